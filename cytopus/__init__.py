@@ -1,4 +1,4 @@
 """A Knowledge Base for Single Cell Biology"""
 
 from .tl import *
-from .knowledge_base import KnowledgeBase, get_data
\ No newline at end of file
+from .knowledge_base import KnowledgeBase, get_data, list_versions, register_version, diff_kb, enable_cache, disable_cache
\ No newline at end of file
@@ -0,0 +1,253 @@
+"""Command line interface: cytopus <command> [options]"""
+import argparse
+import os
+import sys
+import time
+
+#gene sets shared by the labeling workers, set once per worker by _init_worker
+_worker_gene_sets = None
+
+
+def _load_kb(kb):
+    '''
+    load a KnowledgeBase from a path or version name (None for the default KnowledgeBase) without status messages
+    '''
+    from .knowledge_base import KnowledgeBase, get_version_path
+
+    path = kb if kb is not None and os.path.isfile(kb) else get_version_path(kb)
+    return KnowledgeBase(path, verbose=False)
+
+
+def _separator(path):
+    '''
+    column separator of a table file, tab for .tsv/.txt/.gmt files and comma otherwise
+    '''
+    return '\t' if os.path.splitext(path)[1].lower() in ('.tsv', '.txt', '.gmt') else ','
+
+
+def _select_gene_sets(kb, gene_sets, celltypes=None):
+    '''
+    plain dictionary {gene set name: [genes]} of the gene sets to label with or export, the lists are copies which
+    may be modified (e.g. padded by get_gmt) without changing the KnowledgeBase
+    gene_sets: str, 'processes', 'identities', 'all' or 'celltype-processes' (gene sets of celltypes and their relatives)
+    '''
+    if gene_sets == 'celltype-processes':
+        if not celltypes:
+            raise ValueError("--celltypes is required for 'celltype-processes'")
+        gs_dict = {}
+        for v in kb.get_celltype_processes(celltypes, inplace=False).values():
+            for k in v:
+                gs_dict.setdefault(k, list(v[k]))
+        return gs_dict
+    gs_dict = {}
+    if gene_sets in ('processes', 'all'):
+        gs_dict.update((k, list(v)) for k, v in kb.processes.items())
+    if gene_sets in ('identities', 'all'):
+        gs_dict.update((k, list(v)) for k, v in kb.identities.items())
+    return gs_dict
+
+
+def _read_markers(path, markers_key='SPECTRA_markers', celltype_key=None):
+    '''
+    read marker genes (factors x marker genes) from a table with factor names in the first column or from a Spectra
+    .h5ad file (adata.uns[markers_key]), optionally with the cell type of each factor (see cytopus.tl.label.get_celltype)
+    returns: pandas.DataFrame of marker genes, dict {factor: cell type} or None
+    '''
+    import pandas as pd
+
+    if path.endswith('.h5ad'):
+        import anndata
+        from .tl.label import get_celltype
+
+        adata = anndata.read_h5ad(path, backed='r' if celltype_key is None else None)
+        markers = pd.DataFrame(adata.uns[markers_key])
+        celltypes = get_celltype(adata, celltype_key) if celltype_key is not None else None
+        return markers, celltypes
+    return pd.read_csv(path, sep=_separator(path), index_col=0), None
+
+
+def _init_worker(gene_sets):
+    global _worker_gene_sets
+    _worker_gene_sets = gene_sets
+
+
+def _label_file(path, out_dir, threshold, markers_key, celltype_key):
+    '''
+    label the marker genes of one file and write the overlap coefficients to out_dir
+    returns: dict, input and output path, number of factors and labeled factors, and timings in seconds
+    '''
+    from .tl.label import label_marker_genes
+
+    start = time.perf_counter()
+    markers, celltypes = _read_markers(path, markers_key=markers_key, celltype_key=celltype_key)
+    read = time.perf_counter()
+    overlap_df = label_marker_genes(markers.values, _worker_gene_sets, threshold=threshold)
+    overlap_df.index = [label if label in _worker_gene_sets else factor for label, factor in zip(overlap_df.index, markers.index)]
+    if celltypes is not None:
+        overlap_df.insert(0, 'celltype', [celltypes.get(x) for x in markers.index])
+    labeled = time.perf_counter()
+    out_path = os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0] + '_labels.csv')
+    overlap_df.to_csv(out_path)
+    return {'input': path, 'output': out_path, 'n_factors': len(markers),
+            'n_labeled': int(sum(x in _worker_gene_sets for x in overlap_df.index)),
+            'read_s': read - start, 'label_s': labeled - read, 'total_s': time.perf_counter() - start}
+
+
+def _label(args):
+    import pandas as pd
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    start = time.perf_counter()
+    kb = _load_kb(args.kb)
+    gene_sets = _select_gene_sets(kb, args.gene_sets, args.celltypes)
+    print(f"loaded KnowledgeBase with {len(gene_sets)} gene sets in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+    os.makedirs(args.out_dir, exist_ok=True)
+    task_args = (args.out_dir, args.threshold, args.markers_key, args.celltype_key)
+
+    timings = []
+    def report(result):
+        #stream one line per finished file
+        timings.append(result)
+        print(f"{result['input']}\t{result['output']}\t{result['n_labeled']}/{result['n_factors']} labeled\t{result['total_s']:.2f}s", flush=True)
+
+    if args.workers == 1:
+        _init_worker(gene_sets)
+        for path in args.inputs:
+            report(_label_file(path, *task_args))
+    else:
+        #workers receive the gene sets once at startup (inherited without copying when processes are forked)
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(gene_sets,)) as pool:
+            futures = {pool.submit(_label_file, path, *task_args): path for path in args.inputs}
+            for future in as_completed(futures):
+                try:
+                    report(future.result())
+                except Exception as e:
+                    print(f"{futures[future]}\tfailed: {type(e).__name__}: {e}", file=sys.stderr, flush=True)
+
+    timings = pd.DataFrame(timings, columns=['input', 'output', 'n_factors', 'n_labeled', 'read_s', 'label_s', 'total_s'])
+    if args.timings is not None:
+        timings.to_csv(args.timings, index=False)
+    print(f"labeled {len(timings)}/{len(args.inputs)} files in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+    if len(timings) < len(args.inputs):
+        sys.exit(1)
+
+
+def _export(args):
+    from .tl.label import get_gmt, geneset_to_csv, hierarchy_to_csv
+
+    kb = _load_kb(args.kb)
+    if args.gene_sets == 'hierarchy':
+        hierarchy_to_csv({args.root: kb.get_celltype_hierarchy(args.root)}, filename=args.out)
+    else:
+        gs_dict = _select_gene_sets(kb, args.gene_sets, args.celltypes)
+        if args.format == 'gmt':
+            get_gmt(gs_dict, save=True, path=args.out)
+        else:
+            geneset_to_csv(gs_dict, filename=args.out)
+    print(f"exported {args.gene_sets} to {args.out}", file=sys.stderr)
+
+
+def _read_table(path, columns=2):
+    '''
+    rows of a table file with a header line as tuples of its first columns
+    '''
+    import pandas as pd
+
+    df = pd.read_csv(path, sep=_separator(path), dtype=str)
+    return list(df.iloc[:, :columns].itertuples(index=False, name=None))
+
+
+def _build(args):
+    import pandas as pd
+    from .tl.create import construct_kb
+
+    celltype_edges = _read_table(args.celltype_edges)
+    if args.hierarchy_order == 'parent-child':
+        celltype_edges = [(child, parent) for parent, child in celltype_edges]
+    annotation_dict = dict(_read_table(args.annotations))
+    metadata_dict = None
+    if args.metadata is not None:
+        metadata = pd.read_csv(args.metadata, sep=_separator(args.metadata), index_col=0)
+        metadata_dict = {k: {a: v for a, v in row.items() if not pd.isna(v)} for k, row in metadata.to_dict(orient='index').items()}
+    construct_kb(celltype_edges, _read_table(args.geneset_gene_edges), _read_table(args.geneset_celltype_edges),
+                 annotation_dict, metadata_dict=metadata_dict, save=True, save_path=args.out)
+
+
+def _slice(args):
+    kb = _load_kb(args.kb)
+    kb_slice = kb.slice(args.celltypes, depth=args.depth, ancestors=not args.no_ancestors)
+    kb_slice.save(args.out)
+    print(f"saved {len(kb_slice.celltypes)} cell types, {len(kb_slice.processes)} cellular processes and "
+          f"{len(kb_slice.identities)} identities to {args.out} ({os.path.getsize(args.out) / 2**20:.2f} MB)", file=sys.stderr)
+
+
+def _serve(args):
+    from .knowledge_base.kb_server import serve
+    serve(args.kb, host=args.host, port=args.port)
+
+
+def build_parser():
+    '''
+    argument parser of the cytopus command line interface
+    '''
+    parser = argparse.ArgumentParser(prog='cytopus', description='A Knowledge Base for Single Cell Biology')
+    commands = parser.add_subparsers(dest='command', required=True)
+    kb_help = 'KnowledgeBase path or version name (see cytopus.list_versions), default KnowledgeBase if omitted'
+    gene_set_choices = ['processes', 'identities', 'all', 'celltype-processes']
+
+    label = commands.add_parser('label', help='label marker genes of many files (e.g. Spectra factors) with KnowledgeBase gene sets')
+    label.add_argument('inputs', nargs='+', help='marker gene tables (factors x marker genes, factor names in the first column) or Spectra .h5ad files')
+    label.add_argument('--kb', default=None, help=kb_help)
+    label.add_argument('--out-dir', default='.', help='directory to write <input>_labels.csv files to (default: .)')
+    label.add_argument('--gene-sets', choices=gene_set_choices, default='processes', help='gene sets to label with (default: processes)')
+    label.add_argument('--celltypes', nargs='+', default=None, help="cell types for --gene-sets celltype-processes")
+    label.add_argument('--threshold', type=float, default=0.4, help='minimum overlap coefficient to label a factor (default: 0.4)')
+    label.add_argument('--markers-key', default='SPECTRA_markers', help='adata.uns key of the marker genes in .h5ad files (default: SPECTRA_markers)')
+    label.add_argument('--celltype-key', default=None, help='adata.obs key of cell type labels in .h5ad files, adds the cell type of each factor')
+    label.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes (default: number of CPUs)')
+    label.add_argument('--timings', default=None, help='path to write per-file timings to (.csv)')
+    label.set_defaults(func=_label)
+
+    export = commands.add_parser('export', help='export KnowledgeBase gene sets or the cell type hierarchy')
+    export.add_argument('gene_sets', choices=gene_set_choices + ['hierarchy'], help='what to export')
+    export.add_argument('out', help='output path')
+    export.add_argument('--kb', default=None, help=kb_help)
+    export.add_argument('--format', choices=['gmt', 'csv'], default='gmt', help='gene set file format (default: gmt)')
+    export.add_argument('--celltypes', nargs='+', default=None, help="cell types for celltype-processes")
+    export.add_argument('--root', default='all-cells', help="root cell type of the exported hierarchy (default: all-cells)")
+    export.set_defaults(func=_export)
+
+    build = commands.add_parser('build', help='build a KnowledgeBase from edge files (.csv or .tsv with a header line)')
+    build.add_argument('out', help='path to save the pickled KnowledgeBase graph to')
+    build.add_argument('--celltype-edges', required=True, help='cell type hierarchy edges')
+    build.add_argument('--hierarchy-order', choices=['parent-child', 'child-parent'], default='parent-child',
+                       help='column order of --celltype-edges (default: parent-child as written by cytopus export hierarchy)')
+    build.add_argument('--geneset-gene-edges', required=True, help='gene set, gene edges')
+    build.add_argument('--geneset-celltype-edges', required=True, help='gene set, cell type edges')
+    build.add_argument('--annotations', required=True, help='gene set, annotation (cellular_process or cellular_identity)')
+    build.add_argument('--metadata', default=None, help='gene set metadata, gene set names in the first column and one column per attribute')
+    build.set_defaults(func=_build)
+
+    kb_slice = commands.add_parser('slice', help='save the part of a KnowledgeBase relevant to some cell types (e.g. to ship to workers)')
+    kb_slice.add_argument('out', help='path to save the pickled KnowledgeBase slice to (load with --kb or cytopus.KnowledgeBase)')
+    kb_slice.add_argument('--celltypes', nargs='+', required=True, help='cell types to keep with their descendants and ancestors')
+    kb_slice.add_argument('--kb', default=None, help=kb_help)
+    kb_slice.add_argument('--depth', type=int, default=None, help='maximum number of levels below --celltypes to keep (default: all)')
+    kb_slice.add_argument('--no-ancestors', action='store_true', help='do not keep the ancestors of --celltypes and their gene sets')
+    kb_slice.set_defaults(func=_slice)
+
+    serve = commands.add_parser('serve', help='load a KnowledgeBase once and answer queries over HTTP/JSON')
+    serve.add_argument('--kb', default=None, help=kb_help)
+    serve.add_argument('--host', default='127.0.0.1', help='interface to listen on (default: 127.0.0.1)')
+    serve.add_argument('--port', type=int, default=8765, help='port to listen on (default: 8765)')
+    serve.set_defaults(func=_serve)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
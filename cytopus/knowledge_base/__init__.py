@@ -1,5 +1,9 @@
 """Tools to plot and query KnowledgeBase"""
 from .kb_queries import KnowledgeBase, get_data
+from .kb_versions import list_versions, register_version, get_version_path, diff_kb
+from .kb_cache import ResultCache, enable_cache, disable_cache
+from .kb_server import KnowledgeBaseClient, serve
+from .kb_shared import SharedKnowledgeBase, publish_kb, attach_kb
 
 
 
@@ -0,0 +1,152 @@
+"""Opt-in persistent cache for query and labeling results"""
+import hashlib
+import os
+import pickle
+import tempfile
+import numpy as np
+
+#cache used when functions are called with cache=None, set with enable_cache
+_default_cache = None
+
+
+class ResultCache:
+    def __init__(self, path=None, max_size=2**30):
+        '''
+        directory of pickled results with least recently used eviction
+        results are loaded with pickle, which can execute arbitrary code: the directory must only be writable by users
+        whose files you would import (new directories are created private to the current user), do not share a cache
+        directory with untrusted users
+        path: str, cache directory, defaults to $XDG_CACHE_HOME/cytopus (~/.cache/cytopus)
+        max_size: int, maximum total size of the cache in bytes
+        '''
+        if path is None:
+            path = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'cytopus')
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        self.path = path
+        self.max_size = max_size
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.pkl')
+
+    def get(self, key):
+        '''
+        return the cached result for key, or None if it is not cached
+        '''
+        try:
+            with open(self._file(key), 'rb') as f:
+                result = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        #mark as recently used, another process may have evicted the entry since it was read
+        try:
+            os.utime(self._file(key))
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, result):
+        '''
+        store result under key and evict the least recently used entries above max_size
+        '''
+        with tempfile.NamedTemporaryFile(dir=self.path, suffix='.tmp', delete=False) as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, self._file(key))
+        self.evict()
+
+    def evict(self):
+        '''
+        delete least recently used entries until the cache is smaller than max_size
+        '''
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.pkl'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(x[1] for x in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+
+    def size(self):
+        '''
+        total size of the cached results in bytes
+        '''
+        return sum(entry.stat().st_size for entry in os.scandir(self.path) if entry.name.endswith('.pkl'))
+
+    def clear(self):
+        '''
+        delete all cached results
+        '''
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.pkl'):
+                os.remove(entry.path)
+
+
+def enable_cache(path=None, max_size=2**30):
+    '''
+    cache results of KnowledgeBase.get_celltype_processes and tl.label.label_marker_genes on disk
+    cached results are keyed by the content of the KnowledgeBase (or gene sets) and the call parameters, results of
+    a changed KnowledgeBase are therefore never returned
+    cached results are unpickled, only use a cache directory which untrusted users cannot write to
+    path: str, cache directory, defaults to $XDG_CACHE_HOME/cytopus (~/.cache/cytopus)
+    max_size: int, maximum total size of the cache in bytes, least recently used results are deleted first
+    returns: cytopus.knowledge_base.kb_cache.ResultCache
+    '''
+    global _default_cache
+    _default_cache = ResultCache(path=path, max_size=max_size)
+    return _default_cache
+
+
+def disable_cache():
+    '''
+    stop caching results on disk (cached files are kept)
+    '''
+    global _default_cache
+    _default_cache = None
+
+
+def get_cache(cache=None):
+    '''
+    resolve the cache argument of cached functions
+    cache: None to use the cache set with enable_cache, False to disable caching, or a ResultCache
+    '''
+    if cache is None:
+        return _default_cache
+    if cache is False:
+        return None
+    return cache
+
+
+def make_key(*parts):
+    '''
+    hash normalized call parameters (json-like values, numpy arrays and pandas objects) into a cache key
+    '''
+    import pandas as pd
+
+    digest = hashlib.sha1()
+
+    def update(value):
+        if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+            digest.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+            digest.update(repr(list(getattr(value, 'columns', []))).encode())
+        elif isinstance(value, np.ndarray):
+            update(pd.DataFrame(value.reshape(len(value), -1)))
+        elif isinstance(value, dict):
+            digest.update(b'{')
+            for k in sorted(value, key=repr):
+                update(k)
+                update(value[k])
+            digest.update(b'}')
+        elif isinstance(value, (list, tuple)):
+            digest.update(b'[')
+            for x in value:
+                update(x)
+            digest.update(b']')
+        else:
+            digest.update(repr(value).encode() + b';')
+
+    for part in parts:
+        update(part)
+    return digest.hexdigest()
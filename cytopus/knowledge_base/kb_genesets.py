@@ -0,0 +1,38 @@
+"""Memory accounting of the gene set dictionaries and indices of a KnowledgeBase"""
+import sys
+import numpy as np
+
+
+def deep_sizeof(obj, seen=None):
+    '''
+    approximate memory size of an object and everything it references, counting shared objects only once
+    obj: object to measure
+    seen: set, ids of objects already counted (shared between calls to attribute shared objects to the first caller)
+    returns: int, size in bytes
+    '''
+    if seen is None:
+        seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        x = stack.pop()
+        if id(x) in seen:
+            continue
+        seen.add(id(x))
+        if isinstance(x, np.ndarray):
+            #arrays owning their data include it in getsizeof, views point to their base
+            size += sys.getsizeof(x)
+            if x.base is not None:
+                stack.append(x.base)
+            if x.dtype == object:
+                stack.extend(x.ravel().tolist())
+            continue
+        size += sys.getsizeof(x)
+        if isinstance(x, dict):
+            stack.extend(x.keys())
+            stack.extend(x.values())
+        elif isinstance(x, (list, tuple, set, frozenset)):
+            stack.extend(x)
+        elif hasattr(x, '__dict__') and not isinstance(x, type):
+            stack.append(x.__dict__)
+    return size
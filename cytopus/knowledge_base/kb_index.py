@@ -0,0 +1,540 @@
+"""Integer-encoded index over a KnowledgeBase graph"""
+import threading
+import numpy as np
+
+#node class implied for gene sets without a 'class' attribute by the edge linking them to a cell type
+GENE_SET_EDGE_CLASSES = {'process_OF': 'cellular_process', 'identity_OF': 'identity'}
+
+
+class KBIndex:
+    def __init__(self, graph):
+        '''
+        integer-encode the nodes and edges of a KnowledgeBase graph
+        graph: networkx.DiGraph, formatted for cytopus
+        '''
+        #node table, attributes are shared with the graph
+        self.names = list(graph.nodes)
+        self.codes = {n: i for i, n in enumerate(self.names)}
+        self.attributes = [d for _, d in graph.nodes(data=True)]
+
+        #edge table
+        n_edges = graph.number_of_edges()
+        self.edge_src = np.empty(n_edges, dtype=np.int32)
+        self.edge_dst = np.empty(n_edges, dtype=np.int32)
+        edge_class_codes = {}
+        edge_class = np.empty(n_edges, dtype=np.int16)
+        for i, (u, v, c) in enumerate(graph.edges(data='class')):
+            self.edge_src[i] = self.codes[u]
+            self.edge_dst[i] = self.codes[v]
+            edge_class[i] = edge_class_codes.setdefault(c, len(edge_class_codes))
+        self.edge_classes = list(edge_class_codes)
+        self.edge_class = edge_class
+
+        #node classes, inferred from gene set edges where the attribute is missing
+        node_class_codes = {}
+        node_class = np.empty(len(self.names), dtype=np.int16)
+        for i, (n, c) in enumerate(graph.nodes(data='class')):
+            node_class[i] = node_class_codes.setdefault(c, len(node_class_codes))
+        for edge_name, class_name in GENE_SET_EDGE_CLASSES.items():
+            if edge_name not in edge_class_codes or None not in node_class_codes:
+                continue
+            origins = self.edge_src[self.edge_class == edge_class_codes[edge_name]]
+            origins = origins[node_class[origins] == node_class_codes[None]]
+            node_class[origins] = node_class_codes.setdefault(class_name, len(node_class_codes))
+        self.classes = list(node_class_codes)
+        self.node_class = node_class
+
+        #edges between cell types in the order of graph.pred (the order networkx lists the children of a cell type in),
+        #which differs from the edge table order in graph.edges
+        celltype_mask = self.node_class_mask(['cell_type'])
+        celltype_edges = np.flatnonzero(celltype_mask[self.edge_src] & celltype_mask[self.edge_dst])
+        positions = {(u, v): i for u, v, i in zip(self.edge_src[celltype_edges].tolist(), self.edge_dst[celltype_edges].tolist(),
+                                                 celltype_edges.tolist())}
+        self.child_order = np.array([positions[(self.codes[u], self.codes[v])] for v in np.array(self.names, dtype=object)[celltype_mask]
+                                     for u in graph.pred[v] if celltype_mask[self.codes[u]]], dtype=np.int32)
+
+        #memoized hierarchy structures and indexes
+        self._adjacency = {}
+        self._traversals = {}
+        self._edge_adjacency = {}
+        self._metadata = {}
+        self._incidence = {}
+        self._name_index = None
+        self._content_hash = {}
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        return {k: v for k, v in self.__dict__.items() if k != '_lock'}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def _memoized(self, cache, key, build):
+        '''
+        cache[key], computed with build() on first use, memos are filled under the index's lock so that concurrent
+        readers (e.g. the threads of a KBSnapshot server) build every structure once and see it complete
+        '''
+        value = cache.get(key)
+        if value is None:
+            with self._lock:
+                value = cache.get(key)
+                if value is None:
+                    value = build()
+                    cache[key] = value
+        return value
+
+    def node_class_mask(self, classes):
+        '''
+        boolean mask over all nodes selecting the node classes in classes
+        classes: list, node classes to select (e.g. ['cell_type','gene'])
+        '''
+        codes = [i for i, c in enumerate(self.classes) if c in classes]
+        return np.isin(self.node_class, codes)
+
+    def edge_class_mask(self, classes):
+        '''
+        boolean mask over all edges selecting the edge classes in classes
+        classes: list, edge classes to select (e.g. ['process_OF'])
+        '''
+        codes = [i for i, c in enumerate(self.edge_classes) if c in classes]
+        return np.isin(self.edge_class, codes)
+
+    def class_of(self, node):
+        '''
+        return the (inferred) class of a node
+        node: str, node name
+        '''
+        return self.classes[self.node_class[self.codes[node]]]
+
+    def get_codes(self, nodes):
+        '''
+        node codes of a list of node names, -1 for names not in the KnowledgeBase
+        '''
+        return np.array([self.codes.get(n, -1) for n in nodes], dtype=np.int64)
+
+    def edge_adjacency(self, edge_classes, by='src'):
+        '''
+        CSR index of the edges of some classes, memoized for this index
+        edge_classes: list, edge classes to include (e.g. ['process_OF','identity_OF'])
+        by: str, 'src' to group edges by their origin, 'dst' to group them by their target
+        returns: (indptr, neighbors, edges) with the neighbors and edge positions of node code i in
+        neighbors[indptr[i]:indptr[i+1]] and edges[indptr[i]:indptr[i+1]]
+        '''
+        def build():
+            edges = np.flatnonzero(self.edge_class_mask(edge_classes))
+            origin, target = (self.edge_src, self.edge_dst) if by == 'src' else (self.edge_dst, self.edge_src)
+            edges = edges[np.argsort(origin[edges], kind='stable')]
+            indptr = np.zeros(len(self) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(origin[edges], minlength=len(self)), out=indptr[1:])
+            return (indptr, target[edges], edges)
+        return self._memoized(self._edge_adjacency, (tuple(sorted(edge_classes)), by), build)
+
+    def metadata_index(self, attribute):
+        '''
+        inverted index of a node attribute, memoized for this index
+        attribute: str, node attribute (e.g. 'gene_set_topic')
+        returns: dict, {attribute value: array of node codes}
+        '''
+        def build():
+            postings = {}
+            for i, d in enumerate(self.attributes):
+                value = d.get(attribute)
+                if value is not None:
+                    try:
+                        postings.setdefault(value, []).append(i)
+                    except TypeError:
+                        postings.setdefault(str(value), []).append(i)
+            return {k: np.array(v, dtype=np.int64) for k, v in postings.items()}
+        return self._memoized(self._metadata, attribute, build)
+
+    def content_hash(self, ordered=False):
+        '''
+        hash of all node names, node classes and edges, memoized for this index
+        ordered: bool, if False the hash is independent of the order of nodes and edges, if True it also changes with
+        their order (e.g. to key results listed in graph order)
+        returns: str, hex digest
+        '''
+        def build():
+            import hashlib
+            names = hash_names(self.names)
+            node_keys = names ^ hash_names(self.classes)[self.node_class] * np.uint64(0xC2B2AE3D27D4EB4F)
+            edge_keys = (names[self.edge_src] * np.uint64(0x9E3779B97F4A7C15) ^ names[self.edge_dst]
+                         ^ hash_names(self.edge_classes)[self.edge_class] * np.uint64(0xC2B2AE3D27D4EB4F))
+            if not ordered:
+                node_keys, edge_keys = np.sort(node_keys), np.sort(edge_keys)
+                child_order = b''
+            else:
+                child_order = self.child_order.tobytes()
+            return hashlib.sha1(node_keys.tobytes() + edge_keys.tobytes() + child_order).hexdigest()
+        return self._memoized(self._content_hash, ordered, build)
+
+    def celltype_adjacency(self, invert=False):
+        '''
+        CSR adjacency of the cell type hierarchy, restricted to edges between cell type nodes
+        invert: bool, if False map every cell type to its children, if True map every cell type to its parents
+        returns: (indptr, indices) with the neighbors of node code i in indices[indptr[i]:indptr[i+1]], in the order
+        networkx lists them (graph.predecessors for children, graph.successors for parents)
+        '''
+        def build():
+            if invert:
+                celltype_mask = self.node_class_mask(['cell_type'])
+                edges = np.flatnonzero(celltype_mask[self.edge_src] & celltype_mask[self.edge_dst])
+            else:
+                edges = self.child_order
+            #edges point from child to parent
+            child, parent = self.edge_src[edges], self.edge_dst[edges]
+            origin, target = (child, parent) if invert else (parent, child)
+            order = np.argsort(origin, kind='stable')
+            indptr = np.zeros(len(self) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(origin, minlength=len(self)), out=indptr[1:])
+            return (indptr, target[order])
+        return self._memoized(self._adjacency, invert, build)
+
+    def celltype_lca(self):
+        '''
+        lowest common ancestor structure (TreeLCA) of the cell type hierarchy, memoized for this index
+        '''
+        def build():
+            indptr, parents = self.celltype_adjacency(invert=True)
+            celltypes = np.flatnonzero(self.node_class_mask(['cell_type']))
+            n_parents = indptr[celltypes + 1] - indptr[celltypes]
+            if (n_parents > 1).any():
+                raise ValueError('lowest common ancestors require a cell type tree, some cell types have several parents')
+            position = np.full(len(self), -1, dtype=np.int64)
+            position[celltypes] = np.arange(len(celltypes))
+            celltype_parents = np.where(n_parents == 1, position[parents[np.minimum(indptr[celltypes], len(parents) - 1)]], -1)
+            return TreeLCA([self.names[x] for x in celltypes], celltype_parents)
+        return self._memoized(self._adjacency, 'lca', build)
+
+    def celltype_roots(self):
+        '''
+        return the codes of all cell types without parents
+        '''
+        indptr, _ = self.celltype_adjacency(invert=True)
+        celltypes = np.flatnonzero(self.node_class_mask(['cell_type']))
+        return celltypes[indptr[celltypes + 1] == indptr[celltypes]]
+
+    def traverse_hierarchy(self, node, invert=False, depth=None):
+        '''
+        breadth-first traversal of the cell type hierarchy, memoized for this index, each cell type is visited once
+        (from the first cell type it is reached from, like networkx.bfs_tree) also if it has several parents
+        node: str, cell type to start from (not contained in the output)
+        invert: bool, if False traverse to the children, if True traverse to the parents
+        depth: int, maximum number of steps from node, None for no limit
+        returns: (codes, parents) arrays of the visited node codes and the position of the node they were reached from
+        in codes (-1 for node)
+        '''
+        def build():
+            indptr, indices = self.celltype_adjacency(invert=invert)
+            codes, parents = [], []
+            frontier = np.array([self.codes[node]])
+            frontier_positions = np.array([-1])
+            visited = np.zeros(len(self), dtype=bool)
+            visited[frontier] = True
+            level = 0
+            n_visited = 0
+            while len(frontier) and (depth is None or level < depth):
+                #gather all neighbors of the current frontier at once
+                rows, next_frontier = csr_gather(indptr, indices, frontier)
+                #drop visited cell types and keep the first occurrence of cell types reached from several parents
+                unvisited = ~visited[next_frontier]
+                rows, next_frontier = rows[unvisited], next_frontier[unvisited]
+                first = np.sort(np.unique(next_frontier, return_index=True)[1])
+                rows, next_frontier = rows[first], next_frontier[first]
+                if len(next_frontier) == 0:
+                    break
+                visited[next_frontier] = True
+                codes.append(next_frontier)
+                parents.append(frontier_positions[rows])
+                frontier = next_frontier
+                frontier_positions = np.arange(n_visited, n_visited + len(next_frontier))
+                n_visited += len(next_frontier)
+                level += 1
+            empty = np.array([], dtype=np.int64)
+            return (np.concatenate(codes) if codes else empty, np.concatenate(parents) if parents else empty)
+        return self._memoized(self._traversals, (node, invert, depth), build)
+
+    def nested_hierarchy(self, node, invert=False, depth=None):
+        '''
+        nested dictionary of the cell type hierarchy below (or above) a cell type, built iteratively
+        node: str, cell type to start from (not contained in the output)
+        invert: bool, if False the dict will contain all children below the node, if True all parents above the node
+        depth: int, maximum number of steps from node, None for no limit
+        '''
+        codes, parents = self.traverse_hierarchy(node, invert=invert, depth=depth)
+        root = {}
+        containers = []
+        for code, parent in zip(codes.tolist(), parents.tolist()):
+            container = {}
+            (root if parent < 0 else containers[parent])[self.names[code]] = container
+            containers.append(container)
+        return root
+
+    def slice_codes(self, celltypes, depth=None, ancestors=True):
+        '''
+        nodes and edges of the part of the KnowledgeBase relevant to some cell types: the cell types, their descendants
+        (up to depth) and ancestors, the gene sets attached to them and the genes of these gene sets
+        celltypes: list, cell types to slice the KnowledgeBase for
+        depth: int, maximum number of levels below celltypes to include, None for all descendants
+        ancestors: bool, if True include all ancestors of celltypes (e.g. 'all-cells' for global gene sets)
+        returns: (node codes, edge positions) sorted in KnowledgeBase order, edges are all edges between the nodes
+        '''
+        codes = self.get_codes(celltypes)
+        if (codes < 0).any():
+            raise ValueError(f"cell types not contained in the KnowledgeBase: {[c for c, x in zip(celltypes, codes) if x < 0]}")
+        mask = np.zeros(len(self), dtype=bool)
+        mask[codes] = True
+        for celltype in celltypes:
+            mask[self.traverse_hierarchy(celltype, invert=False, depth=depth)[0]] = True
+            if ancestors:
+                mask[self.traverse_hierarchy(celltype, invert=True)[0]] = True
+        #gene sets attached to the cell types and their genes
+        indptr, neighbors, _ = self.edge_adjacency(list(GENE_SET_EDGE_CLASSES), by='dst')
+        gene_sets = csr_gather(indptr, neighbors, np.flatnonzero(mask))[1]
+        mask[gene_sets] = True
+        #only gene members, names of gene set members which are also cell types (e.g. 'MSC') do not pull in those cell types
+        indptr, neighbors, _ = self.edge_adjacency(['gene_OF'], by='src')
+        genes = csr_gather(indptr, neighbors, gene_sets)[1]
+        mask[genes[self.node_class_mask(['gene'])[genes]]] = True
+        return np.flatnonzero(mask), np.flatnonzero(mask[self.edge_src] & mask[self.edge_dst])
+
+    def name_index(self):
+        '''
+        NameIndex (cytopus.knowledge_base.kb_names) over all cell types ('celltype'), gene sets ('gene_set') and
+        genes ('gene') including the 'synonyms' node attributes, memoized for this index
+        '''
+        if self._name_index is not None:
+            return self._name_index
+        with self._lock:
+            if self._name_index is None:
+                from .kb_names import NameIndex
+
+                kinds = np.array(['gene_set'] * len(self.classes), dtype=object)
+                for node_class, kind in [('cell_type', 'celltype'), ('gene', 'gene')]:
+                    if node_class in self.classes:
+                        kinds[self.classes.index(node_class)] = kind
+                synonyms = {}
+                for name, d in zip(self.names, self.attributes):
+                    values = d.get('synonyms')
+                    for synonym in ([values] if isinstance(values, str) else values or []):
+                        synonyms.setdefault(synonym, str(name))
+                self._name_index = NameIndex(self.names, kinds[self.node_class], synonyms=synonyms)
+        return self._name_index
+
+    def gene_set_incidence(self, var_names, gene_sets, genes=None):
+        '''
+        genes x gene sets incidence matrix aligned to a dataset's var index, memoized per hash of the var index and gene sets
+        var_names: array-like, gene names of the dataset (e.g. adata.var_names), the first occurrence of duplicates is used
+        gene_sets: list, gene set names, one column each
+        genes: list of lists, genes of each gene set, None to use the gene set memberships of the KnowledgeBase
+        returns: (scipy.sparse.csr_matrix of float32 with shape (len(var_names), len(gene_sets)), numpy.ndarray of the
+        number of genes per gene set, numpy.ndarray of the number of genes found in var_names per gene set, numpy.ndarray
+        of genes not found in var_names), shared between calls and not to be modified
+        '''
+        import hashlib
+        import pandas as pd
+
+        var_names = pd.Index(np.asarray(var_names, dtype=object))
+        gene_sets = list(gene_sets)
+        digest = hashlib.sha1(pd.util.hash_array(var_names.values).tobytes())
+        digest.update(hash_names(gene_sets).tobytes())
+        if genes is not None:
+            lengths = np.array([len(g) for g in genes], dtype=np.int64)
+            flat = np.array([x for g in genes for x in g], dtype=object)
+            digest.update(hash_names(flat).tobytes() + lengths.tobytes())
+
+        def build():
+            if genes is None:
+                codes = self.get_codes(gene_sets)
+                if (codes < 0).any():
+                    raise ValueError(f"gene sets not contained in the KnowledgeBase: {[g for g, c in zip(gene_sets, codes) if c < 0]}")
+                indptr, neighbors, _ = self.edge_adjacency(['gene_OF'], by='src')
+                columns, gene_codes = csr_gather(indptr, neighbors, codes)
+                #only members of class gene, like KnowledgeBase.processes (some gene names are also cell type names)
+                is_gene = self.node_class_mask(['gene'])[gene_codes]
+                columns, gene_codes = columns[is_gene], gene_codes[is_gene]
+                members = np.array(self.names, dtype=object)[gene_codes]
+            else:
+                columns, members = np.repeat(np.arange(len(gene_sets)), lengths), flat
+            matrix, n_genes, missing = incidence_matrix(var_names, columns, members, len(gene_sets))
+
+            #keep the alignments of the most recent datasets
+            if len(self._incidence) >= 16:
+                del self._incidence[next(iter(self._incidence))]
+            return (matrix, n_genes, matrix.getnnz(axis=0), missing)
+        return self._memoized(self._incidence, digest.hexdigest(), build)
+
+
+class TreeLCA:
+    def __init__(self, names, parents):
+        '''
+        lowest common ancestor structure of a tree (or forest) using an Euler tour and a sparse table of depths
+        names: list, node names
+        parents: numpy.ndarray, parent position of every node, -1 for roots
+        '''
+        import pandas as pd
+
+        self.names = np.array(names, dtype=object)
+        self._lookup = pd.Index(names)
+        n = len(names)
+        parents = np.where(np.asarray(parents) < 0, n, parents)  # node n is a virtual root joining all trees
+        order = np.argsort(parents, kind='stable')
+        indptr = np.zeros(n + 2, dtype=np.int64)
+        np.cumsum(np.bincount(parents, minlength=n + 1), out=indptr[1:])
+
+        #iterative depth first Euler tour starting at the virtual root
+        euler, euler_depth = [], []
+        self.first = np.full(n + 1, -1, dtype=np.int64)
+        self.depth = np.zeros(n + 1, dtype=np.int64)
+        stack = [(n, 0)]
+        while stack:
+            node, child_position = stack.pop()
+            if self.first[node] < 0:
+                self.first[node] = len(euler)
+            euler.append(node)
+            euler_depth.append(self.depth[node])
+            if indptr[node] + child_position < indptr[node + 1]:
+                child = order[indptr[node] + child_position]
+                self.depth[child] = self.depth[node] + 1
+                stack.append((node, child_position + 1))
+                stack.append((child, 0))
+        if (self.first < 0).any():
+            raise ValueError('hierarchy contains a cycle')
+        self.euler = np.array(euler, dtype=np.int64)
+        euler_depth = np.array(euler_depth, dtype=np.int64)
+
+        #sparse table: table[k][i] is the Euler position with minimal depth in [i, i + 2**k)
+        table = [np.arange(len(euler))]
+        while 2 ** len(table) <= len(euler):
+            previous, half = table[-1], 2 ** (len(table) - 1)
+            left, right = previous[:-half], previous[half:]
+            table.append(np.where(euler_depth[left] <= euler_depth[right], left, right))
+        self._table = table
+        self._euler_depth = euler_depth
+
+    def lca_codes(self, a, b):
+        '''
+        lowest common ancestors and tree distances of pairs of node positions
+        a, b: numpy.ndarray, node positions (-1 for missing)
+        returns: (lca, distance) arrays, -1 where a node is missing or the nodes are in different trees
+        '''
+        valid = (a >= 0) & (b >= 0)
+        a, b = np.where(valid, a, 0), np.where(valid, b, 0)
+        left = np.minimum(self.first[a], self.first[b])
+        right = np.maximum(self.first[a], self.first[b]) + 1
+        level = np.log2(right - left).astype(np.int64)
+        lca = np.empty(len(a), dtype=np.int64)
+        for k in np.unique(level):
+            selected = level == k
+            candidate_left = self._table[k][left[selected]]
+            candidate_right = self._table[k][right[selected] - 2 ** k]
+            position = np.where(self._euler_depth[candidate_left] <= self._euler_depth[candidate_right], candidate_left, candidate_right)
+            lca[selected] = self.euler[position]
+        distance = self.depth[a] + self.depth[b] - 2 * self.depth[lca]
+        missing = ~valid | (lca == len(self.names))
+        lca[missing] = -1
+        distance[missing] = -1
+        return lca, distance
+
+    def lca_labels(self, labels_a, labels_b):
+        '''
+        lowest common ancestors and tree distances of pairs of node names, only distinct names are looked up
+        labels_a, labels_b: array-like or pandas.Series (also categorical), node names compared as strings
+        (names not in the tree are treated as missing)
+        returns: (lca, distance) with lca as pandas.Categorical (NaN if missing) and distance (-1 if missing)
+        '''
+        import pandas as pd
+
+        codes = []
+        for labels in [labels_a, labels_b]:
+            if isinstance(getattr(labels, 'dtype', None), pd.CategoricalDtype):
+                value_codes, values = np.asarray(labels.cat.codes if isinstance(labels, pd.Series) else labels.codes), labels.categories if not isinstance(labels, pd.Series) else labels.cat.categories
+            else:
+                value_codes, values = pd.factorize(np.asarray(labels, dtype=object))
+            codes.append(np.append(self._lookup.get_indexer(pd.Index(values).astype(str)), -1)[value_codes])
+        lca, distance = self.lca_codes(*codes)
+        return pd.Categorical.from_codes(lca, categories=pd.Index(self.names)), distance
+
+
+def hash_names(names):
+    '''
+    stable 64 bit hashes of node names (or other values, hashed by their string representation)
+    '''
+    import pandas as pd
+    return pd.util.hash_array(np.array([str(x) for x in names], dtype=object))
+
+
+def incidence_matrix(var_names, columns, genes, n_columns):
+    '''
+    binary genes x columns incidence matrix of (column, gene) pairs aligned to a var index, missing genes (NaN, None
+    and 'nan') are dropped and genes listed several times in a column count once
+    var_names: pandas.Index, gene names to align to, the first occurrence of duplicates is used
+    columns: numpy.ndarray, column of every pair
+    genes: numpy.ndarray of object, gene of every pair
+    n_columns: int, number of columns
+    returns: (scipy.sparse.csr_matrix of float32 with shape (len(var_names), n_columns), numpy.ndarray of the number
+    of distinct genes per column, numpy.ndarray of the genes not found in var_names)
+    '''
+    import pandas as pd
+    import scipy.sparse
+
+    valid = ~(pd.isna(genes) | (genes.astype(str) == 'nan'))
+    columns, genes = columns[valid], genes[valid]
+
+    #position of every gene in var_names, -1 if missing
+    first = ~var_names.duplicated()
+    rows = var_names[first].get_indexer(genes)
+    rows = np.where(rows >= 0, np.flatnonzero(first)[rows], -1)
+    found = rows >= 0
+    matrix = scipy.sparse.csr_matrix((np.ones(found.sum(), dtype=np.float32), (rows[found], columns[found])),
+                                     shape=(len(var_names), n_columns))
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    unique_columns = pd.DataFrame({'column': columns, 'gene': genes}).drop_duplicates()['column'].values
+    n_genes = np.bincount(unique_columns, minlength=n_columns)
+    return matrix, n_genes, np.unique(genes[~found].astype(str))
+
+
+def csr_gather(indptr, indices, rows):
+    '''
+    gather the neighbors of several rows of a CSR index at once
+    indptr, indices: CSR index
+    rows: numpy.ndarray, row codes
+    returns: (positions, neighbors) with the position in rows each neighbor belongs to
+    '''
+    counts = indptr[rows + 1] - indptr[rows]
+    positions = np.repeat(np.arange(len(rows)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return positions, indices[indptr[rows][positions] + offsets]
+
+
+def encode_strings(strings):
+    '''
+    encode a list of strings as one utf-8 buffer plus offsets
+    strings: list of str
+    returns: (numpy.ndarray of uint8, numpy.ndarray of int64 offsets with len(strings)+1 entries)
+    '''
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(buffer, offsets):
+    '''
+    decode strings encoded with encode_strings
+    buffer: numpy.ndarray of uint8
+    offsets: numpy.ndarray of int64
+    returns: list of str
+    '''
+    raw = bytes(buffer)
+    offsets = offsets.tolist()
+    if raw.isascii():
+        #byte offsets are character offsets, slice one decoded string
+        text = raw.decode('ascii')
+        return [text[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+    return [raw[a:b].decode('utf-8') for a, b in zip(offsets[:-1], offsets[1:])]
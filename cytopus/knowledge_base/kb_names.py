@@ -0,0 +1,213 @@
+"""Name index for batch resolution of free-text labels to KnowledgeBase names"""
+import numpy as np
+
+#characters treated as word separators when normalizing names
+_SEPARATORS = r'[\s_\-\.,;:/\\()\[\]+]+'
+
+#scores of the lookup methods, prefix and fuzzy matches are scaled by their similarity
+METHOD_SCORES = {'exact': 1.0, 'synonym': 1.0, 'normalized': 0.95, 'prefix': 0.9, 'fuzzy': 0.85}
+
+
+def normalize_names(names):
+    '''
+    normalize names for matching: case-folded, with runs of spaces, underscores, hyphens and other separators
+    replaced by a single space, plural s removed from words and the word 'cell' dropped (e.g. 'T-cells' -> 't')
+    names: array-like of str
+    returns: numpy.ndarray of str
+    '''
+    import pandas as pd
+    names = pd.Series(np.asarray(names, dtype=object)).astype(str)
+    names = names.str.casefold().str.replace(_SEPARATORS, ' ', regex=True).str.strip()
+    names = names.str.replace(r'(?<=\w{3})s\b', '', regex=True)
+    without_cell = names.str.replace(r'\bcell\b', ' ', regex=True).str.replace(r'\s+', ' ', regex=True).str.strip()
+    return names.where(without_cell == '', without_cell).values.astype(str)
+
+
+def _trigrams(names):
+    '''
+    character trigrams of names padded with spaces
+    returns: (positions, trigrams) with the position in names each trigram belongs to
+    '''
+    positions, trigrams = [], []
+    for i, name in enumerate(names):
+        padded = f' {name} '
+        grams = {padded[j:j + 3] for j in range(len(padded) - 2)}
+        positions.extend([i] * len(grams))
+        trigrams.extend(grams)
+    return np.array(positions, dtype=np.int64), np.array(trigrams, dtype=object)
+
+
+class NameIndex:
+    def __init__(self, names, kinds=None, synonyms=None):
+        '''
+        index of names for exact, synonym, normalized, prefix and fuzzy (character trigram) lookup
+        names: list of str, names to resolve labels to
+        kinds: list of str, kind of every name (e.g. 'celltype', 'gene_set', 'gene'), None if all names are of one kind
+        synonyms: dict, {synonym: name} alternative names of names
+        '''
+        import pandas as pd
+        import scipy.sparse
+
+        self.names = np.array([str(x) for x in names], dtype=object)
+        self.kinds = np.array(['name'] * len(self.names) if kinds is None else list(kinds), dtype=object)
+        self.normalized = normalize_names(self.names)
+
+        synonyms = {} if synonyms is None else dict(synonyms)
+        name_codes = {}
+        for i, name in enumerate(self.names):
+            name_codes.setdefault(name, i)
+        codes = np.array([name_codes.get(str(x), -1) for x in synonyms.values()], dtype=np.int64)
+        if (codes < 0).any():
+            raise ValueError(f"synonyms of unknown names: {[s for s, c in zip(synonyms, codes) if c < 0]}")
+        self._synonyms = pd.Index(normalize_names(list(synonyms)))
+        self._synonym_codes = codes
+
+        #normalized names sorted for prefix search
+        self._sorted = np.argsort(self.normalized, kind='stable')
+        self._sorted_names = self.normalized[self._sorted]
+        self._lengths = np.char.str_len(self.normalized)
+
+        #binary names x trigrams matrix for fuzzy search
+        positions, trigrams = _trigrams(self.normalized)
+        trigram_codes, self._trigrams = pd.factorize(trigrams)
+        self._trigrams = pd.Index(self._trigrams)
+        self._trigram_matrix = scipy.sparse.csr_matrix((np.ones(len(positions), dtype=np.float32), (positions, trigram_codes)),
+                                                       shape=(len(self.names), len(self._trigrams)))
+        self._trigram_counts = np.bincount(positions, minlength=len(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def _kind_mask(self, kinds):
+        return np.ones(len(self.names), dtype=bool) if kinds is None else np.isin(self.kinds, list(kinds))
+
+    def _match_keys(self, keys, index, codes, allowed):
+        '''
+        codes of the allowed names matched by keys through index (a pandas.Index of keys of codes), -1 if none
+        '''
+        import pandas as pd
+
+        valid = allowed[codes] if len(codes) else np.zeros(0, dtype=bool)
+        table = pd.DataFrame({'key': np.asarray(index)[valid], 'code': codes[valid]}).drop_duplicates('key')
+        found = pd.Index(table['key']).get_indexer(keys)
+        return np.where(found >= 0, table['code'].values[found.clip(0)] if len(table) else -1, -1)
+
+    def _prefix(self, keys, allowed):
+        '''
+        code of the shortest allowed name starting with each (normalized) key, -1 if none
+        '''
+        lower = np.searchsorted(self._sorted_names, keys, side='left')
+        upper = np.searchsorted(self._sorted_names, np.char.add(keys, '\uffff'), side='left')
+        result = np.full(len(keys), -1, dtype=np.int64)
+        for i in np.flatnonzero((upper > lower) & (np.char.str_len(keys) > 0)):
+            candidates = self._sorted[lower[i]:upper[i]]
+            candidates = candidates[allowed[candidates]]
+            if len(candidates):
+                result[i] = candidates[np.argmin(self._lengths[candidates])]
+        return result
+
+    def _fuzzy(self, keys, allowed, n_matches, min_score, chunk_size=2000):
+        '''
+        best fuzzy matches of keys by cosine similarity of character trigrams
+        returns: (queries, codes, similarity) of up to n_matches matches per key with similarity >= min_score
+        '''
+        import scipy.sparse
+
+        positions, trigrams = _trigrams(keys)
+        query_counts = np.bincount(positions, minlength=len(keys))
+        trigram_codes = self._trigrams.get_indexer(trigrams)
+        known = trigram_codes >= 0
+        queries = scipy.sparse.csr_matrix((np.ones(known.sum(), dtype=np.float32), (positions[known], trigram_codes[known])),
+                                          shape=(len(keys), len(self._trigrams)))
+        candidates = self._trigram_matrix[np.flatnonzero(allowed)].T.tocsc()
+        allowed_codes = np.flatnonzero(allowed)
+        results = ([], [], [])
+        for start in range(0, len(keys), chunk_size):
+            shared = (queries[start:start + chunk_size] @ candidates).tocoo()
+            rows, cols = shared.row, shared.col
+            similarity = shared.data / np.sqrt(query_counts[start + rows] * self._trigram_counts[allowed_codes[cols]])
+            selected = similarity >= min_score
+            rows, cols, similarity = rows[selected], cols[selected], similarity[selected]
+            #keep the n_matches most similar names per query
+            order = np.lexsort((-similarity, rows))
+            rows, cols, similarity = rows[order], cols[order], similarity[order]
+            rank = np.arange(len(rows)) - np.searchsorted(rows, rows, side='left')
+            top = rank < n_matches
+            results[0].append(start + rows[top])
+            results[1].append(allowed_codes[cols[top]])
+            results[2].append(similarity[top])
+        return tuple(np.concatenate(x) if x else np.zeros(0) for x in results)
+
+    def resolve(self, labels, kinds=None, fuzzy=True, min_score=0.5, n_matches=1):
+        '''
+        resolve many labels at once, trying exact, synonym, normalized, prefix and fuzzy lookup in this order
+        labels: array-like, labels to resolve (duplicates are resolved once)
+        kinds: list, kinds of names to match (e.g. ['celltype']), None for all
+        fuzzy: bool, if False only exact, synonym, normalized and prefix lookups are used
+        min_score: float, minimum score of prefix and fuzzy matches
+        n_matches: int, maximum number of fuzzy matches per label, exact to prefix lookups return one match
+        returns: pandas.DataFrame, with label, match (NaN if unresolved), kind, method and score per match, labels
+        in input order
+        '''
+        import pandas as pd
+
+        label_codes, unique_labels = pd.factorize(pd.Series(np.asarray(labels, dtype=object)), use_na_sentinel=True)
+        unique_labels = np.asarray(unique_labels, dtype=object)
+        raw = np.array([str(x) for x in unique_labels], dtype=object)
+        keys = normalize_names(raw)
+        allowed = self._kind_mask(kinds)
+
+        codes = np.full(len(raw), -1, dtype=np.int64)
+        methods = np.full(len(raw), None, dtype=object)
+        scores = np.zeros(len(raw))
+        lookups = [
+            ('exact', lambda todo: self._match_keys(raw[todo], self.names, np.arange(len(self.names)), allowed)),
+            ('synonym', lambda todo: self._match_keys(keys[todo], self._synonyms, self._synonym_codes, allowed)),
+            ('normalized', lambda todo: self._match_keys(keys[todo], self.normalized, np.arange(len(self.names)), allowed)),
+        ]
+        for method, lookup in lookups:
+            todo = np.flatnonzero(codes < 0)
+            found = lookup(todo)
+            codes[todo], methods[todo[found >= 0]], scores[todo[found >= 0]] = found, method, METHOD_SCORES[method]
+
+        #prefix matches are scored by the fraction of the name covered by the label
+        todo = np.flatnonzero(codes < 0)
+        found = self._prefix(keys[todo], allowed)
+        coverage = np.where(found >= 0, np.char.str_len(keys[todo]) / np.maximum(self._lengths[found.clip(0)], 1), 0)
+        accepted = (found >= 0) & (coverage * METHOD_SCORES['prefix'] >= min_score)
+        codes[todo[accepted]], methods[todo[accepted]] = found[accepted], 'prefix'
+        scores[todo[accepted]] = coverage[accepted] * METHOD_SCORES['prefix']
+
+        rows = pd.DataFrame({'position': np.arange(len(raw)), 'code': codes, 'method': methods, 'score': scores})
+        rows = rows[rows.code >= 0]
+        todo = np.flatnonzero(codes < 0)
+        if fuzzy and len(todo) and allowed.any():
+            queries, matches, similarity = self._fuzzy(keys[todo], allowed, n_matches, min_score / METHOD_SCORES['fuzzy'])
+            rows = pd.concat([rows, pd.DataFrame({'position': todo[queries], 'code': matches, 'method': 'fuzzy',
+                                                  'score': similarity * METHOD_SCORES['fuzzy']})], ignore_index=True)
+
+        #broadcast the matches of unique labels to all labels, unresolved labels keep one empty row
+        unresolved = np.setdiff1d(np.arange(len(raw)), rows.position.values)
+        rows = pd.concat([rows, pd.DataFrame({'position': unresolved, 'code': -1, 'method': None, 'score': 0.0})], ignore_index=True)
+        rows = rows.sort_values(['position', 'score'], ascending=[True, False], kind='stable')
+        #missing labels (NaN) are never resolved
+        rows = pd.concat([rows, pd.DataFrame({'position': [-1], 'code': -1, 'method': None, 'score': 0.0})], ignore_index=True)
+        unique_labels = np.append(unique_labels, np.nan)
+        label_rows = pd.DataFrame({'label_position': np.arange(len(label_codes)), 'position': label_codes})
+        result = label_rows.merge(rows, on='position', how='inner').sort_values('label_position', kind='stable')
+        code = result.code.values
+        return pd.DataFrame({
+            'label': unique_labels[result.position.values],
+            'match': np.where(code >= 0, self.names[code.clip(0)], np.nan),
+            'kind': np.where(code >= 0, self.kinds[code.clip(0)], np.nan),
+            'method': result.method.values,
+            'score': result.score.values,
+        })
+
+    def lookup(self, label, kinds=None, n_matches=5, min_score=0.5):
+        '''
+        best matches of a single label, see resolve
+        returns: pandas.DataFrame, with match, kind, method and score, best first
+        '''
+        result = self.resolve([label], kinds=kinds, n_matches=n_matches, min_score=min_score)
+        return result.dropna(subset=['match']).drop(columns='label').reset_index(drop=True)
@@ -0,0 +1,260 @@
+"""Declarative queries over the KnowledgeBase index, planned by filter selectivity"""
+import warnings
+import numpy as np
+from .kb_index import csr_gather
+
+#relation of the queried cell types to the cell types whose gene sets are returned: (to children, to parents)
+RELATIONS = {'self': (False, False), 'descendants': (True, False), 'ancestors': (False, True), 'lineage': (True, True)}
+
+
+def _celltype_filter(index, celltypes, relation, depth):
+    '''
+    cell type codes selected by the cell type filter
+    '''
+    if relation not in RELATIONS:
+        raise ValueError(f"relation must be one of {list(RELATIONS)}")
+    missing = [x for x in celltypes if x not in index.codes or index.class_of(x) != 'cell_type']
+    if missing:
+        warnings.warn(f'cell types {missing} are not contained in the KnowledgeBase')
+    selected = [np.array([index.codes[x] for x in celltypes if x not in missing], dtype=np.int64)]
+    for celltype in set(celltypes) - set(missing):
+        for invert, use in zip([False, True], RELATIONS[relation]):
+            if use:
+                selected.append(index.traverse_hierarchy(celltype, invert=invert, depth=depth)[0])
+    return np.unique(np.concatenate(selected))
+
+
+def _gene_filter(index, genes, require_all):
+    '''
+    gene set codes containing any (or all) of genes
+    '''
+    indptr, gene_sets, _ = index.edge_adjacency(['gene_OF'], by='dst')
+    codes = np.unique(index.get_codes(genes))
+    codes = codes[codes >= 0]
+    _, hits = csr_gather(indptr, gene_sets, codes)
+    gene_sets, counts = np.unique(hits, return_counts=True)
+    return gene_sets[counts == len(codes)] if require_all else gene_sets
+
+
+def plan_query(index, celltypes=None, relation='self', depth=None, gene_set_class=None, genes_any=None, genes_all=None, metadata=None,
+               edge_class=['process_OF', 'identity_OF']):
+    '''
+    order the filters of a query by their estimated number of matching gene set attachments
+    see KnowledgeBase.query for the parameters
+    returns: list of dicts, with filter name, parameters and estimated matches in order of evaluation
+    '''
+    attachments, _, _ = index.edge_adjacency(edge_class, by='dst')
+    #every filter is estimated in attachments of the gene sets it selects (at most, for gene filters)
+    gene_set_attachments = np.diff(index.edge_adjacency(edge_class, by='src')[0])
+    gene_index, gene_sets, _ = index.edge_adjacency(['gene_OF'], by='dst')
+    plan = []
+    if celltypes is not None:
+        codes = _celltype_filter(index, celltypes, relation, depth)
+        plan.append({'filter': 'celltypes', 'codes': codes,
+                     'estimate': int((attachments[codes + 1] - attachments[codes]).sum())})
+    for name, genes in [('genes_any', genes_any), ('genes_all', genes_all)]:
+        if genes is not None:
+            codes = index.get_codes(genes)
+            codes = np.unique(codes[codes >= 0])
+            plan.append({'filter': name, 'genes': genes,
+                         'estimate': int(gene_set_attachments[csr_gather(gene_index, gene_sets, codes)[1]].sum())})
+    if gene_set_class is not None:
+        class_codes = [i for i, c in enumerate(index.classes) if c in gene_set_class]
+        plan.append({'filter': 'gene_set_class', 'class_codes': class_codes,
+                     'estimate': int(gene_set_attachments[np.isin(index.node_class, class_codes)].sum())})
+    for attribute, values in (metadata or {}).items():
+        values = values if isinstance(values, (list, tuple, set)) else [values]
+        postings = index.metadata_index(attribute)
+        codes = np.unique(np.concatenate([postings.get(v, np.array([], dtype=np.int64)) for v in values])) if values else np.array([], dtype=np.int64)
+        plan.append({'filter': 'metadata', 'attribute': attribute, 'codes': codes,
+                     'estimate': int(gene_set_attachments[codes].sum())})
+    return sorted(plan, key=lambda x: x['estimate'])
+
+
+def run_query(index, edge_class=['process_OF', 'identity_OF'], **filters):
+    '''
+    evaluate a query starting from its most selective filter, see KnowledgeBase.query
+    returns: pandas.DataFrame, one row per gene set attachment to a cell type
+    '''
+    import pandas as pd
+
+    plan = plan_query(index, edge_class=edge_class, **filters)
+    by_celltype = index.edge_adjacency(edge_class, by='dst')
+    by_gene_set = index.edge_adjacency(edge_class, by='src')
+
+    #candidate attachment edges from the most selective filter
+    if plan and plan[0]['filter'] == 'celltypes':
+        edges = csr_gather(by_celltype[0], by_celltype[2], plan[0]['codes'])[1]
+    else:
+        if plan:
+            gene_sets = _evaluate(index, plan[0])
+        else:
+            gene_sets = np.flatnonzero(by_gene_set[0][1:] > by_gene_set[0][:-1])
+        edges = csr_gather(by_gene_set[0], by_gene_set[2], gene_sets)[1]
+    gene_set, celltype = index.edge_src[edges], index.edge_dst[edges]
+
+    #apply the remaining filters to the candidates
+    matched = None
+    for step in plan[1:] if plan else []:
+        if step['filter'] == 'celltypes':
+            keep = np.isin(celltype, step['codes'])
+        elif step['filter'] == 'gene_set_class':
+            keep = np.isin(index.node_class[gene_set], step['class_codes'])
+        else:
+            keep = np.isin(gene_set, _evaluate(index, step, candidates=np.unique(gene_set)))
+        edges, gene_set, celltype = edges[keep], gene_set[keep], celltype[keep]
+
+    #gene counts of the resulting gene sets
+    gene_mask = index.node_class_mask(['gene'])
+    member_index = index.edge_adjacency(['gene_OF'], by='src')
+    unique_gene_sets, position = np.unique(gene_set, return_inverse=True)
+    rows, members = csr_gather(member_index[0], member_index[1], unique_gene_sets)
+    is_gene = gene_mask[members]
+    n_genes = np.bincount(rows[is_gene], minlength=len(unique_gene_sets))
+    result = pd.DataFrame({
+        'gene_set': [index.names[x] for x in gene_set],
+        'gene_set_class': [index.classes[x] for x in index.node_class[gene_set]],
+        'celltype': [index.names[x] for x in celltype],
+        'edge_class': [index.edge_classes[x] for x in index.edge_class[edges]],
+        'n_genes': n_genes[position],
+    })
+    query_genes = [g for key in ['genes_any', 'genes_all'] if filters.get(key) is not None for g in filters[key]]
+    if query_genes:
+        hits = is_gene & np.isin(members, index.get_codes(query_genes))
+        result['n_matched_genes'] = np.bincount(rows[hits], minlength=len(unique_gene_sets))[position]
+    result = result.sort_values(['celltype', 'gene_set'], ignore_index=True)
+    result.attrs['plan'] = [{'filter': x['filter'], 'estimate': x['estimate']} for x in plan]
+    return result
+
+
+def _evaluate(index, step, candidates=None):
+    '''
+    gene set codes matching one filter of a plan
+    candidates: numpy.ndarray, restrict the evaluation to these gene set codes
+    '''
+    if step['filter'] == 'metadata':
+        return step['codes']
+    if step['filter'] == 'gene_set_class':
+        codes = np.flatnonzero(np.isin(index.node_class, step['class_codes'])) if candidates is None else candidates
+        return codes[np.isin(index.node_class[codes], step['class_codes'])]
+    if candidates is not None:
+        #count hits within the members of the candidates only
+        member_index = index.edge_adjacency(['gene_OF'], by='src')
+        rows, members = csr_gather(member_index[0], member_index[1], candidates)
+        codes = np.unique(index.get_codes(step['genes']))
+        codes = codes[codes >= 0]
+        hits = np.bincount(rows[np.isin(members, codes)], minlength=len(candidates))
+        return candidates[hits == len(codes)] if step['filter'] == 'genes_all' else candidates[hits > 0]
+    return _gene_filter(index, step['genes'], require_all=step['filter'] == 'genes_all')
+
+
+def _first_pairs(rows, gene_sets, n_columns):
+    '''
+    first occurrence of every (row, gene set) pair, in order
+    '''
+    _, first = np.unique(rows.astype(np.int64) * n_columns + gene_sets, return_index=True)
+    first = np.sort(first)
+    return rows[first], gene_sets[first]
+
+
+def celltype_gene_sets(index, celltypes, global_celltypes=[None], get_parents=True, get_children=True, parent_depth=1,
+                       child_depth=None, fill_missing=True, parent_depth_dict=None, child_depth_dict=None, log=print):
+    '''
+    cellular processes of cell types merged with those of their children and parents, assembled on the integer
+    cell type x gene set incidence (see KnowledgeBase.get_celltype_processes for the parameters)
+    every gene set is listed under each cell type whose merged cell types it is attached to; gene sets attached to
+    global_celltypes are only listed under 'global'; gene sets are ordered by merged cell type (children before
+    parents, in breadth-first order) and attachment
+    log: callable, used to print status messages
+    returns: dict, {celltype: {gene set: [genes]}} with a 'global' key unless global_celltypes is [None]
+    '''
+    import pandas as pd
+
+    parent_depth_dict = {} if parent_depth_dict is None else parent_depth_dict
+    child_depth_dict = {} if child_depth_dict is None else child_depth_dict
+    celltype_mask = index.node_class_mask(['cell_type'])
+    empty = np.array([], dtype=np.int64)
+
+    def relatives(code, invert, depths, depth):
+        #the cell type and its children (or parents) up to depth, a depth of None in depths only keeps the cell type
+        name = index.names[code]
+        if name in depths:
+            depth = depths[name]
+            if depth is None:
+                return np.array([code])
+        return pd.unique(np.concatenate([[code], index.traverse_hierarchy(name, invert=invert, depth=depth)[0]]))
+
+    #member cell types of every key in merge order, children first
+    keys = list(dict.fromkeys(celltypes))
+    members, children, parents = [], [], []
+    for celltype in keys:
+        code = index.codes.get(celltype, -1)
+        own = np.array([code]) if code >= 0 else empty
+        key_children = key_parents = empty
+        if code >= 0 and celltype_mask[code]:
+            if get_children:
+                key_children = relatives(code, False, child_depth_dict, child_depth)
+            if get_parents:
+                key_parents = relatives(code, True, parent_depth_dict, parent_depth)
+        else:
+            if get_parents:
+                if fill_missing:
+                    log('adding empty dictionary for cell type:', celltype)
+                else:
+                    key_parents = own
+                    log('cell type of interest', celltype, 'is not in the knowledge base')
+            if get_children:
+                key_children = own
+                log('cell type of interest', celltype, 'is not in the knowledge base')
+        if not get_children and not get_parents:
+            key_children = own
+        children.append(key_children)
+        parents.append(key_parents)
+        members.append(np.concatenate([key_children, key_parents]))
+
+    #gene sets of the merged cell types: one sparse row per key
+    indptr, gene_sets, _ = index.edge_adjacency(['process_OF'], by='dst')
+    member_codes = np.concatenate(members).astype(np.int64) if members else empty
+    member_rows = np.repeat(np.arange(len(keys)), [len(x) for x in members])
+    positions, pair_gene_sets = csr_gather(indptr, gene_sets, member_codes)
+    pair_rows, pair_gene_sets = _first_pairs(member_rows[positions], pair_gene_sets, len(index))
+
+    use_global = global_celltypes != [None]
+    global_gene_sets = empty
+    if use_global:
+        global_codes = index.get_codes([x for x in dict.fromkeys(global_celltypes) if x is not None])
+        for celltype, code in zip([x for x in dict.fromkeys(global_celltypes) if x is not None], global_codes):
+            if code < 0 or indptr[code + 1] == indptr[code]:
+                log('did not find', celltype, 'in cell type keys to set as global')
+        global_codes = global_codes[global_codes >= 0]
+        global_gene_sets = pd.unique(csr_gather(indptr, gene_sets, global_codes)[1])
+        keep = ~np.isin(pair_gene_sets, global_gene_sets)
+        pair_rows, pair_gene_sets = pair_rows[keep], pair_gene_sets[keep]
+    else:
+        log('you must add a "global" key to run Spectra. E.g. set <global_celltypes> to one cell type key to be set as "global"')
+
+    #cell types shared between the children (or parents) of several keys
+    for name, relation, use in [('children', children, get_children), ('parents', parents, get_parents)]:
+        if use and relation:
+            codes, counts = np.unique(np.concatenate(relation), return_counts=True)
+            shared = [index.names[x] for x in codes[counts > 1]]
+            if shared:
+                log(f'cell types of interest share the following {name}:', shared, 'This may be desired.')
+
+    #genes of all selected gene sets
+    selected = np.unique(np.concatenate([pair_gene_sets, global_gene_sets])).astype(np.int64)
+    gene_indptr, genes, _ = index.edge_adjacency(['gene_OF'], by='src')
+    gene_positions, gene_codes = csr_gather(gene_indptr, genes, selected)
+    is_gene = index.node_class_mask(['gene'])[gene_codes]
+    splits = np.searchsorted(gene_positions[is_gene], np.arange(1, len(selected)))
+    names = index.names
+    gene_lists = {code: [names[x] for x in chunk.tolist()] for code, chunk in zip(selected.tolist(), np.split(gene_codes[is_gene], splits))}
+
+    process_dict = {}
+    row_splits = np.split(pair_gene_sets, np.searchsorted(pair_rows, np.arange(1, len(keys)))) if keys else []
+    for celltype, row in zip(keys, row_splits):
+        if len(row) or get_children or get_parents:
+            process_dict[celltype] = {names[x]: gene_lists[x] for x in row.tolist()}
+    if use_global:
+        process_dict['global'] = {names[x]: gene_lists[x] for x in global_gene_sets.tolist()}
+    return process_dict
@@ -4,6 +4,11 @@ import pickle
 import pkg_resources
 import networkx as nx
 import numpy as np
+from .kb_index import KBIndex
+from .kb_versions import DEFAULT_VERSION, diff_kb
+from .kb_planner import run_query, celltype_gene_sets
+from .kb_cache import get_cache, make_key
+from .kb_genesets import deep_sizeof
 
 
 def get_data(filename):
@@ -13,41 +18,31 @@ def get_data(filename):
     return pkg_resources.resource_filename('cytopus', 'data/' + filename)
 
 #nested dict with celltype hierarchy
-def extract_hierarchy(G, node='all-cells',invert=False):
+def extract_hierarchy(G, node='all-cells',invert=False, depth=None):
     '''
     extract cell type hierarchy from KnowledgeBase object as a nested dictionary
     G: cytopus.kb.KnowledgeBase, with a hierarchy of celltypes
     node: str, celltype to use as starting points in the hiearchy (e.g. 'all-cells')
     invert: bool, if False the dict will contain all children below the node, if True the dict will contain all parents above the node
+    depth: int, maximum number of levels below (or above) node to include, None for the full hierarchy
     '''
-    node_list_plot = G.celltypes
-
-    def filter_node(n1):
-        return n1 in node_list_plot
-
-    view = nx.subgraph_view(G.graph, filter_node=filter_node)
-    if invert:
-        predecessors = view.successors(node)
-    else:
-        predecessors = view.predecessors(node)
-    if not predecessors:
-        return node
-    else:
-        return {s: extract_hierarchy(G, s) for s in predecessors}
+    return G.index.nested_hierarchy(node, invert=invert, depth=depth)
 
 
 class KnowledgeBase:
-    def __init__(self, graph=None):
+    def __init__(self, graph=None, verbose=True):
         '''
         load KnowledgeBase from file
         retrieve all cell types in KnowledgeBase
         create dictionary for cellular processes in KnowledgeBase
         graph: str or networkx.DiGraph, path to pickled networkx.DiGraph object formatted for cytopus or networkx.DiGraph
+        verbose: bool, if False the KnowledgeBase does not print status messages
         '''
+        self.verbose = verbose
         
         # Initialise default graph data
         if graph is None:
-            graph = get_data("Cytopus_1.31nc_newcelltypes.txt")
+            graph = get_data(DEFAULT_VERSION)
         # load KnowledgeBase from pickled file
         if isinstance(graph, nx.classes.digraph.DiGraph):
             self.graph = graph
@@ -62,15 +57,42 @@ class KnowledgeBase:
         #create gene set : gene dict for all cellular processes
         processes = self.get_processes(gene_sets = list(set([x[0] for x in self.filter_edges(attribute_name = 'class', attributes = ['process_OF'],target=self.celltypes)])))
         processes = {k:[x for x in v if x not in ['nan',np.nan]] for k,v in processes.items()}
-        self.processes = processes 
+        self.processes = processes
         #self.processes = #self.filter_nodes(attribute_name = 'class',attributes= ['processes'],origin=None,target=None)
-        print(self)
+        if self.verbose:
+            print(self)
         #create gene set : gene dict for all cellular identities
         identities = self.get_identities(self.filter_nodes(attribute_name = 'class',attributes=['cell_type'],origin=None,target=None))
         identities = {k:[x for x in v if x not in ['nan',np.nan]] for k,v in identities.items()}
         self.identities = identities
         
     
+    @property
+    def index(self):
+        '''
+        integer-encoded index of self.graph (cytopus.knowledge_base.kb_index.KBIndex), built on first use and kept until
+        self.graph is replaced or invalidate() is called; call invalidate() after editing self.graph in place
+        '''
+        if getattr(self, '_index', None) is None or getattr(self, '_index_graph', None) is not self.graph:
+            self._index = KBIndex(self.graph)
+            self._index_graph = self.graph
+        return self._index
+
+    def invalidate(self):
+        '''
+        discard the index of self.graph and everything memoized on it, call after editing self.graph in place
+        (e.g. adding or removing nodes, edges or node attributes); results cached with cytopus.enable_cache are keyed
+        on the graph content and stay valid
+        '''
+        self._index = None
+
+    def _print(self, *args):
+        '''
+        print status messages unless the KnowledgeBase was created with verbose=False
+        '''
+        if getattr(self, 'verbose', True):
+            print(*args)
+
     def __str__(self):
         print(f"KnowledgeBase object containing {len(self.celltypes)} cell types and {len(self.processes)} cellular processes")
         return ""
@@ -125,12 +147,191 @@ class KnowledgeBase:
             edge_list = [x for x in edge_list if x[1] in target]
         return edge_list
     
-    def get_celltype_hierarchy(self, node='all-cells',invert=False):
-        #retrieve hierarchy
-        hierarchy_dict = extract_hierarchy(self, node=node,invert=invert)
+    def memory_usage(self):
+        '''
+        approximate memory used by the KnowledgeBase, objects shared between components are counted for the first one listed
+        returns: pandas.DataFrame, with bytes and megabytes per component ('graph', 'processes', 'identities',
+        'celltype_process_dict', 'index' with its memoized structures, 'other'), the index is only counted once it is built
+        '''
+        import pandas as pd
+
+        seen = set()
+        components = {
+            'graph': self.graph,
+            'processes': self.processes,
+            'identities': self.identities,
+            'celltype_process_dict': getattr(self, 'celltype_process_dict', None),
+            'index': getattr(self, '_index', None),
+        }
+        usage = {name: deep_sizeof(obj, seen) if obj is not None else 0 for name, obj in components.items()}
+        usage['other'] = deep_sizeof(self, seen)
+        usage = pd.DataFrame({'bytes': pd.Series(usage)})
+        usage.loc['total'] = usage['bytes'].sum()
+        usage['MB'] = usage['bytes'] / 2**20
+        return usage
+
+    def diff(self, other):
+        '''
+        structural diff between this KnowledgeBase and another version (see cytopus.knowledge_base.kb_versions.diff_kb)
+        other: cytopus.KnowledgeBase, networkx.DiGraph, path or version name (see cytopus.list_versions), the newer version
+        '''
+        return diff_kb(self, other)
+
+    def get_celltype_hierarchy(self, node='all-cells',invert=False, depth=None):
+        '''
+        retrieve the cell type hierarchy as a nested dictionary, the traversal is memoized on self.index (see invalidate),
+        the nested dictionary is rebuilt on each call
+        node: str, celltype to use as starting points in the hiearchy (e.g. 'all-cells')
+        invert: bool, if False the dict will contain all children below the node, if True the dict will contain all parents above the node
+        depth: int, maximum number of levels below (or above) node to include, None for the full hierarchy
+        '''
+        hierarchy_dict = extract_hierarchy(self, node=node,invert=invert, depth=depth)
         return hierarchy_dict
         
-    def get_processes(self,gene_sets): 
+    def query(self, celltypes=None, relation='self', depth=None, gene_set_class=None, edge_class=['process_OF','identity_OF'],
+              genes_any=None, genes_all=None, metadata=None):
+        '''
+        declarative query for gene sets attached to cell types, all filters are combined with AND
+        filters are evaluated starting with the most selective index, the plan is stored in result.attrs['plan']
+        celltypes: list, cell types to retrieve gene sets for, None for all cell types
+        relation: str, 'self', 'descendants' (children), 'ancestors' (parents) or 'lineage' (both) of celltypes to include
+        depth: int, maximum number of hierarchy steps for relation, None for no limit
+        gene_set_class: list, gene set classes to include (e.g. ['cellular_process'] or ['identity'])
+        edge_class: list, edge classes linking gene sets to cell types to include
+        genes_any: list, only include gene sets containing at least one of these genes
+        genes_all: list, only include gene sets containing all of these genes
+        metadata: dict, gene set attributes as keys and accepted values (list) as values (e.g. {'gene_set_topic':['metabolism']})
+        returns: pandas.DataFrame, with gene_set, gene_set_class, celltype, edge_class, n_genes (and n_matched_genes) per
+        gene set attachment
+        '''
+        return run_query(self.index, celltypes=celltypes, relation=relation, depth=depth, gene_set_class=gene_set_class,
+                         edge_class=edge_class, genes_any=genes_any, genes_all=genes_all, metadata=metadata)
+
+    def lowest_common_ancestor(self, celltypes_a, celltypes_b):
+        '''
+        lowest common ancestors of pairs of cell types in the cell type hierarchy
+        celltypes_a, celltypes_b: array-like, cell type names of equal length (unknown names are treated as missing)
+        returns: pandas.DataFrame, with the lowest common ancestor ('lca', NaN if missing) and number of hierarchy steps
+        between the cell types ('distance', -1 if missing)
+        '''
+        import pandas as pd
+        lca, distance = self.index.celltype_lca().lca_labels(celltypes_a, celltypes_b)
+        return pd.DataFrame({'lca': lca, 'distance': distance})
+
+    def slice(self, celltypes, depth=None, ancestors=True, verbose=False):
+        '''
+        self-contained KnowledgeBase restricted to some cell types, e.g. to ship to workers analyzing only these cells;
+        the slice is built from the index without copying the full graph and can be saved with .save
+        celltypes: list, cell types to slice the KnowledgeBase for
+        depth: int, maximum number of levels below celltypes to include, None for all descendants
+        ancestors: bool, if True include all ancestors of celltypes and their gene sets (e.g. for global_celltypes)
+        verbose: bool, if False the slice does not print status messages
+        returns: cytopus.KnowledgeBase, with the cell types, their descendants and ancestors, the cellular processes and
+        identities attached to them and the genes of these gene sets (node and edge attributes are copied)
+        '''
+        index = self.index
+        nodes, edges = index.slice_codes(celltypes, depth=depth, ancestors=ancestors)
+        graph = nx.DiGraph()
+        graph.add_nodes_from((index.names[i], dict(index.attributes[i])) for i in nodes.tolist())
+        adjacency = self.graph.adj
+        graph.add_edges_from((index.names[u], index.names[v], dict(adjacency[index.names[u]][index.names[v]]))
+                             for u, v in zip(index.edge_src[edges].tolist(), index.edge_dst[edges].tolist()))
+        return KnowledgeBase(graph, verbose=verbose)
+
+    def save(self, path):
+        '''
+        save the KnowledgeBase graph as a pickled networkx.DiGraph which can be loaded with cytopus.KnowledgeBase(path)
+        path: str, path to save the KnowledgeBase to
+        '''
+        with open(path, 'wb') as f:
+            pickle.dump(self.graph, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def get_gene_sets(self, genes):
+        '''
+        retrieve the gene sets (cellular processes and identities) containing each gene
+        genes: list of genes
+        returns: dict, {gene: [gene_set1, gene_set2,...]}, genes not in the KnowledgeBase map to empty lists
+        '''
+        index = self.index
+        indptr, gene_sets, _ = index.edge_adjacency(['gene_OF'], by='dst')
+        gene_set_dict = {}
+        for gene in genes:
+            code = index.codes.get(gene)
+            gene_set_dict[gene] = [] if code is None else [index.names[x] for x in gene_sets[indptr[code]:indptr[code + 1]]]
+        return gene_set_dict
+
+    def resolve_names(self, labels, kinds=None, fuzzy=True, min_score=0.5, n_matches=1):
+        '''
+        resolve many free-text labels (e.g. cell type annotations) to KnowledgeBase names in one pass, trying exact,
+        synonym, normalized (case and separator insensitive), prefix and fuzzy (character trigram) lookup in this order
+        labels: array-like, labels to resolve
+        kinds: list, kinds of names to match: 'celltype', 'gene_set' and/or 'gene', None for all
+        fuzzy: bool, if False only exact, synonym, normalized and prefix lookups are used
+        min_score: float, minimum score (0-1) of prefix and fuzzy matches
+        n_matches: int, maximum number of fuzzy matches per label
+        returns: pandas.DataFrame, with label, match (NaN if unresolved), kind, method and score per match
+        '''
+        return self.index.name_index().resolve(labels, kinds=kinds, fuzzy=fuzzy, min_score=min_score, n_matches=n_matches)
+
+    def add_synonyms(self, synonyms):
+        '''
+        add synonyms used by resolve_names, stored under the 'synonyms' attribute of the nodes in self.graph
+        synonyms: dict, {synonym: name in the KnowledgeBase}
+        '''
+        for synonym, name in synonyms.items():
+            if name not in self.graph:
+                raise ValueError(f"{name} is not contained in the KnowledgeBase")
+            values = self.graph.nodes[name].get('synonyms') or []
+            values = [values] if isinstance(values, str) else list(values)
+            if synonym not in values:
+                self.graph.nodes[name]['synonyms'] = values + [synonym]
+        self.invalidate()
+
+    def _suggest(self, labels, kinds):
+        '''
+        closest KnowledgeBase names of unknown labels for warnings, {label: name}
+        '''
+        matches = self.resolve_names(labels, kinds=kinds, min_score=0.6).dropna(subset=['match'])
+        return dict(zip(matches['label'], matches['match']))
+
+    def gene_set_matrix(self, var_names, gene_sets=None):
+        '''
+        genes x gene sets incidence matrix aligned to a dataset's var index (e.g. for Spectra), the alignment is memoized
+        per hash of the var index and the gene sets so repeated calls on the same dataset are free
+        var_names: array-like, gene names of the dataset (e.g. adata.var_names)
+        gene_sets: None for all gene sets in the KnowledgeBase, list of gene set names or dictionary of gene sets per cell type
+        as created by get_celltype_processes ({celltype: {gene set name: [genes]}}, e.g. self.celltype_process_dict)
+        returns: dict, with 'matrix' (scipy.sparse.csr_matrix of float32, var_names x gene sets), 'gene_sets'
+        (pandas.DataFrame with gene_set, celltype, gene_set_class, n_genes and n_genes_found per matrix column) and
+        'missing_genes' (sorted genes of the gene sets not contained in var_names), the matrix is shared between calls
+        and should not be modified in place
+        '''
+        import pandas as pd
+        from collections.abc import Mapping
+
+        index = self.index
+        if isinstance(gene_sets, Mapping):
+            celltypes, names, genes = [], [], []
+            for celltype, celltype_dict in gene_sets.items():
+                for name, gene_set in celltype_dict.items():
+                    celltypes.append(celltype)
+                    names.append(name)
+                    genes.append(gene_set)
+            matrix, n_genes, n_found, missing = index.gene_set_incidence(var_names, names, genes)
+        else:
+            if gene_sets is None:
+                gene_sets = [index.names[x] for x in np.unique(index.edge_src[index.edge_class_mask(['gene_OF'])])]
+            names = list(gene_sets)
+            matrix, n_genes, n_found, missing = index.gene_set_incidence(var_names, names)
+            #cell types the gene sets are attached to
+            indptr, attached, _ = index.edge_adjacency(['process_OF', 'identity_OF'], by='src')
+            celltypes = [','.join(index.names[x] for x in attached[indptr[c]:indptr[c + 1]]) or None for c in index.get_codes(names)]
+        classes = [index.class_of(x) if x in index.codes else None for x in names]
+        metadata = pd.DataFrame({'gene_set': names, 'celltype': celltypes, 'gene_set_class': classes,
+                                 'n_genes': n_genes, 'n_genes_found': n_found})
+        return {'matrix': matrix, 'gene_sets': metadata, 'missing_genes': list(missing)}
+
+    def get_processes(self,gene_sets):
         '''
         create dictionary gene sets for cellular processes : genes
         self: KnowledgeBase object (networkx)
@@ -148,7 +349,7 @@ class KnowledgeBase:
                 gene_set_dict[i[0]]= [i[1]]#
         return gene_set_dict
     
-    def get_celltype_processes(self,celltypes,global_celltypes=[None],get_parents =True, get_children =True, parent_depth=1, child_depth= None, fill_missing=True,parent_depth_dict=None, child_depth_dict=None, inplace=True):
+    def get_celltype_processes(self,celltypes,global_celltypes=[None],get_parents =True, get_children =True, parent_depth=1, child_depth= None, fill_missing=True,parent_depth_dict=None, child_depth_dict=None, inplace=True, cache=None):
         '''
         get gene sets for specific cell types
         self: KnowledgeBase object (networkx)
@@ -162,157 +363,57 @@ class KnowledgeBase:
         child_depth: steps from cell type to go down the hierarchie to retrieve gene sets linked to children (e.g. 2 would be down to grandchildren) 
         child_depth_dict: you can also set the depth for specific celltype with a dictionary {celltype1:depth1,celltype2:depth2}
         inplace: bool, if True save output under self.celltype_process_dict
+        cache: None to use the on-disk cache if enabled with cytopus.enable_cache, False to disable caching for this call
+        or a cytopus.knowledge_base.kb_cache.ResultCache
+        gene sets attached to several cell types are listed (as one shared list) under every cell type they are merged into, gene sets
+        attached to global_celltypes only under 'global'
         '''
-        import itertools
         import warnings
-        from collections import Counter
-
-        ## limit to celltype subgraph to retrieve relevant celltypes
 
-        node_list_plot = self.celltypes
+        celltype_set = set(self.celltypes)
+        missing_celltypes = [x for x in dict.fromkeys(celltypes + global_celltypes) if x is not None and x not in celltype_set]
+        if missing_celltypes:
+            warnings.warn(f"Not all cell types are contained in the Immune Knowledge base: {missing_celltypes}, "
+                          f"closest matches: {self._suggest(missing_celltypes, ['celltype'])}")
 
-        def filter_node(n1):
-            return n1 in node_list_plot
+        result_cache = get_cache(cache)
+        if result_cache is not None:
+            #results list gene sets in graph order, so the key includes the order of nodes and edges
+            cache_key = make_key('celltype_gene_sets', self.index.content_hash(ordered=True), list(celltypes),
+                                 sorted(set(global_celltypes), key=repr), get_parents, get_children, parent_depth,
+                                 child_depth, fill_missing, parent_depth_dict, child_depth_dict)
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                #status messages of the call which computed the result
+                for args in cached['messages']:
+                    self._print(*args)
+                #rebuild the nested dict with one list per gene set holding the graph's own gene name strings
+                names, codes = self.index.names, self.index.codes
+                gene_lists = {k: [names[codes[g]] if g in codes else g for g in v] for k, v in cached['gene_sets'].items()}
+                process_dict_merged = {key: {k: gene_lists[k] for k in value} for key, value in cached['celltypes'].items()}
+                if inplace:
+                    self.celltype_process_dict = process_dict_merged
+                    return
+                return process_dict_merged
 
-        view = nx.subgraph_view(self.graph, filter_node=filter_node)
+        #status messages are stored with cached results and printed again when they are loaded
+        messages = []
 
-        for x in list(set(celltypes+global_celltypes)):
-            if x not in list(view.nodes):
-                warnings.warn('Not all cell types are contained in the Immune Knowledge base')
-        if get_parents:
-            all_celltypes_parents = {}
-            if parent_depth_dict == None:
-                parent_depth_dict = {}
-
-            for i in celltypes:
-                if i in view.nodes:#is celltype in KnowledgeBase
-                    if i in parent_depth_dict.keys(): #check if query depth was manually defined
-                        if parent_depth_dict[i] == None:
-                            all_celltypes_parents[i]=  [i] 
-                        else:
-                            all_celltypes_parents[i]=  [n for n in nx.traversal.bfs_tree(view, i,depth_limit=parent_depth_dict[i])] 
-                    else:
-                        all_celltypes_parents[i]=  [n for n in nx.traversal.bfs_tree(view, i,depth_limit=parent_depth)] 
-                elif fill_missing: 
-                    all_celltypes_parents[i] = {} #if not add an empty dictionary
-                    print('adding empty dictionary for cell type:',i)
-                else:
-                    all_celltypes_parents[i]=  [i]
-                    print('cell type of interest',i,'is not in the knowledge base')
-        if get_children:
-            all_celltypes_children = {}
-            if child_depth_dict == None:
-                child_depth_dict = {}
-
-            for i in celltypes:
-                if i in view.nodes:
-                    if i in child_depth_dict.keys(): #check if query depth was manually defined
-                        if child_depth_dict[i] ==None:
-                            all_celltypes_children[i]=  [i]
-                        else:
-                            all_celltypes_children[i]=  [n for n in nx.traversal.bfs_tree(view, i,reverse=True,depth_limit=child_depth_dict[i])]
-                    else:
-                        all_celltypes_children[i]=  [n for n in nx.traversal.bfs_tree(view, i,reverse=True,depth_limit=child_depth)]
-                else:
-                    all_celltypes_children[i]=  [i]
-                    print('cell type of interest',i,'is not in the knowledge base')
-
-        if get_parents ==True and  get_children==True:
-            all_celltypes = list(itertools.chain.from_iterable(list(all_celltypes_children.values())+list(all_celltypes_parents.values())))
-        elif get_parents==True and  get_children==False:
-            all_celltypes = list(itertools.chain.from_iterable(list(all_celltypes_parents.values())))
-        elif get_parents == False and  get_children==True:
-            all_celltypes = list(itertools.chain.from_iterable(list(all_celltypes_children.values())))
-        else:
-            all_celltypes = []
-        all_celltypes = list(set(all_celltypes +  global_celltypes + celltypes))
-        
-        #get process genesets connected to these celltypes
-        gene_set_edges =self.filter_edges(attribute_name = 'class', attributes = ['process_OF'],target=all_celltypes)  
+        def log(*args):
+            messages.append(args)
+            self._print(*args)
 
-        #dictionary gene set  : cell type
-        gene_set_celltype_dict = dict(gene_set_edges)
-        #dictionary cell type: [gene_set1, gene_set2,...]
-        celltype_gene_set_dict = {}
+        #merge the gene sets of children and parents on the cell type x gene set incidence of the index
+        process_dict_merged = celltype_gene_sets(self.index, celltypes, global_celltypes=global_celltypes, get_parents=get_parents,
+                                                 get_children=get_children, parent_depth=parent_depth, child_depth=child_depth,
+                                                 fill_missing=fill_missing, parent_depth_dict=parent_depth_dict,
+                                                 child_depth_dict=child_depth_dict, log=log)
 
-        for key,value in gene_set_celltype_dict.items():
-            if value in celltype_gene_set_dict.keys():
-                celltype_gene_set_dict[value].append(key)
-            else:
-                celltype_gene_set_dict[value] = [key]
-        
-        #get dict gene sets for cellular processes : genes
-        gene_set_dict = self.get_processes(gene_sets = list(set([x[0] for x in gene_set_edges])))
-        
-        #construct dictionary
-        process_dict = {}
-
-        for key,value in celltype_gene_set_dict.items():
-            process_dict[key] = {}
-            for gene_set in value:
-                process_dict[key][gene_set] = gene_set_dict[gene_set]
-        if global_celltypes != [None]:
-            global_gs = {}
-            for i in global_celltypes:
-                if i in process_dict.keys():
-                    global_gs.update(process_dict[i])
-                    del process_dict[i]
-                else:
-                    print('did not find',i,'in cell type keys to set as global')
-            process_dict['global'] = global_gs
-
-        else:
-            print('you must add a "global" key to run Spectra. E.g. set <global_celltypes> to one cell type key to be set as "global"')
-
-        ## merge relevant children and parents into cell type specific keys
-
-        process_dict_merged = {}
-       
-        
-        if get_children:
-            for key,value in all_celltypes_children.items():
-                merged_dict = {}
-                for cell_type in value:
-                    if cell_type in process_dict.keys():
-                        merged_dict.update(process_dict[cell_type])
-                if key in process_dict_merged.keys():
-                    process_dict_merged[key].update(merged_dict) 
-                else:
-                    process_dict_merged[key]=merged_dict 
-
-        if get_parents:
-            for key,value in all_celltypes_parents.items():
-                merged_dict = {}
-                for cell_type in value:
-                    if cell_type in process_dict.keys():
-                        merged_dict.update(process_dict[cell_type])
-                if key in process_dict_merged.keys():
-                    process_dict_merged[key].update(merged_dict)
-                else:
-                    process_dict_merged[key]=merged_dict 
-                
-        if get_children==False and get_parents==False:
-            process_dict_merged =process_dict 
-                
-        if global_celltypes != [None]:
-            process_dict_merged['global'] = process_dict['global']
-            
-        ## check if cell types contain shared children or parents
-        if get_children:
-            shared_children = []
-            for key,value in Counter(list(itertools.chain.from_iterable(list(all_celltypes_children.values())))).items():
-                if value >1:
-                    shared_children.append(key)
-            if shared_children != []:
-
-                print('cell types of interest share the following children:',shared_children,'This may be desired.')
-        if get_parents:
-            shared_parents = []
-            for key,value in Counter(list(itertools.chain.from_iterable(list(all_celltypes_parents.values())))).items():
-                if value >1:
-                    shared_parents.append(key)
-            if shared_parents != []:
-                print('cell types of interest share the following parents:',shared_parents,'This may be desired.')
+        if result_cache is not None:
+            #store every gene set once as plain lists
+            result_cache.put(cache_key, {'gene_sets': {k: v for value in process_dict_merged.values() for k, v in value.items()},
+                                         'celltypes': {key: list(value) for key, value in process_dict_merged.items()},
+                                         'messages': messages})
         if inplace:
             self.celltype_process_dict = process_dict_merged
             #self.processes = gene_set_dict
@@ -357,7 +458,7 @@ class KnowledgeBase:
                 identity_gs = gene_set_dict[edge[0]]
                 identity_dict[edge[1]] = identity_gs
             else:
-                print(edge[1],'not contained in KnowledgeBase')
+                self._print(edge[1],'not contained in KnowledgeBase')
         return identity_dict
         
     def plot_celltypes(self, figure_size = [30,30], node_size = 1000, edge_width= 1, arrow_size=20, 
@@ -399,42 +500,162 @@ class KnowledgeBase:
         labels = nx.draw_networkx_labels(view,pos=pos,font_size=label_size)
         print('all celltypes in knowledge base:',list(labels.keys()))
         
-    def plot_graph_interactive(self, attributes=['cell_type','cellular_process'],colors= ['red','blue'], save_path = 'graph.html'):
+    def get_graph_json(self, attributes=['cell_type','cellular_process'], colors=['red','blue'], aggregate_genes=True):
+        '''
+        build the nodes and edges of a KnowledgeBase excerpt for interactive plotting
+        self: KnowledgeBase object (networkx)
+        attributes: list of node classes to include
+        colors: list of colors in the order of the node classes
+        aggregate_genes: bool, if True and 'gene' is in attributes genes are not added as nodes but stored per gene set
+        in 'chunks' so they can be expanded on demand
+        returns: dict, with 'classes' and 'colors', 'nodes' as [name, class index, number of aggregated genes],
+        'edges' as [origin, target] node positions, 'genes' as gene names and 'chunks' as {node position: [gene positions]}
+        '''
+        if len(attributes) != len(colors):
+            raise ValueError('attributes and colors have to be same length')
+        if len(set(attributes)) != len(attributes):
+            raise ValueError('attributes have to be unique')
+        index = self.index
+        aggregate_genes = aggregate_genes and 'gene' in attributes
+        node_classes = [x for x in attributes if not (aggregate_genes and x == 'gene')]
+
+        #select nodes and the edges between them
+        node_mask = index.node_class_mask(node_classes)
+        nodes = np.flatnonzero(node_mask)
+        position = np.full(len(index), -1, dtype=np.int64)
+        position[nodes] = np.arange(len(nodes))
+        edge_mask = node_mask[index.edge_src] & node_mask[index.edge_dst]
+        edges = np.stack([position[index.edge_src[edge_mask]], position[index.edge_dst[edge_mask]]], axis=1)
+
+        #aggregate genes into the selected nodes pointing to them
+        genes = np.array([], dtype=np.int64)
+        chunks = {}
+        n_genes = np.zeros(len(nodes), dtype=np.int64)
+        if aggregate_genes:
+            gene_mask = index.node_class_mask(['gene'])
+            gene_edge_mask = node_mask[index.edge_src] & gene_mask[index.edge_dst]
+            origins = position[index.edge_src[gene_edge_mask]]
+            genes, targets = np.unique(index.edge_dst[gene_edge_mask], return_inverse=True)
+            order = np.argsort(origins, kind='stable')
+            origins, targets = origins[order], targets[order]
+            n_genes = np.bincount(origins, minlength=len(nodes))
+            bounds = np.cumsum(n_genes)
+            for i in np.flatnonzero(n_genes):
+                chunks[int(i)] = targets[bounds[i] - n_genes[i]:bounds[i]].tolist()
+
+        class_position = {c: i for i, c in enumerate(attributes)}
+        return {
+            'classes': list(attributes),
+            'colors': list(colors),
+            'nodes': [[index.names[n], class_position[index.classes[index.node_class[n]]], int(k)] for n, k in zip(nodes, n_genes)],
+            'edges': edges.tolist(),
+            'genes': [index.names[n] for n in genes],
+            'chunks': chunks,
+        }
+
+    def plot_graph_interactive(self, attributes=['cell_type','cellular_process'],colors= ['red','blue'], save_path = 'graph.html', aggregate_genes=True, height='750px', backend='vis', vis_js=None):
         '''
-        plot excerpt from the KnowledgeBase using the pyvis package
+        plot excerpt from the KnowledgeBase as an interactive .html file
         self: KnowledgeBase object (networkx)
         attributes: list of node classes to plot
         colors: list of colors in the order of the node classes to plot
         save_path: save path for .html file
+        aggregate_genes: bool, if True genes are collapsed into their gene sets and shown on double click of a gene set
+        (only for backend 'vis')
+        height: str, height of the plot
+        backend: str, 'vis' to write the plot with vis-network (version pinned in _VIS_NETWORK_URL) or 'pyvis' to plot with the
+        pyvis package
+        vis_js: str, path to a local vis-network.min.js which is inlined into the .html file (e.g. for offline use),
+        if None the script is loaded from _VIS_NETWORK_URL (only for backend 'vis')
+        returns: IPython.display.IFrame showing the plot if IPython is installed
+        '''
+        import json
+
+        if backend == 'pyvis':
+            self._plot_graph_pyvis(attributes=attributes, colors=colors, save_path=save_path, height=height)
+        elif backend == 'vis':
+            graph_json = self.get_graph_json(attributes=attributes, colors=colors, aggregate_genes=aggregate_genes)
+            if vis_js is None:
+                script = '<script src="' + _VIS_NETWORK_URL + '"></script>'
+            else:
+                with open(vis_js) as f:
+                    script = '<script>' + f.read().replace('</script', '<\\/script') + '</script>'
+            html = _GRAPH_HTML.replace('__HEIGHT__', height).replace('__DATA__', json.dumps(graph_json, separators=(',', ':')))
+            with open(save_path, 'w') as f:
+                f.write(html.replace('__SCRIPT__', script))
+        else:
+            raise ValueError("backend has to be 'vis' or 'pyvis'")
+        try:
+            from IPython.display import IFrame
+        except ModuleNotFoundError:
+            return None
+        return IFrame(save_path, width='100%', height=height)
+
+    def _plot_graph_pyvis(self, attributes, colors, save_path, height):
+        '''
+        write plot excerpt from the KnowledgeBase as .html file using the pyvis package
+        self: KnowledgeBase object (networkx)
+        attributes: list of node classes to plot
+        colors: list of colors in the order of the node classes to plot
+        save_path: save path for .html file
+        height: str, height of the plot
         '''
-        
         try:
             from pyvis.network import Network
         except ModuleNotFoundError:
-            print('please install pyvis')
-            pass          
-        
-        while len(attributes)!=len(colors):
-            print('attributes and colors have to be same length')
-            break
-        while len(set(attributes))!=len(attributes):
-            print('attributes have to be unique')
-            break
-            
-        net = Network(notebook=True)
-        #cell types
-        node_list_plot = self.filter_nodes(attribute_name='class', attributes = attributes)
-        def filter_node(n1):
-                return n1 in node_list_plot
-        view = nx.subgraph_view(self.graph,filter_node=filter_node)
-        net.from_nx(view)
-
-        for i in net.nodes:
-            index_range = list(range(len(attributes)))
-            for v in index_range:
-                             if i['class'] == attributes[v]:
-                               i['color']= colors[v]
-               
-        #show
-        net.show(save_path)
-         
+            raise ModuleNotFoundError('please install pyvis or use backend="vis"')
+
+        graph_json = self.get_graph_json(attributes=attributes, colors=colors, aggregate_genes=False)
+        net = Network(notebook=True, height=height, directed=True, cdn_resources='in_line')
+        for name, c, _ in graph_json['nodes']:
+            net.add_node(name, label=name, title=attributes[c], color=colors[c])
+        names = [n[0] for n in graph_json['nodes']]
+        for origin, target in graph_json['edges']:
+            net.add_edge(names[origin], names[target])
+        net.write_html(save_path, notebook=True)
+
+
+#vis-network release loaded by KnowledgeBase.plot_graph_interactive if no local script is passed
+_VIS_NETWORK_URL = 'https://unpkg.com/vis-network@9.1.9/standalone/umd/vis-network.min.js'
+
+#template for KnowledgeBase.plot_graph_interactive, genes of gene sets are added and removed on double click
+_GRAPH_HTML = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+__SCRIPT__
+</head>
+<body>
+<div id="graph" style="width: 100%; height: __HEIGHT__; border: 1px solid lightgray;"></div>
+<script>
+var data = __DATA__;
+var geneColor = data.colors[data.classes.indexOf('gene')] || 'gray';
+var nodes = new vis.DataSet(data.nodes.map(function (n, i) {
+  var label = n[2] > 0 ? n[0] + ' (' + n[2] + ' genes)' : n[0];
+  return {id: i, label: label, title: data.classes[n[1]], color: data.colors[n[1]]};
+}));
+var edges = new vis.DataSet(data.edges.map(function (e) { return {from: e[0], to: e[1]}; }));
+var network = new vis.Network(document.getElementById('graph'), {nodes: nodes, edges: edges},
+  {edges: {arrows: 'to'}, physics: {stabilization: {iterations: 100}}});
+var expanded = {};
+network.on('doubleClick', function (params) {
+  if (params.nodes.length === 0 || !(params.nodes[0] in data.chunks)) { return; }
+  var node = params.nodes[0];
+  var chunk = data.chunks[node];
+  if (expanded[node]) {
+    edges.remove(chunk.map(function (g) { return node + '-g' + g; }));
+    var orphans = chunk.filter(function (g) { return network.getConnectedEdges('g' + g).length === 0; });
+    nodes.remove(orphans.map(function (g) { return 'g' + g; }));
+    delete expanded[node];
+    return;
+  }
+  nodes.update(chunk.filter(function (g) { return nodes.get('g' + g) === null; }).map(function (g) {
+    return {id: 'g' + g, label: data.genes[g], title: 'gene', color: geneColor};
+  }));
+  edges.update(chunk.map(function (g) { return {id: node + '-g' + g, from: node, to: 'g' + g}; }));
+  expanded[node] = true;
+});
+</script>
+</body>
+</html>
+'''
@@ -0,0 +1,275 @@
+"""Local HTTP/JSON server and client for a shared, read-only KnowledgeBase"""
+import json
+from collections.abc import Mapping
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import networkx as nx
+
+
+class KBSnapshot:
+    #methods which can be called over HTTP
+    METHODS = ('get_celltype_processes', 'get_identities', 'get_processes', 'get_gene_sets', 'get_celltype_hierarchy',
+               'query', 'lowest_common_ancestor', 'label_marker_genes')
+
+    def __init__(self, kb=None):
+        '''
+        frozen, print-free KnowledgeBase whose query methods can be called from concurrent threads
+        kb: cytopus.KnowledgeBase (the snapshot freezes a copy of its graph and gene sets, kb itself stays editable and
+        later edits are not served), path, version name (see cytopus.list_versions) or None for the default KnowledgeBase
+        '''
+        import copy
+        import os
+        from .kb_queries import KnowledgeBase
+        from .kb_versions import get_version_path
+
+        if isinstance(kb, KnowledgeBase):
+            snapshot = copy.copy(kb)
+            snapshot.graph = kb.graph.copy()
+            snapshot.celltypes = list(kb.celltypes)
+            snapshot.processes = {k: list(v) for k, v in kb.processes.items()}
+            snapshot.identities = {k: list(v) for k, v in kb.identities.items()}
+            snapshot._index = None
+            kb = snapshot
+        else:
+            path = kb if kb is not None and os.path.isfile(kb) else get_version_path(kb)
+            kb = KnowledgeBase(path, verbose=False)
+        kb.verbose = False
+        nx.freeze(kb.graph)
+        self.kb = kb
+
+        #build all memoized structures up front so readers only look them up
+        index = kb.index
+        index.content_hash()
+        index.celltype_adjacency(invert=False)
+        index.celltype_adjacency(invert=True)
+        for by in ['src', 'dst']:
+            index.edge_adjacency(['gene_OF'], by=by)
+            index.edge_adjacency(['process_OF', 'identity_OF'], by=by)
+        try:
+            index.celltype_lca()
+        except ValueError:
+            pass
+
+    def get_celltype_processes(self, celltypes, **kwargs):
+        kwargs['inplace'] = False
+        return self.kb.get_celltype_processes(celltypes, **kwargs)
+
+    def get_identities(self, celltypes_identities, include_subsets=False):
+        return self.kb.get_identities(celltypes_identities, include_subsets=include_subsets)
+
+    def get_processes(self, gene_sets):
+        return self.kb.get_processes(gene_sets)
+
+    def get_gene_sets(self, genes):
+        return self.kb.get_gene_sets(genes)
+
+    def get_celltype_hierarchy(self, node='all-cells', invert=False, depth=None):
+        return self.kb.get_celltype_hierarchy(node=node, invert=invert, depth=depth)
+
+    def query(self, **filters):
+        return self.kb.query(**filters)
+
+    def lowest_common_ancestor(self, celltypes_a, celltypes_b):
+        return self.kb.lowest_common_ancestor(celltypes_a, celltypes_b)
+
+    def label_marker_genes(self, marker_genes, gs_label_dict=None, threshold=0.4):
+        '''
+        label marker genes against gs_label_dict, or against all cellular processes if gs_label_dict is None
+        '''
+        from ..tl.label import label_marker_genes
+        return label_marker_genes(marker_genes, gs_label_dict if gs_label_dict is not None else self.kb.processes, threshold=threshold)
+
+    def call(self, method, params):
+        '''
+        call one of METHODS with a dict of keyword arguments
+        '''
+        if method not in self.METHODS:
+            raise ValueError(f"unknown method {method}, available methods: {list(self.METHODS)}")
+        return getattr(self, method)(**params)
+
+
+def _encode(obj):
+    '''
+    json default for objects returned by KBSnapshot methods
+    '''
+    import pandas as pd
+
+    if isinstance(obj, pd.DataFrame):
+        return {'__dataframe__': json.loads(obj.to_json(orient='split'))}
+    if isinstance(obj, (pd.Series, pd.Index, pd.Categorical)):
+        return _encode(np.asarray(obj, dtype=object))
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _decode(obj):
+    '''
+    json object_hook restoring DataFrames encoded by _encode
+    '''
+    if '__dataframe__' in obj:
+        import pandas as pd
+        split = obj['__dataframe__']
+        return pd.DataFrame(split['data'], index=split['index'], columns=split['columns'])
+    return obj
+
+
+class _Handler(BaseHTTPRequestHandler):
+    snapshot = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, payload):
+        body = json.dumps(payload, default=_encode).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _call(self, method, params):
+        try:
+            return {'result': self.snapshot.call(method, params or {})}
+        except Exception as e:
+            return {'error': f"{type(e).__name__}: {e}"}
+
+    def do_GET(self):
+        if self.path.rstrip('/') in ('', '/health'):
+            kb = self.snapshot.kb
+            self._respond(200, {'status': 'ok', 'celltypes': len(kb.celltypes), 'processes': len(kb.processes),
+                                'content_hash': kb.index.content_hash(), 'methods': list(self.snapshot.METHODS)})
+        else:
+            self._respond(404, {'error': f"unknown path {self.path}"})
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except json.JSONDecodeError as e:
+            self._respond(400, {'error': f"invalid JSON: {e}"})
+            return
+        path = self.path.strip('/')
+        if path == 'batch':
+            #several calls in one request: [{'method': ..., 'params': {...}}, ...]
+            self._respond(200, [self._call(x.get('method'), x.get('params')) for x in request])
+        else:
+            response = self._call(path, request)
+            self._respond(200 if 'result' in response else 400, response)
+
+
+class _Server(ThreadingHTTPServer):
+    #listen backlog large enough for many concurrent clients
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def make_server(kb=None, host='127.0.0.1', port=8765):
+    '''
+    create (but do not start) a threaded HTTP server answering KnowledgeBase queries
+    kb: cytopus.KnowledgeBase, path, version name or None for the default KnowledgeBase
+    host: str, interface to listen on
+    port: int, port to listen on (0 to pick a free port)
+    returns: http.server.ThreadingHTTPServer, start it with serve_forever()
+    '''
+    handler = type('KBHandler', (_Handler,), {'snapshot': KBSnapshot(kb)})
+    return _Server((host, port), handler)
+
+
+def serve(kb=None, host='127.0.0.1', port=8765):
+    '''
+    load a KnowledgeBase once and answer queries over HTTP/JSON until interrupted
+    POST /<method> with the keyword arguments as JSON object, POST /batch with a list of {'method':..., 'params':...},
+    GET /health for status, see KBSnapshot.METHODS for the available methods
+    kb: cytopus.KnowledgeBase, path, version name or None for the default KnowledgeBase
+    host: str, interface to listen on
+    port: int, port to listen on
+    '''
+    server = make_server(kb, host=host, port=port)
+    print(f"serving KnowledgeBase on http://{server.server_address[0]}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class KnowledgeBaseClient:
+    def __init__(self, url='http://127.0.0.1:8765', timeout=60):
+        '''
+        client for a KnowledgeBase served with `cytopus serve`, methods mirror cytopus.KnowledgeBase
+        url: str, server address
+        timeout: float, request timeout in seconds
+        '''
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, path, payload=None):
+        import urllib.request
+        import urllib.error
+
+        data = None if payload is None else json.dumps(payload, default=_encode).encode('utf-8')
+        request = urllib.request.Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read(), object_hook=_decode)
+        except urllib.error.HTTPError as e:
+            return json.loads(e.read(), object_hook=_decode)
+
+    def _call(self, method, **params):
+        response = self._request('/' + method, params)
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response['result']
+
+    def health(self):
+        '''
+        status of the server and the served KnowledgeBase
+        '''
+        return self._request('/health')
+
+    def batch(self, calls):
+        '''
+        run several calls in one request
+        calls: list of (method, params) tuples, e.g. [('get_identities', {'celltypes_identities': ['T']})]
+        returns: list of results, failed calls are returned as RuntimeError instances
+        '''
+        responses = self._request('/batch', [{'method': m, 'params': p} for m, p in calls])
+        return [x['result'] if 'result' in x else RuntimeError(x['error']) for x in responses]
+
+    def get_celltype_processes(self, celltypes, global_celltypes=[None], get_parents=True, get_children=True, parent_depth=1,
+                               child_depth=None, fill_missing=True, parent_depth_dict=None, child_depth_dict=None):
+        return self._call('get_celltype_processes', celltypes=celltypes, global_celltypes=global_celltypes,
+                          get_parents=get_parents, get_children=get_children, parent_depth=parent_depth,
+                          child_depth=child_depth, fill_missing=fill_missing, parent_depth_dict=parent_depth_dict,
+                          child_depth_dict=child_depth_dict)
+
+    def get_identities(self, celltypes_identities, include_subsets=False):
+        return self._call('get_identities', celltypes_identities=celltypes_identities, include_subsets=include_subsets)
+
+    def get_processes(self, gene_sets):
+        return self._call('get_processes', gene_sets=gene_sets)
+
+    def get_gene_sets(self, genes):
+        return self._call('get_gene_sets', genes=genes)
+
+    def get_celltype_hierarchy(self, node='all-cells', invert=False, depth=None):
+        return self._call('get_celltype_hierarchy', node=node, invert=invert, depth=depth)
+
+    def query(self, celltypes=None, relation='self', depth=None, gene_set_class=None, edge_class=['process_OF','identity_OF'],
+              genes_any=None, genes_all=None, metadata=None):
+        return self._call('query', celltypes=celltypes, relation=relation, depth=depth, gene_set_class=gene_set_class,
+                          edge_class=edge_class, genes_any=genes_any, genes_all=genes_all, metadata=metadata)
+
+    def lowest_common_ancestor(self, celltypes_a, celltypes_b):
+        return self._call('lowest_common_ancestor', celltypes_a=list(celltypes_a), celltypes_b=list(celltypes_b))
+
+    def label_marker_genes(self, marker_genes, gs_label_dict=None, threshold=0.4):
+        return self._call('label_marker_genes', marker_genes=np.asarray(marker_genes, dtype=object),
+                          gs_label_dict=gs_label_dict, threshold=threshold)
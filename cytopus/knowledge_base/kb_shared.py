@@ -0,0 +1,321 @@
+"""Read-only KnowledgeBase published once into shared memory and attached by worker processes without copying"""
+import json
+import pickle
+import sys
+import threading
+import warnings
+from collections.abc import Mapping
+import numpy as np
+from .kb_index import KBIndex, decode_strings, encode_strings, csr_gather
+
+#edge adjacencies published with the KnowledgeBase, others are built by the workers when needed
+SHARED_EDGE_ADJACENCIES = [(['gene_OF'], 'src'), (['gene_OF'], 'dst'), (['process_OF', 'identity_OF'], 'src'),
+                           (['process_OF', 'identity_OF'], 'dst'), (['process_OF'], 'dst'), (['identity_OF'], 'dst')]
+#alignment of the arrays in the shared memory block
+_ALIGNMENT = 64
+#names of the shared memory blocks published by this process, registered with the resource tracker by publish_kb
+_published = set()
+
+
+class SharedKBIndex(KBIndex):
+    def __init__(self, header, arrays):
+        '''
+        KBIndex over arrays in shared memory, only the node names are decoded, node attributes are unpickled when
+        first needed (e.g. by metadata queries or name resolution)
+        header: dict, layout of the shared memory block written by publish_kb
+        arrays: dict, {array name: read-only numpy.ndarray view into the shared memory block}
+        '''
+        self.names = decode_strings(arrays['names'], arrays['name_offsets'])
+        self.codes = {n: i for i, n in enumerate(self.names)}
+        self.edge_src, self.edge_dst, self.edge_class = arrays['edge_src'], arrays['edge_dst'], arrays['edge_class']
+        self.edge_classes = header['edge_classes']
+        self.node_class = arrays['node_class']
+        self.child_order = arrays['child_order']
+        self.classes = header['classes']
+        self._attributes = arrays['attributes']
+        self._attribute_list = None
+
+        self._adjacency = {invert: (arrays[f'celltype_adjacency_{invert}_indptr'], arrays[f'celltype_adjacency_{invert}_indices'])
+                           for invert in [False, True]}
+        self._traversals = {}
+        self._edge_adjacency = {}
+        for edge_classes, by in SHARED_EDGE_ADJACENCIES:
+            key = '_'.join(sorted(edge_classes) + [by])
+            self._edge_adjacency[(tuple(sorted(edge_classes)), by)] = tuple(arrays[f'edge_adjacency_{key}_{x}'] for x in ['indptr', 'neighbors', 'edges'])
+        self._metadata = {}
+        self._incidence = {}
+        self._name_index = None
+        self._content_hash = {False: header['content_hash']}
+        self._lock = threading.RLock()
+
+    @property
+    def attributes(self):
+        if self._attribute_list is None:
+            with self._lock:
+                if self._attribute_list is None:
+                    self._attribute_list = pickle.loads(self._attributes)
+        return self._attribute_list
+
+
+class SharedGeneSets(Mapping):
+    def __init__(self, index, keys, gene_sets):
+        '''
+        read-only dictionary {key: [genes]} decoding the genes of gene sets from the shared KnowledgeBase on access
+        index: cytopus.knowledge_base.kb_shared.SharedKBIndex
+        keys: list, dictionary keys (gene set or cell type names)
+        gene_sets: numpy.ndarray, node code of the gene set of each key
+        '''
+        self.index = index
+        self._positions = {k: i for i, k in enumerate(keys)}
+        self._keys = list(keys)
+        self._gene_sets = gene_sets
+        self._gene_mask = index.node_class_mask(['gene'])
+
+    def __getitem__(self, key):
+        gene_set = self._gene_sets[self._positions[key]]
+        indptr, neighbors, _ = self.index.edge_adjacency(['gene_OF'], by='src')
+        genes = neighbors[indptr[gene_set]:indptr[gene_set + 1]]
+        names = self.index.names
+        return [names[x] for x in genes[self._gene_mask[genes]].tolist() if names[x] != 'nan']
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def __repr__(self):
+        return f"SharedGeneSets with {len(self)} gene sets"
+
+    def to_dict(self):
+        return {k: self[k] for k in self._keys}
+
+
+def _views(shm):
+    '''
+    header and read-only array views of a shared memory block written by publish_kb
+    '''
+    buffer = shm.buf
+    n_header = int(np.frombuffer(buffer, dtype=np.uint64, count=1)[0])
+    header = json.loads(bytes(buffer[8:8 + n_header]).decode('utf-8'))
+    arrays = {}
+    for name, (offset, dtype, shape) in header['arrays'].items():
+        array = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+        array.setflags(write=False)
+        arrays[name] = array
+    return header, arrays
+
+
+def publish_kb(kb=None, name=None):
+    '''
+    publish the core arrays of a KnowledgeBase (string table, node and edge tables, CSR hierarchy and gene set
+    memberships and node attributes) into one block of shared memory which workers can attach to with attach_kb
+    kb: cytopus.KnowledgeBase, path, version name (see cytopus.list_versions) or None for the default KnowledgeBase
+    name: str, name of the shared memory block, None for a random name
+    returns: cytopus.knowledge_base.kb_shared.SharedKnowledgeBase, owning the block; pass it (or its .name) to the
+    workers, call .unlink() (or use it as a context manager) to free the block once all workers are done
+    '''
+    from multiprocessing import shared_memory
+    from .kb_queries import KnowledgeBase
+    from .kb_versions import get_version_path
+    import os
+
+    if not isinstance(kb, KnowledgeBase):
+        path = kb if kb is not None and os.path.isfile(kb) else get_version_path(kb)
+        kb = KnowledgeBase(path, verbose=False)
+    index = kb.index
+    names, name_offsets = encode_strings([str(x) for x in index.names])
+    arrays = {
+        'names': names,
+        'name_offsets': name_offsets,
+        'node_class': index.node_class,
+        'edge_src': index.edge_src,
+        'edge_dst': index.edge_dst,
+        'edge_class': index.edge_class,
+        'child_order': index.child_order,
+        'attributes': np.frombuffer(pickle.dumps(index.attributes, protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8),
+    }
+    for invert in [False, True]:
+        arrays[f'celltype_adjacency_{invert}_indptr'], arrays[f'celltype_adjacency_{invert}_indices'] = index.celltype_adjacency(invert=invert)
+    for edge_classes, by in SHARED_EDGE_ADJACENCIES:
+        key = '_'.join(sorted(edge_classes) + [by])
+        for x, array in zip(['indptr', 'neighbors', 'edges'], index.edge_adjacency(edge_classes, by=by)):
+            arrays[f'edge_adjacency_{key}_{x}'] = array
+
+    #layout: header length (uint64), json header, aligned arrays
+    layout = {}
+    header = {'classes': index.classes, 'edge_classes': index.edge_classes, 'content_hash': index.content_hash(), 'arrays': layout}
+    n_header = 2**12
+    while True:
+        offset = -(-(8 + n_header) // _ALIGNMENT) * _ALIGNMENT
+        for key, array in arrays.items():
+            layout[key] = (offset, array.dtype.str, list(array.shape))
+            offset += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+        encoded = json.dumps(header).encode('utf-8')
+        if len(encoded) <= n_header:
+            break
+        n_header = 2 * len(encoded)
+
+    shm = shared_memory.SharedMemory(name=name, create=True, size=max(offset, 1))
+    _published.add(shm._name)
+    buffer = shm.buf
+    buffer[:8] = np.array([len(encoded)], dtype=np.uint64).tobytes()
+    buffer[8:8 + len(encoded)] = encoded
+    for key, array in arrays.items():
+        start = layout[key][0]
+        np.ndarray(array.shape, dtype=array.dtype, buffer=buffer, offset=start)[...] = array
+    return SharedKnowledgeBase(shm, owner=True)
+
+
+def attach_kb(name):
+    '''
+    attach to a KnowledgeBase published with publish_kb, the arrays are used in place without copying
+    name: str, name of the shared memory block (SharedKnowledgeBase.name)
+    returns: cytopus.knowledge_base.kb_shared.SharedKnowledgeBase
+    '''
+    from multiprocessing import shared_memory
+
+    if sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        #the block is owned by the publishing process, drop the registration of this attachment so the resource
+        #tracker does not unlink the block when this process exits
+        if shm._name not in _published:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+    return SharedKnowledgeBase(shm, owner=False)
+
+
+class SharedKnowledgeBase:
+    def __init__(self, shm, owner=False):
+        '''
+        read-only KnowledgeBase-compatible query object over a KnowledgeBase published with publish_kb, use
+        publish_kb and attach_kb to create it; pickling only transfers the name of the shared memory block
+        shm: multiprocessing.shared_memory.SharedMemory, block written by publish_kb
+        owner: bool, if True .unlink() frees the block (the publishing process)
+        '''
+        from .kb_queries import KnowledgeBase
+
+        self._shm = shm
+        self.owner = owner
+        self.name = shm.name
+        self.verbose = False
+        header, arrays = _views(shm)
+        self.index = SharedKBIndex(header, arrays)
+
+        index = self.index
+        self.celltypes = [index.names[x] for x in np.flatnonzero(index.node_class_mask(['cell_type']))]
+        celltype_mask = index.node_class_mask(['cell_type'])
+        #cellular processes attached to cell types
+        indptr, celltypes, _ = index.edge_adjacency(['process_OF'], by='dst')
+        gene_sets = np.unique(csr_gather(indptr, celltypes, np.flatnonzero(celltype_mask))[1])
+        self.processes = SharedGeneSets(index, [index.names[x] for x in gene_sets], gene_sets)
+        #identity of each cell type, the last identity edge of a cell type wins as in KnowledgeBase.get_identities
+        edges = np.flatnonzero(index.edge_class_mask(['identity_OF']) & celltype_mask[index.edge_dst])
+        celltypes, last = np.unique(index.edge_dst[edges][::-1], return_index=True)
+        self.identities = SharedGeneSets(index, [index.names[x] for x in celltypes], index.edge_src[edges][::-1][last])
+        self._kb_class = KnowledgeBase
+
+    def __reduce__(self):
+        return (attach_kb, (self.name,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        if self.owner:
+            self.unlink()
+
+    def __str__(self):
+        return f"SharedKnowledgeBase {self.name} containing {len(self.celltypes)} cell types and {len(self.processes)} cellular processes"
+
+    def close(self):
+        '''
+        release the views of this process into the shared memory block, the object can not be used afterwards
+        '''
+        self.index = self.processes = self.identities = None
+        try:
+            self._shm.close()
+        except BufferError:
+            warnings.warn(f"arrays of {self.name} are still referenced, the shared memory stays mapped until they are released")
+
+    def unlink(self):
+        '''
+        free the shared memory block once all processes have closed it (only the publishing process should call this)
+        '''
+        if sys.version_info < (3, 13):
+            from multiprocessing import resource_tracker
+            #workers started with spawn or forkserver share the resource tracker of this process and dropped its
+            #registration of the block in attach_kb, register it again so that unlink can unregister it
+            resource_tracker.register(self._shm._name, 'shared_memory')
+        self._shm.unlink()
+        _published.discard(self._shm._name)
+
+    def get_processes(self, gene_sets):
+        '''
+        create dictionary gene sets for cellular processes : genes, see cytopus.KnowledgeBase.get_processes
+        '''
+        index = self.index
+        indptr, genes, _ = index.edge_adjacency(['gene_OF'], by='src')
+        gene_mask = index.node_class_mask(['gene'])
+        gene_set_dict = {}
+        for gene_set in gene_sets:
+            code = index.codes.get(gene_set)
+            if code is not None:
+                members = genes[indptr[code]:indptr[code + 1]]
+                members = [index.names[x] for x in members[gene_mask[members]].tolist()]
+                if members:
+                    gene_set_dict[gene_set] = members
+        return gene_set_dict
+
+    def get_identities(self, celltypes_identities, include_subsets=False):
+        '''
+        dictionary cell type : genes of its identity gene set, see cytopus.KnowledgeBase.get_identities
+        '''
+        if not isinstance(celltypes_identities, list):
+            raise TypeError('celltypes_identities must of be of type: list')
+        if include_subsets:
+            index = self.index
+            celltypes = set()
+            for celltype in celltypes_identities:
+                celltypes.add(celltype)
+                celltypes.update(index.names[x] for x in index.traverse_hierarchy(celltype)[0].tolist())
+            celltypes_identities = list(celltypes)
+        return {k: self.identities[k] for k in celltypes_identities if k in self.identities}
+
+    def get_celltype_processes(self, celltypes, global_celltypes=[None], get_parents=True, get_children=True, parent_depth=1,
+                               child_depth=None, fill_missing=True, parent_depth_dict=None, child_depth_dict=None):
+        '''
+        dictionary {celltype: {gene set: [genes]}} of cellular processes, see cytopus.KnowledgeBase.get_celltype_processes
+        '''
+        from .kb_planner import celltype_gene_sets
+        return celltype_gene_sets(self.index, celltypes, global_celltypes=global_celltypes, get_parents=get_parents,
+                                  get_children=get_children, parent_depth=parent_depth, child_depth=child_depth,
+                                  fill_missing=fill_missing, parent_depth_dict=parent_depth_dict,
+                                  child_depth_dict=child_depth_dict, log=lambda *args: None)
+
+    #query methods of KnowledgeBase which only use the index
+    def get_celltype_hierarchy(self, node='all-cells', invert=False, depth=None):
+        return self._kb_class.get_celltype_hierarchy(self, node=node, invert=invert, depth=depth)
+
+    def query(self, celltypes=None, relation='self', depth=None, gene_set_class=None, edge_class=['process_OF','identity_OF'],
+              genes_any=None, genes_all=None, metadata=None):
+        return self._kb_class.query(self, celltypes=celltypes, relation=relation, depth=depth, gene_set_class=gene_set_class,
+                                    edge_class=edge_class, genes_any=genes_any, genes_all=genes_all, metadata=metadata)
+
+    def lowest_common_ancestor(self, celltypes_a, celltypes_b):
+        return self._kb_class.lowest_common_ancestor(self, celltypes_a, celltypes_b)
+
+    def get_gene_sets(self, genes):
+        return self._kb_class.get_gene_sets(self, genes)
+
+    def gene_set_matrix(self, var_names, gene_sets=None):
+        return self._kb_class.gene_set_matrix(self, var_names, gene_sets=gene_sets)
+
+    def resolve_names(self, labels, kinds=None, fuzzy=True, min_score=0.5, n_matches=1):
+        return self._kb_class.resolve_names(self, labels, kinds=kinds, fuzzy=fuzzy, min_score=min_score, n_matches=n_matches)
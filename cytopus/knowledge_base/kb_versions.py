@@ -0,0 +1,179 @@
+"""Registry of KnowledgeBase versions and structural diffs between them"""
+import os
+import pickle
+import pkg_resources
+import numpy as np
+import networkx as nx
+from .kb_index import KBIndex, hash_names
+
+#KnowledgeBase loaded by cytopus.KnowledgeBase() without arguments
+DEFAULT_VERSION = 'Cytopus_1.31nc_newcelltypes.txt'
+
+#KnowledgeBase files shipped in cytopus/data, oldest first
+BUNDLED_VERSIONS = ['Cytopus_1.2.txt', 'Cytopus_1.22.txt', 'Cytopus_1.23.txt', 'Cytopus_1.31nc.txt', 'Cytopus_1.31nc_newcelltypes.txt']
+
+#KnowledgeBase files added with register_version: {name: {'path':..., 'description':...}}
+_user_versions = {}
+
+
+def register_version(name, path, description=None):
+    '''
+    register a user KnowledgeBase file so it can be listed and compared by name
+    name: str, name of the version
+    path: str, path to pickled networkx.DiGraph object formatted for cytopus
+    description: str, free text description
+    '''
+    if name in BUNDLED_VERSIONS:
+        raise ValueError(f"{name} is the name of a bundled KnowledgeBase version")
+    if not os.path.isfile(path):
+        raise ValueError(f"{path} does not exist")
+    _user_versions[name] = {'path': os.path.abspath(path), 'description': description}
+
+
+def get_version_path(name=None):
+    '''
+    return the path to a bundled or registered KnowledgeBase version
+    name: str, name of the version, None for the default version
+    '''
+    if name is None:
+        name = DEFAULT_VERSION
+    if name in _user_versions:
+        return _user_versions[name]['path']
+    if name in BUNDLED_VERSIONS:
+        return pkg_resources.resource_filename('cytopus', 'data/' + name)
+    raise ValueError(f"unknown KnowledgeBase version {name}, see cytopus.list_versions()")
+
+
+def list_versions():
+    '''
+    list bundled and registered KnowledgeBase versions without loading them
+    returns: pandas.DataFrame, with name, version, source ('bundled' or 'user'), path, size in bytes, default flag and description
+    '''
+    import pandas as pd
+
+    rows = []
+    for name in BUNDLED_VERSIONS:
+        rows.append({'name': name, 'version': name[len('Cytopus_'):-len('.txt')], 'source': 'bundled', 'description': None})
+    for name, info in _user_versions.items():
+        rows.append({'name': name, 'version': name, 'source': 'user', 'description': info['description']})
+    for row in rows:
+        row['path'] = get_version_path(row['name'])
+        row['size_bytes'] = os.path.getsize(row['path']) if os.path.isfile(row['path']) else None
+        row['default'] = row['name'] == DEFAULT_VERSION
+    return pd.DataFrame(rows, columns=['name', 'version', 'source', 'path', 'size_bytes', 'default', 'description'])
+
+
+def _load_graph(kb):
+    '''
+    return the networkx.DiGraph of a KnowledgeBase, graph, file path or version name
+    '''
+    if isinstance(kb, nx.DiGraph):
+        return kb
+    if hasattr(kb, 'graph'):
+        return kb.graph
+    if isinstance(kb, str):
+        path = kb if os.path.isfile(kb) else get_version_path(kb)
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    raise ValueError('KnowledgeBase must be a cytopus.KnowledgeBase, networkx.DiGraph, path or version name')
+
+
+class _EdgeTable:
+    def __init__(self, graph):
+        '''
+        hashed, integer-encoded nodes and edges of a KnowledgeBase graph for diffing
+        graph: networkx.DiGraph, formatted for cytopus
+        '''
+        index = KBIndex(graph)
+        self.names = np.array(index.names, dtype=object)
+        self.hashes = hash_names(index.names)
+        self.edge_src = index.edge_src
+        self.edge_dst = index.edge_dst
+        self.keys = self.hashes[index.edge_src] * np.uint64(0x9E3779B97F4A7C15) ^ self.hashes[index.edge_dst]
+        self.edge_masks = {c: index.edge_class_mask([c]) for c in ['gene_OF', 'SUBSET_OF', 'process_OF', 'identity_OF']}
+        self.celltypes = index.node_class_mask(['cell_type'])
+        self.genes = index.node_class_mask(['gene'])
+        self.gene_sets = np.zeros(len(index), dtype=bool)
+        for c in ['gene_OF', 'process_OF', 'identity_OF']:
+            self.gene_sets[index.edge_src[self.edge_masks[c]]] = True
+
+
+def _isin(hashes, other):
+    '''
+    boolean mask of hashes contained in other, using a hash table lookup
+    '''
+    import pandas as pd
+    return pd.Index(hashes).isin(other)
+
+
+def _node_changes(a, b, mask_a, mask_b):
+    '''
+    names of nodes selected by mask_b missing in a, and selected by mask_a missing in b
+    '''
+    hashes_a, hashes_b = a.hashes[mask_a], b.hashes[mask_b]
+    added = b.names[mask_b][~_isin(hashes_b, hashes_a)]
+    removed = a.names[mask_a][~_isin(hashes_a, hashes_b)]
+    return sorted(added), sorted(removed)
+
+
+def _edge_changes(a, b, edge_class, shared_src):
+    '''
+    edges of one class added or removed between a and b, restricted to origins contained in both
+    returns: pandas.DataFrame with origin, target and change ('added' or 'removed')
+    '''
+    import pandas as pd
+
+    frames = []
+    for table, other, change in [(b, a, 'added'), (a, b, 'removed')]:
+        mask = table.edge_masks[edge_class]
+        mask = mask & _isin(table.hashes[table.edge_src], shared_src)
+        new = mask.copy()
+        new[mask] = ~_isin(table.keys[mask], other.keys[other.edge_masks[edge_class]])
+        frames.append(pd.DataFrame({'origin': table.names[table.edge_src[new]],
+                                    'target': table.names[table.edge_dst[new]],
+                                    'change': change}))
+    return pd.concat(frames, ignore_index=True).sort_values(['origin', 'change', 'target'], ignore_index=True)
+
+
+def diff_kb(kb_a, kb_b):
+    '''
+    structural diff between two KnowledgeBases based on hashed edge tables, runs in linear time
+    kb_a: cytopus.KnowledgeBase, networkx.DiGraph, path or version name (see list_versions), old version
+    kb_b: cytopus.KnowledgeBase, networkx.DiGraph, path or version name (see list_versions), new version
+    returns: dict, with added and removed 'celltypes', 'gene_sets' and 'genes', 'gene_set_membership'
+    (pandas.DataFrame of genes added to or removed from gene sets contained in both),
+    'hierarchy_moves' (pandas.DataFrame of cell types whose parents changed), 'gene_set_celltypes'
+    (pandas.DataFrame of gene sets attached to different cell types) and a 'summary' of counts
+    '''
+    import pandas as pd
+
+    a, b = _EdgeTable(_load_graph(kb_a)), _EdgeTable(_load_graph(kb_b))
+    report = {}
+    for key in ['celltypes', 'gene_sets', 'genes']:
+        added, removed = _node_changes(a, b, getattr(a, key), getattr(b, key))
+        report[key] = {'added': added, 'removed': removed}
+
+    #gene membership of gene sets contained in both versions
+    shared_gene_sets = b.hashes[b.gene_sets][_isin(b.hashes[b.gene_sets], a.hashes[a.gene_sets])]
+    membership = _edge_changes(a, b, 'gene_OF', shared_gene_sets)
+    report['gene_set_membership'] = membership.rename(columns={'origin': 'gene_set', 'target': 'gene'})
+
+    #parents of cell types contained in both versions
+    shared_celltypes = b.hashes[b.celltypes][_isin(b.hashes[b.celltypes], a.hashes[a.celltypes])]
+    moves = _edge_changes(a, b, 'SUBSET_OF', shared_celltypes)
+    moves = pd.concat([moves[moves.change == 'removed'].groupby('origin')['target'].agg(list).rename('old_parents'),
+                       moves[moves.change == 'added'].groupby('origin')['target'].agg(list).rename('new_parents')], axis=1)
+    moves = moves.map(lambda x: x if isinstance(x, list) else [])
+    report['hierarchy_moves'] = moves.rename_axis('celltype').reset_index()
+
+    #cell types of gene sets contained in both versions
+    attachments = pd.concat([_edge_changes(a, b, c, shared_gene_sets).assign(edge_class=c) for c in ['process_OF', 'identity_OF']], ignore_index=True)
+    report['gene_set_celltypes'] = attachments.rename(columns={'origin': 'gene_set', 'target': 'celltype'})
+
+    report['summary'] = {
+        **{f'{key}_{change}': len(report[key][change]) for key in ['celltypes', 'gene_sets', 'genes'] for change in ['added', 'removed']},
+        'gene_set_membership_changes': len(report['gene_set_membership']),
+        'hierarchy_moves': len(report['hierarchy_moves']),
+        'gene_set_celltype_changes': len(report['gene_set_celltypes']),
+    }
+    return report
@@ -1,4 +1,5 @@
 #import networkx as nx
+from ..knowledge_base import KnowledgeBase
 
 def construct_kb(celltype_edges, geneset_gene_edges,geneset_celltype_edges,annotation_dict,metadata_dict=None,save=False, save_path=None):
     '''
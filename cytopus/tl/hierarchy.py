@@ -1,38 +1,34 @@
 #import networkx as nx
+import json
+import numpy as np
 from networkx.drawing.nx_agraph import graphviz_layout
-def build_nested_dict(graph, node):
+from ..knowledge_base.kb_index import encode_strings, decode_strings, TreeLCA
+from ..knowledge_base.kb_names import NameIndex
+def get_hierarchy_dict(G, depth=None):
     '''
-    build nested dictionary from reverse view of cytopus cell type hierarchy
-    graph: networkx.DiGraph.view, reverse view of Cytopus cell type hierarchy
-    root: str, name of root node in the reversed view
-    '''
-    nested_dict = {node: {}}
-    for neighbor in graph.successors(node):
-        nested_dict[node].update(build_nested_dict(graph, neighbor))
-    return nested_dict
-
-def get_hierarchy_dict(G):
-    '''
-    reverse Cytopus cell type hierarchy and build nested hierarchy from it
+    build nested hierarchy from the Cytopus cell type hierarchy, going from least granular to most granular cell type
     G: Cytopus.KnowledgeBase, containing cell type hierarchy
-
+    depth: int, maximum number of levels below the root cell types to include, None for the full hierarchy
     '''
-    import networkx as nx
-    #get view of cell type hierarchy
-    node_list_plot = G.filter_nodes(attribute_name='class', attributes = ['cell_type']) 
-    def filter_node(n1):
-                return n1 in node_list_plot
-        
-    view = nx.subgraph_view(G.graph, filter_node=filter_node)
+    from collections import deque
+    index = G.index
+    #children of every cell type in the order of the graph's edges (the order of the reversed hierarchy view),
+    #unlike KnowledgeBase.get_celltype_hierarchy which lists them in networkx predecessor order
+    celltype_mask = index.node_class_mask(['cell_type'])
+    edges = np.flatnonzero(celltype_mask[index.edge_src] & celltype_mask[index.edge_dst])
+    children = {}
+    for child, parent in zip(index.edge_src[edges].tolist(), index.edge_dst[edges].tolist()):
+        children.setdefault(parent, []).append(child)
 
-    #reverse graph view (going from least granular to most granular cell type)
-    reversed_view = view.reverse(copy=True)
-    root_nodes = [n for n in reversed_view.nodes if reversed_view.in_degree(n) == 0]
-
-    #build the nested dictionary
+    #breadth-first so that siblings are inserted in order, cell types with several parents are nested under each
     hierarchy_dict = {}
-    for root in root_nodes:
-        hierarchy_dict.update(build_nested_dict(reversed_view, root))
+    queue = deque((root, hierarchy_dict, 0, frozenset()) for root in index.celltype_roots().tolist())
+    while queue:
+        code, container, level, path = queue.popleft()
+        container[index.names[code]] = nested = {}
+        if depth is None or level < depth:
+            path = path | {code}
+            queue.extend((child, nested, level + 1, path) for child in children.get(code, []) if child not in path)
 
     return hierarchy_dict
 
@@ -75,15 +71,403 @@ def get_node_labels(graph, node_type):
     nodes = [node for node in nx.dfs_postorder_nodes(graph) if graph.nodes[node]['type'] == node_type]
     return nodes[::-1]
 
+#binary container for Hierarchy.save: magic, header length, json header, then 64 byte aligned arrays
+_CONTAINER_MAGIC = b'CYTOPUSH'
+_CONTAINER_ALIGN = 64
+
+def write_container(path, arrays, metadata=None):
+    '''
+    write numpy arrays to a binary container which can be read (and memory-mapped) array by array
+    path: str, file to write
+    arrays: dict, array names as keys and numpy.ndarrays as values
+    metadata: dict, json serializable metadata to store in the header
+    '''
+    specs = {}
+    offset = 0
+    for name, array in arrays.items():
+        specs[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // _CONTAINER_ALIGN) * _CONTAINER_ALIGN
+    header = json.dumps({'arrays': specs, 'metadata': metadata or {}}).encode('utf-8')
+    data_start = -(-(len(_CONTAINER_MAGIC) + 8 + len(header)) // _CONTAINER_ALIGN) * _CONTAINER_ALIGN
+    with open(path, 'wb') as f:
+        f.write(_CONTAINER_MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + specs[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+
+def read_container_header(path):
+    '''
+    read the header of a binary container written with write_container
+    path: str, container file
+    returns: dict, with 'arrays' (dtype, shape and absolute offset per array) and 'metadata'
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(_CONTAINER_MAGIC)) != _CONTAINER_MAGIC:
+            raise ValueError(f"{path} is not a cytopus container file")
+        header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    data_start = -(-(len(_CONTAINER_MAGIC) + 8 + header_length) // _CONTAINER_ALIGN) * _CONTAINER_ALIGN
+    for spec in header['arrays'].values():
+        spec['offset'] += data_start
+    return header
+
+def read_container_array(path, header, name, mmap=False):
+    '''
+    read one array from a binary container
+    path: str, container file
+    header: dict, header returned by read_container_header
+    name: str, name of the array
+    mmap: bool, if True return a read-only numpy.memmap instead of reading the array into memory
+    '''
+    spec = header['arrays'][name]
+    shape = tuple(spec['shape'])
+    if mmap and int(np.prod(shape)) > 0:
+        return np.memmap(path, dtype=spec['dtype'], mode='r', offset=spec['offset'], shape=shape)
+    count = int(np.prod(shape))
+    return np.fromfile(path, dtype=spec['dtype'], count=count, offset=spec['offset']).reshape(shape)
+
+_CSV_SUFFIXES = ('.csv', '.tsv', '.txt')
+
+
+def _read_obs(source, obs_columns=None, chunk_size=100000):
+    '''
+    read the cell annotations of a dataset for Hierarchy.add_cells_batched, chunk_size rows at a time
+    source: anndata.AnnData, str (path to .h5ad file or to a .csv/.tsv/.txt obs table, optionally compressed, with
+    cell barcodes in the first column) or pandas.DataFrame (obs)
+    obs_columns: list, columns to read, for files only these columns are loaded from disk
+    chunk_size: int, maximum number of rows per chunk, files are never read beyond the current chunk
+    yields: pandas.DataFrame, consecutive row slices of obs
+    '''
+    import pandas as pd
+    import anndata
+
+    if isinstance(source, (pd.DataFrame, anndata.AnnData)):
+        obs = source if isinstance(source, pd.DataFrame) else source.obs
+        if obs_columns is not None:
+            obs = obs[obs_columns]
+        for chunk_start in range(0, len(obs), chunk_size):
+            yield obs.iloc[chunk_start:chunk_start + chunk_size]
+    elif isinstance(source, str):
+        name = source.lower()
+        for compression in ('.gz', '.bz2', '.zip', '.xz', '.zst'):
+            name = name[:-len(compression)] if name.endswith(compression) else name
+        if name.endswith(_CSV_SUFFIXES):
+            yield from _read_obs_csv(source, obs_columns, chunk_size, sep=',' if name.endswith('.csv') else '\t')
+        else:
+            yield from _read_obs_h5ad(source, obs_columns, chunk_size)
+    else:
+        raise ValueError('sources must be anndata.AnnData objects, paths to .h5ad or .csv/.tsv files or pandas.DataFrames')
+
+
+def _read_obs_csv(path, obs_columns, chunk_size, sep=','):
+    '''
+    read the obs table of a .csv/.tsv file chunk_size rows at a time, the first column holds the cell barcodes
+    '''
+    import pandas as pd
+
+    header = list(pd.read_csv(path, sep=sep, nrows=0).columns)
+    usecols = None
+    if obs_columns is not None:
+        missing = [c for c in obs_columns if c not in header[1:]]
+        if missing:
+            raise ValueError(f"columns {missing} are not contained in {path}")
+        usecols = [0] + sorted(header.index(c, 1) for c in obs_columns)
+    #labels are read as strings, missing annotations stay NaN
+    for chunk in pd.read_csv(path, sep=sep, index_col=0, usecols=usecols, dtype=str, chunksize=chunk_size):
+        yield chunk if obs_columns is None else chunk[obs_columns]
+
+
+def _read_obs_h5ad(path, obs_columns, chunk_size):
+    '''
+    read obs of a .h5ad file chunk_size rows at a time, categorical columns share their categories between chunks
+    '''
+    import h5py
+    import pandas as pd
+    try:
+        from anndata.io import read_elem
+    except ImportError:
+        from anndata.experimental import read_elem
+
+    def read_rows(elem, rows, categories=None):
+        if categories is not None:
+            return pd.Categorical.from_codes(elem['codes'][rows], categories=categories,
+                                             ordered=bool(elem.attrs.get('ordered', False)))
+        if isinstance(elem, h5py.Dataset):
+            return elem.asstr()[rows] if h5py.check_string_dtype(elem.dtype) is not None else elem[rows]
+        #nullable arrays are stored as values and mask
+        values = pd.Series(read_rows(elem['values'], rows))
+        return (values.mask(elem['mask'][rows]) if 'mask' in elem else values).values
+
+    with h5py.File(path, 'r') as f:
+        group = f['obs']
+        columns = list(group.attrs['column-order']) if obs_columns is None else list(obs_columns)
+        missing = [c for c in columns if c not in group]
+        if missing:
+            raise ValueError(f"columns {missing} are not contained in obs of {path}")
+        index = group[group.attrs['_index']]
+        categories = {c: pd.Index(read_elem(group[c]['categories'])) for c in columns
+                      if group[c].attrs.get('encoding-type') == 'categorical'}
+        for chunk_start in range(0, index.shape[0], chunk_size):
+            rows = slice(chunk_start, chunk_start + chunk_size)
+            yield pd.DataFrame({c: read_rows(group[c], rows, categories.get(c)) for c in columns},
+                               index=pd.Index(read_rows(index, rows)))
+
+
+class _CelltypeIndex:
+    def __init__(self, graph):
+        '''
+        integer-encoded cell type hierarchy of a Hierarchy graph with precomputed ancestors
+        graph: networkx.DiGraph, Hierarchy graph with edges pointing from child to parent cell type
+        '''
+        import networkx as nx
+        import pandas as pd
+
+        self.celltypes = [n for n, t in graph.nodes(data='type') if t == 'cell_type']
+        self.codes = {n: i for i, n in enumerate(self.celltypes)}
+        self._lookup = pd.Index(self.celltypes)
+        tree = graph.subgraph(self.celltypes)
+        self.parents = [[self.codes[p] for p in tree.successors(n)] for n in self.celltypes]
+
+        # ancestors[i, j] is True if cell type j is a (proper) ancestor of cell type i
+        self.ancestors = np.zeros((len(self.celltypes), len(self.celltypes)), dtype=bool)
+        for node in reversed(list(nx.topological_sort(tree))):
+            i = self.codes[node]
+            for parent in self.parents[i]:
+                self.ancestors[i] |= self.ancestors[parent]
+                self.ancestors[i, parent] = True
+
+    def lca(self):
+        '''
+        lowest common ancestor structure (TreeLCA) of the cell type tree, built on first use
+        '''
+        if getattr(self, '_lca', None) is None:
+            if any(len(p) > 1 for p in self.parents):
+                raise ValueError('lowest common ancestors require a cell type tree, some cell types have several parents')
+            self._lca = TreeLCA(self.celltypes, [p[0] if p else -1 for p in self.parents])
+        return self._lca
+
+    def name_index(self):
+        '''
+        NameIndex over the cell types for resolving free-text labels, built on first use
+        '''
+        if getattr(self, '_names', None) is None:
+            self._names = NameIndex(self.celltypes, ['celltype'] * len(self.celltypes))
+        return self._names
+
+    def get_codes(self, labels):
+        '''
+        cell type codes of an array of labels, -1 for labels not in the hierarchy
+        '''
+        return self._lookup.get_indexer(np.asarray(labels))
+
+    def get_column_codes(self, column):
+        '''
+        cell type codes of an obs column compared as strings, -1 for labels not in the hierarchy
+        column: pandas.Series, only the distinct values are converted and looked up
+        '''
+        import pandas as pd
+
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            value_codes, values = column.cat.codes.values, column.cat.categories
+        else:
+            value_codes, values = pd.factorize(column)
+        return np.append(self.get_codes(pd.Index(values).astype(str)), -1)[value_codes]
+
+    def most_granular(self, cells, codes, n_cells):
+        '''
+        select the most granular annotations of every cell, i.e. drop annotations which are ancestors or duplicates of
+        another annotation of the same cell, unrelated annotations are all kept
+        cells: numpy.ndarray, cell index of every annotation
+        codes: numpy.ndarray, cell type code of every annotation
+        n_cells: int, number of cells
+        returns: numpy.ndarray of bool, True for annotations to keep (the first of duplicates is kept)
+        '''
+        if len(cells) == 0:
+            return np.zeros(0, dtype=bool)
+        # arrange annotations as cells x annotations, padded with -1
+        order = np.argsort(cells, kind='stable')
+        counts = np.bincount(cells, minlength=n_cells)
+        rank = np.arange(len(cells)) - np.repeat(np.cumsum(counts) - counts, counts)
+        wide = np.full((n_cells, counts.max()), -1, dtype=np.int64)
+        wide[cells[order], rank] = codes[order]
+
+        for a in range(wide.shape[1]):
+            for b in range(wide.shape[1]):
+                if a == b:
+                    continue
+                valid = (wide[:, a] >= 0) & (wide[:, b] >= 0)
+                dominated = valid & self.ancestors[wide[:, b].clip(0), wide[:, a].clip(0)]
+                if b < a:
+                    dominated |= valid & (wide[:, a] == wide[:, b])
+                wide[dominated, a] = -1
+
+        keep = np.empty(len(cells), dtype=bool)
+        keep[order] = wide[cells[order], rank] >= 0
+        return keep
+
+
+class _CellCounts:
+    def __init__(self, tree):
+        '''
+        cell counts per group and cell type, updated incrementally as cells are (re)assigned
+        tree: cytopus.tl.hierarchy._CelltypeIndex, cell type hierarchy
+        '''
+        import pandas as pd
+
+        n = len(tree.celltypes)
+        self.tree = tree
+        #cover[i, j] is True if cell type j is cell type i or one of its ancestors
+        self.cover = tree.ancestors | np.eye(n, dtype=bool)
+        self.groups = pd.Index([], dtype=object)
+        self.direct = np.zeros((0, n), dtype=np.int64)
+        #cells with several (unrelated) annotations are counted once for their shared ancestors
+        self.overlap = np.zeros((0, n), dtype=np.int64)
+        self.n_cells = np.zeros(0, dtype=np.int64)
+
+    def group_rows(self, groups):
+        '''
+        row of every group label in the count matrices, new groups are appended
+        groups: array-like, group label per cell (None or NaN for cells without group)
+        '''
+        import pandas as pd
+
+        values = pd.Series(np.asarray(groups, dtype=object)).where(lambda x: x.notna(), None)
+        codes, uniques = pd.factorize(values, use_na_sentinel=False)
+        uniques = pd.Index(uniques, dtype=object)
+        new = uniques[self.groups.get_indexer(uniques) < 0]
+        if len(new):
+            self.groups = self.groups.append(new)
+            padding = np.zeros((len(new), self.direct.shape[1]), dtype=np.int64)
+            self.direct = np.vstack([self.direct, padding])
+            self.overlap = np.vstack([self.overlap, padding])
+            self.n_cells = np.append(self.n_cells, np.zeros(len(new), dtype=np.int64))
+        return self.groups.get_indexer(uniques)[codes]
+
+    def update(self, cells, codes, rows, sign=1):
+        '''
+        add (sign=1) or remove (sign=-1) the complete annotations of cells
+        cells: numpy.ndarray, cell index of every annotation
+        codes: numpy.ndarray, cell type code of every annotation
+        rows: numpy.ndarray, group row of every annotation (identical for all annotations of a cell)
+        '''
+        if len(cells) == 0:
+            return
+        n = self.direct.shape[1]
+        self.direct += sign * np.bincount(rows * n + codes, minlength=self.direct.size).reshape(self.direct.shape)
+        order = np.argsort(cells, kind='stable')
+        cells, codes, rows = cells[order], codes[order], rows[order]
+        starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+        self.n_cells += sign * np.bincount(rows[starts], minlength=len(self.n_cells))
+
+        annotations_per_cell = np.diff(np.append(starts, len(cells)))
+        multi = np.repeat(annotations_per_cell > 1, annotations_per_cell)
+        if multi.any():
+            covered = self.cover[codes[multi]]
+            multi_starts = np.flatnonzero(np.r_[True, cells[multi][1:] != cells[multi][:-1]])
+            extra = np.add.reduceat(covered.astype(np.int64), multi_starts, axis=0) - np.logical_or.reduceat(covered, multi_starts, axis=0)
+            np.add.at(self.overlap, rows[multi][multi_starts], sign * extra)
+
+    def cumulative(self):
+        '''
+        number of distinct cells per group assigned to each cell type or one of its subsets, one bottom-up aggregation
+        '''
+        #counts are exact in float64, which uses BLAS for many groups
+        return np.rint(self.direct.astype(np.float64) @ self.cover.astype(np.float64)).astype(np.int64) - self.overlap
+
+
+class _CellTable:
+    def __init__(self):
+        '''
+        barcodes, groups and annotations of the cells in a Hierarchy, barcodes are looked up by their hash in a sorted
+        array so that the cells of a chunk are matched in bulk, updated incrementally as cells are (re)assigned
+        '''
+        self.barcodes = np.zeros(0, dtype=object)
+        self.groups = np.zeros(0, dtype=object)
+        #sorted barcode hashes and the row of the cell of every hash
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.rows = np.zeros(0, dtype=np.int64)
+        #annotations, cell row and cell type code of every cell type -> cell edge
+        self.cells = np.zeros(0, dtype=np.int64)
+        self.codes = np.zeros(0, dtype=np.int64)
+
+    @staticmethod
+    def hash(barcodes):
+        import pandas as pd
+        return pd.util.hash_array(np.asarray(barcodes, dtype=object), categorize=False)
+
+    def lookup(self, barcodes):
+        '''
+        row of every barcode in the table, -1 for barcodes which are not in the table
+        barcodes: numpy.ndarray of object
+        '''
+        rows = np.full(len(barcodes), -1, dtype=np.int64)
+        if len(self.keys) == 0 or len(barcodes) == 0:
+            return rows
+        keys = self.hash(barcodes)
+        position = np.searchsorted(self.keys, keys).clip(max=len(self.keys) - 1)
+        hit = np.flatnonzero(self.keys[position] == keys)
+        rows[hit] = self.rows[position[hit]]
+        #hash collisions, compare with every barcode sharing the hash
+        for i in hit[self.barcodes[rows[hit]] != barcodes[hit]]:
+            same = self.rows[np.searchsorted(self.keys, keys[i]):np.searchsorted(self.keys, keys[i], side='right')]
+            rows[i] = next((r for r in same if self.barcodes[r] == barcodes[i]), -1)
+        return rows
+
+    def add(self, barcodes, groups):
+        '''
+        append new cells, returns their rows
+        barcodes: numpy.ndarray of object, barcodes which are not in the table yet
+        groups: numpy.ndarray of object, group label of every cell (None for cells without group)
+        '''
+        rows = np.arange(len(self.barcodes), len(self.barcodes) + len(barcodes))
+        self.barcodes = np.append(self.barcodes, np.asarray(barcodes, dtype=object))
+        self.groups = np.append(self.groups, np.asarray(groups, dtype=object))
+        keys = self.hash(barcodes)
+        order = np.argsort(keys, kind='stable')
+        position = np.searchsorted(self.keys, keys[order], side='right')
+        self.keys = np.insert(self.keys, position, keys[order])
+        self.rows = np.insert(self.rows, position, rows[order])
+        return rows
+
+    def annotations(self, rows):
+        '''
+        positions in self.cells/self.codes of the annotations of the cells in rows
+        '''
+        selected = np.zeros(len(self.barcodes), dtype=bool)
+        selected[rows] = True
+        return np.flatnonzero(selected[self.cells])
+
+    def replace(self, rows, cells, codes):
+        '''
+        replace all annotations of the cells in rows by the annotations (cells, codes)
+        '''
+        keep = np.ones(len(self.cells), dtype=bool)
+        keep[self.annotations(rows)] = False
+        self.cells = np.concatenate([self.cells[keep], cells])
+        self.codes = np.concatenate([self.codes[keep], codes])
+
 
 class Hierarchy:
     import networkx as nx
+    #defaults for Hierarchy objects pickled before these attributes were added
+    _pending_cells = None
+    _celltypes = None
+    _counts = None
+    _cells = None
+
     def __init__(self, hierarchy_dict):
         '''
         load hierarchy class
         hierarchy_dict: dict, nested dict containing the cell type hierarchy
         '''
         self.graph = create_hierarchical_graph(hierarchy_dict,type_label = 'cell_type')
+        self._pending_cells = None
+        self._celltypes = None
+        self._counts = None
+        self._cells = None
         print(self.__str__())
         
     def __str__(self):
@@ -121,65 +505,458 @@ class Hierarchy:
                             min_source_margin=0, min_target_margin=0)
         labels = nx.draw_networkx_labels(view,pos=pos,font_size=label_size)
 
-    def add_cells(self, adata, obs_columns=None):
+    def save(self, path):
+        '''
+        save the cell type hierarchy and all cell assignments to a binary container file
+        path: str, file to write (e.g. 'hierarchy.cyh')
+        '''
+        self._load_cells()
+        celltypes = [n for n, t in self.graph.nodes(data='type') if t == 'cell_type']
+        barcodes = [n for n, t in self.graph.nodes(data='type') if t == 'cell']
+        celltype_codes = {n: i for i, n in enumerate(celltypes)}
+        barcode_codes = {n: i for i, n in enumerate(barcodes)}
+
+        tree_edges = [(celltype_codes[u], celltype_codes[v]) for u, v in self.graph.edges if u in celltype_codes and v in celltype_codes]
+        cell_edges = [(barcode_codes[v], celltype_codes[u]) for u, v in self.graph.edges if u in celltype_codes and v in barcode_codes]
+        tree_edges = np.array(tree_edges, dtype=np.int32).reshape(-1, 2)
+        cell_edges = np.array(cell_edges, dtype=np.int32).reshape(-1, 2)
+
+        celltype_bytes, celltype_offsets = encode_strings(celltypes)
+        barcode_bytes, barcode_offsets = encode_strings([str(x) for x in barcodes])
+        arrays = {
+            'celltype_bytes': celltype_bytes,
+            'celltype_offsets': celltype_offsets,
+            'tree_child': tree_edges[:, 0],
+            'tree_parent': tree_edges[:, 1],
+            'barcode_bytes': barcode_bytes,
+            'barcode_offsets': barcode_offsets,
+            'cell_codes': cell_edges[:, 0],
+            'label_codes': cell_edges[:, 1],
+        }
+        groups = [self.graph.nodes[b].get('group') for b in barcodes]
+        if any(g is not None for g in groups):
+            import pandas as pd
+            group_codes, group_names = pd.factorize(pd.Series(groups, dtype=object))
+            arrays['group_bytes'], arrays['group_offsets'] = encode_strings([str(g) for g in group_names])
+            arrays['cell_groups'] = group_codes.astype(np.int32)
+        write_container(path, arrays, metadata={'format': 'cytopus.Hierarchy', 'version': 1})
+
+    @classmethod
+    def load(cls, path, load_cells=True, mmap=False):
+        '''
+        load a Hierarchy saved with Hierarchy.save
+        path: str, file written by Hierarchy.save
+        load_cells: bool, if False only the cell type hierarchy is loaded, cell assignments are loaded on first use
+        mmap: bool, if True memory-map the arrays instead of reading them into memory
+        returns: cytopus.tl.hierarchy.Hierarchy
+        '''
+        import networkx as nx
+        header = read_container_header(path)
+        if header['metadata'].get('format') != 'cytopus.Hierarchy':
+            raise ValueError(f"{path} does not contain a cytopus Hierarchy")
+
+        def read(name):
+            return read_container_array(path, header, name, mmap=mmap)
+
+        celltypes = decode_strings(read('celltype_bytes'), read('celltype_offsets'))
+        graph = nx.DiGraph()
+        graph.add_nodes_from(celltypes, type='cell_type')
+        graph.add_edges_from(zip([celltypes[i] for i in read('tree_child')], [celltypes[i] for i in read('tree_parent')]))
+
+        hierarchy = cls.__new__(cls)
+        hierarchy.graph = graph
+        hierarchy._pending_cells = (path, header, mmap)
+        hierarchy._celltypes = None
+        hierarchy._counts = None
+        hierarchy._cells = None
+        if load_cells:
+            hierarchy._load_cells()
+        return hierarchy
+
+    def _load_cells(self):
+        '''
+        add cell assignments deferred by Hierarchy.load(load_cells=False) to the graph
+        '''
+        if self._pending_cells is None:
+            return
+        path, header, mmap = self._pending_cells
+
+        def read(name):
+            return read_container_array(path, header, name, mmap=mmap)
+
+        celltypes = [n for n, t in self.graph.nodes(data='type') if t == 'cell_type']
+        barcodes = decode_strings(read('barcode_bytes'), read('barcode_offsets'))
+        self.graph.add_nodes_from(barcodes, type='cell')
+        self.graph.add_edges_from(zip([celltypes[i] for i in read('label_codes')], [barcodes[i] for i in read('cell_codes')]))
+        if 'cell_groups' in header['arrays']:
+            groups = decode_strings(read('group_bytes'), read('group_offsets'))
+            self.graph.add_nodes_from((b, {'group': groups[g]}) for b, g in zip(barcodes, read('cell_groups').tolist()) if g >= 0)
+        self._pending_cells = None
+
+    def add_cells(self, adata, obs_columns=None, groupby=None):
         '''
         Add cells to their most granular annotation in the hierarchy object.
         adata: anndata.AnnData, containing the cell type annotations under adata.obs.
         obs_columns: list, list of columns in adata.obs where the cell type annotations are stored (recommended).
+        groupby: str, column in adata.obs with a group label (e.g. sample) to store with the cells for Hierarchy.composition
         '''
         import warnings
-        import networkx as nx
 
+        self._load_cells()
         if obs_columns is None:
-            adata_sub = adata.obs
+            adata_sub = adata.obs.drop(columns=[groupby]) if groupby is not None else adata.obs
         else:
             adata_sub = adata.obs[obs_columns]
 
-        # Get cell type annotations from adata (covering both obs_columns and full-obs cases)
-        adata_celltypes = set()
-        for column in adata_sub.columns:
-            adata_celltypes.update(adata_sub[column].dropna().unique())
-
-        # Retrieve cell type nodes from the hierarchy
-        celltype_nodes = get_node_labels(self.graph, 'cell_type')
-        missing_celltypes = adata_celltypes - set(celltype_nodes)
+        missing_celltypes = self._assign_cells(adata_sub, groups=adata.obs[groupby] if groupby is not None else None)
 
         # Warn if there are missing cell types
         if missing_celltypes:
             warnings.warn(
-                f"Cell types {list(missing_celltypes)} are not contained in the hierarchy. Skipping..."
+                f"Cell types {list(missing_celltypes)} are not contained in the hierarchy "
+                f"(closest matches: {self._suggest(list(missing_celltypes))}). Skipping..."
             )
 
-        # Loop over cell types and assign cells
-        for cell_type in celltype_nodes:
-            barcodes = get_indices(adata_sub, cell_type)
-            for barcode in barcodes:
-                # Check if the cell is already in the hierarchy
-                if barcode in self.graph:
-                    # Find all current cell type assignments for this cell
-                    current_annotations = [
-                        edge[0] for edge in self.graph.in_edges(barcode)
-                        if self.graph.nodes[edge[0]]['type'] == 'cell_type'
-                    ]
-
-                    skip = False
-                    for current_annotation in current_annotations:
-                        if nx.has_path(self.graph, current_annotation, cell_type):
-                            # current_annotation is a descendant (more granular), keep it; skip new one
-                            skip = True
-                            break
-                        elif nx.has_path(self.graph, cell_type, current_annotation):
-                            # new cell_type is a descendant (more granular), replace current
-                            self.graph.remove_edge(current_annotation, barcode)
-
-                    if skip:
+    def add_cells_batched(self, sources, obs_columns=None, chunk_size=100000, verbose=True, groupby=None):
+        '''
+        Add cells from many datasets or obs chunks to their most granular annotation, one chunk at a time.
+        Cells seen in several chunks or datasets are resolved with the same rules as in add_cells.
+        sources: anndata.AnnData (also backed), str (path to .h5ad file or .csv/.tsv obs table with cell barcodes in the
+        first column), pandas.DataFrame (obs) or a list/iterator of these
+        obs_columns: list, list of columns in obs where the cell type annotations are stored (recommended), for files
+        only these columns are read from disk
+        chunk_size: int, maximum number of cells to read and resolve at once, files are read chunk_size rows at a time
+        verbose: bool, if True print the throughput of every batch
+        groupby: str, column in obs with a group label (e.g. sample) to store with the cells for Hierarchy.composition
+        returns: pandas.DataFrame, with source, number of cells, number of assigned cells, seconds and cells per second per batch
+        '''
+        import time
+        import warnings
+        import pandas as pd
+        import anndata
+
+        self._load_cells()
+        if isinstance(sources, (str, pd.DataFrame, anndata.AnnData)):
+            sources = [sources]
+        report = []
+        missing_celltypes = set()
+        for source_number, source in enumerate(sources):
+            source_name = source if isinstance(source, str) else source_number
+            columns = list(obs_columns) + [groupby] if obs_columns is not None and groupby is not None else obs_columns
+            chunk_start = 0
+            start = time.perf_counter()
+            #chunks are read one at a time, the time of a batch includes reading it
+            for chunk in _read_obs(source, columns, chunk_size=chunk_size):
+                groups = None
+                if groupby is not None:
+                    groups = chunk[groupby]
+                    chunk = chunk.drop(columns=[groupby])
+                n_cells = self._count_cells()
+                missing_celltypes |= self._assign_cells(chunk, groups=groups)
+                seconds = time.perf_counter() - start
+                report.append({
+                    'source': source_name,
+                    'chunk_start': chunk_start,
+                    'n_cells': len(chunk),
+                    'n_new_cells': self._count_cells() - n_cells,
+                    'seconds': seconds,
+                    'cells_per_second': len(chunk) / seconds if seconds > 0 else float('inf'),
+                })
+                if verbose:
+                    print(f"batch {len(report)} (source {source_name}, rows {chunk_start}-{chunk_start + len(chunk)}): "
+                          f"{len(chunk)} cells in {seconds:.2f}s ({report[-1]['cells_per_second']:.0f} cells/s)")
+                chunk_start += len(chunk)
+                start = time.perf_counter()
+
+        if missing_celltypes:
+            warnings.warn(
+                f"Cell types {list(missing_celltypes)} are not contained in the hierarchy "
+                f"(closest matches: {self._suggest(list(missing_celltypes))}). Skipping..."
+            )
+        return pd.DataFrame(report)
+
+    def annotation_conflicts(self, adata, obs_columns, obs_key='annotation_consistency'):
+        '''
+        Classify how the annotations of every cell in several obs columns relate to each other in the hierarchy.
+        'consistent': all annotations are identical (or only one annotation is available)
+        'refinable': all annotations lie on one lineage, i.e. the others are ancestors of the most granular one
+        'conflicting': at least two annotations lie on unrelated branches of the hierarchy
+        'unannotated': no annotation is contained in the hierarchy
+        adata: anndata.AnnData or pandas.DataFrame (obs), containing the cell type annotations
+        obs_columns: list, columns in obs where the cell type annotations are stored
+        obs_key: str, column label to store the classification under adata.obs[obs_key], None to skip
+        returns: dict, with 'status' (pandas.Series per cell), 'column_pairs' (counts per pair of obs columns),
+        'label_pairs' (number of cells per pair of refinable or conflicting annotations) and 'conflicting_cells'
+        (barcodes of conflicting cells)
+        '''
+        import itertools
+        import pandas as pd
+
+        obs = adata if isinstance(adata, pd.DataFrame) else adata.obs
+        tree = self._celltype_index()
+        codes = np.stack([tree.get_column_codes(obs[column]) for column in obs_columns], axis=1)
+        n_valid = (codes >= 0).sum(axis=1)
+
+        # 0: consistent, 1: refinable, 2: conflicting
+        status = np.zeros(len(obs), dtype=np.int8)
+        column_pairs, label_pairs = [], []
+        for a, b in itertools.combinations(range(len(obs_columns)), 2):
+            code_a, code_b = codes[:, a], codes[:, b]
+            valid = (code_a >= 0) & (code_b >= 0)
+            ancestor = tree.ancestors[code_a.clip(0), code_b.clip(0)] | tree.ancestors[code_b.clip(0), code_a.clip(0)]
+            relation = np.where(code_a == code_b, 0, np.where(ancestor, 1, 2))
+            relation[~valid] = 0
+            np.maximum(status, relation, out=status)
+            column_pairs.append({
+                'column_a': obs_columns[a],
+                'column_b': obs_columns[b],
+                'n_compared': int(valid.sum()),
+                'n_consistent': int((valid & (relation == 0)).sum()),
+                'n_refinable': int((relation == 1).sum()),
+                'n_conflicting': int((relation == 2).sum()),
+            })
+            # count cells per pair of differing annotations
+            differing = relation > 0
+            pair_codes, first, counts = np.unique(code_a[differing] * len(tree.celltypes) + code_b[differing],
+                                                  return_index=True, return_counts=True)
+            pair_relation = relation[differing][first]
+            label_pairs.append(pd.DataFrame({
+                'column_a': obs_columns[a],
+                'column_b': obs_columns[b],
+                'label_a': [tree.celltypes[c] for c in pair_codes // len(tree.celltypes)],
+                'label_b': [tree.celltypes[c] for c in pair_codes % len(tree.celltypes)],
+                'relation': np.array(['refinable', 'conflicting'])[pair_relation - 1],
+                'n_cells': counts,
+            }))
+
+        status_names = np.array(['consistent', 'refinable', 'conflicting', 'unannotated'])
+        status[n_valid == 0] = 3
+        status = pd.Series(pd.Categorical.from_codes(status, categories=status_names), index=obs.index, name=obs_key)
+        if obs_key is not None and not isinstance(adata, pd.DataFrame):
+            adata.obs[obs_key] = status
+        label_pairs = pd.concat(label_pairs, ignore_index=True) if label_pairs else pd.DataFrame(
+            columns=['column_a', 'column_b', 'label_a', 'label_b', 'relation', 'n_cells'])
+        return {
+            'status': status,
+            'column_pairs': pd.DataFrame(column_pairs),
+            'label_pairs': label_pairs.sort_values('n_cells', ascending=False, ignore_index=True),
+            'conflicting_cells': obs.index[status.values == 'conflicting'],
+        }
+
+    def lowest_common_ancestor(self, labels_a, labels_b, adata=None, obs_key='lca', distance_key='lca_distance'):
+        '''
+        Harmonize two annotations by their lowest common ancestor in the hierarchy, e.g. reference and query labels.
+        labels_a: array-like or str, cell type labels per cell, or a column in adata.obs
+        labels_b: array-like or str, cell type labels per cell, or a column in adata.obs
+        adata: anndata.AnnData, to read label columns from and store the results under adata.obs[obs_key] and adata.obs[distance_key]
+        obs_key: str, column label to store the lowest common ancestors under adata.obs[obs_key]
+        distance_key: str, column label to store the number of hierarchy steps between the labels under adata.obs[distance_key]
+        returns: pandas.DataFrame, with the lowest common ancestor ('lca', NaN if a label is missing or not in the
+        hierarchy) and distance ('distance', -1 if missing) per cell
+        '''
+        import pandas as pd
+
+        if isinstance(labels_a, str):
+            labels_a = adata.obs[labels_a]
+        if isinstance(labels_b, str):
+            labels_b = adata.obs[labels_b]
+        lca, distance = self._celltype_index().lca().lca_labels(labels_a, labels_b)
+        result = pd.DataFrame({'lca': lca, 'distance': distance}, index=adata.obs_names if adata is not None else None)
+        if adata is not None:
+            adata.obs[obs_key] = lca
+            adata.obs[distance_key] = distance
+        return result
+
+    def resolve_labels(self, labels, fuzzy=True, min_score=0.5, n_matches=1):
+        '''
+        resolve free-text annotation labels to cell types of the hierarchy in one pass, trying exact, normalized (case,
+        separator and plural insensitive), prefix and fuzzy (character trigram) lookup in this order
+        labels: array-like, labels to resolve, e.g. the categories of an obs column
+        fuzzy: bool, if False only exact, normalized and prefix lookups are used
+        min_score: float, minimum score (0-1) of prefix and fuzzy matches
+        n_matches: int, maximum number of fuzzy matches per label
+        returns: pandas.DataFrame, with label, match (NaN if unresolved), kind, method and score per match
+        '''
+        return self._celltype_index().name_index().resolve(labels, fuzzy=fuzzy, min_score=min_score, n_matches=n_matches)
+
+    def _suggest(self, labels):
+        '''
+        closest cell types of unknown labels for warnings, {label: cell type}
+        '''
+        matches = self.resolve_labels(labels, min_score=0.6).dropna(subset=['match'])
+        return dict(zip(matches['label'], matches['match']))
+
+    def _count_cells(self):
+        '''
+        number of cell nodes in the hierarchy
+        '''
+        return self.graph.number_of_nodes() - len(self._celltype_index().celltypes)
+
+    def _celltype_index(self):
+        '''
+        return the (cached) _CelltypeIndex of the cell type hierarchy
+        '''
+        if getattr(self, '_celltypes', None) is None:
+            self._celltypes = _CelltypeIndex(self.graph)
+        return self._celltypes
+
+    def _assign_cells(self, obs, groups=None):
+        '''
+        assign cells to their most granular annotation, merging with the annotations of cells already in the hierarchy
+        obs: pandas.DataFrame, with cell barcodes as index and cell type annotations as columns
+        groups: array-like, group label (e.g. sample) per row of obs, stored with the cells for Hierarchy.composition
+        returns: set, annotations which are not contained in the hierarchy
+        '''
+        import pandas as pd
+
+        tree = self._celltype_index()
+        table = self._cell_table()
+        cell_ids, barcodes = pd.factorize(obs.index)
+        barcodes = np.asarray(barcodes, dtype=object)
+        missing_celltypes = set()
+
+        # annotations of cells which are already in the hierarchy come first
+        rows = table.lookup(barcodes)
+        present = np.flatnonzero(rows >= 0)
+        old_groups = np.full(len(barcodes), None, dtype=object)
+        old_groups[present] = table.groups[rows[present]]
+        local = np.full(len(table.barcodes), -1, dtype=np.int64)
+        local[rows[present]] = present
+        current = table.annotations(rows[present])
+        existing_count = len(current)
+        cells = [local[table.cells[current]]]
+        codes = [table.codes[current]]
+
+        for column in obs.columns:
+            values = obs[column]
+            column_codes = tree.get_column_codes(values)
+            missing_celltypes.update(values[column_codes < 0].dropna().unique())
+            valid = column_codes >= 0
+            cells.append(cell_ids[valid])
+            codes.append(column_codes[valid])
+        cells, codes = np.concatenate(cells), np.concatenate(codes)
+        keep = tree.most_granular(cells, codes, len(barcodes))
+
+        # group of every cell, new groups replace the stored ones
+        old_groups = pd.Series(old_groups, dtype=object)
+        new_groups = old_groups
+        if groups is not None:
+            _, first = np.unique(cell_ids, return_index=True)
+            new_groups = pd.Series(np.asarray(groups, dtype=object)[first], dtype=object)
+            new_groups = new_groups.where(new_groups.notna(), old_groups)
+
+        # update the cell counts of the replaced and the new annotations of these cells
+        if self._counts is not None:
+            old_rows = self._counts.group_rows(old_groups)
+            self._counts.update(cells[:existing_count], codes[:existing_count], old_rows[cells[:existing_count]], sign=-1)
+            new_rows = self._counts.group_rows(new_groups)
+            self._counts.update(cells[keep], codes[keep], new_rows[cells[keep]], sign=1)
+
+        # remove current annotations replaced by more granular ones and add new annotations
+        self.graph.remove_edges_from(zip([tree.celltypes[c] for c in codes[:existing_count][~keep[:existing_count]]],
+                                         barcodes[cells[:existing_count][~keep[:existing_count]]]))
+        new_cells = cells[existing_count:][keep[existing_count:]]
+        new_codes = codes[existing_count:][keep[existing_count:]]
+        self.graph.add_nodes_from(barcodes[np.unique(new_cells)], type='cell')
+        self.graph.add_edges_from(zip([tree.celltypes[c] for c in new_codes], barcodes[new_cells]))
+        if groups is not None:
+            annotated = np.unique(cells[keep])
+            self.graph.add_nodes_from((b, {'group': g}) for b, g in zip(barcodes[annotated], new_groups.values[annotated]))
+
+        # new cells are the annotated cells which were not in the hierarchy
+        annotated = np.zeros(len(barcodes), dtype=bool)
+        annotated[cells[keep]] = True
+        added = np.flatnonzero(annotated & (rows < 0))
+        rows[added] = table.add(barcodes[added], new_groups.values[added])
+        table.groups[rows[present]] = new_groups.values[present]
+        table.replace(rows[present], rows[cells[keep]], codes[keep])
+        return missing_celltypes
+
+    def _cell_table(self):
+        '''
+        return the incrementally maintained _CellTable of the cells in the hierarchy, built from the graph on first use
+        '''
+        if self._cells is None:
+            self._load_cells()
+            tree = self._celltype_index()
+            table = _CellTable()
+            barcodes = np.array([n for n, t in self.graph.nodes(data='type') if t == 'cell'], dtype=object)
+            rows = dict(zip(barcodes.tolist(), table.add(barcodes, [self.graph.nodes[b].get('group') for b in barcodes])))
+            cells, codes = [], []
+            for celltype in tree.celltypes:
+                for barcode in self.graph.succ[celltype]:
+                    if barcode in rows:
+                        cells.append(rows[barcode])
+                        codes.append(tree.codes[celltype])
+            table.replace([], np.array(cells, dtype=np.int64), np.array(codes, dtype=np.int64))
+            self._cells = table
+        return self._cells
+
+    def _cell_counts(self):
+        '''
+        return the incrementally maintained cell counts, built from all cells in the hierarchy on first use
+        '''
+        if self._counts is None:
+            self._load_cells()
+            tree = self._celltype_index()
+            counts = _CellCounts(tree)
+            barcodes, cells, codes, groups = {}, [], [], []
+            for celltype in tree.celltypes:
+                for barcode in self.graph.succ[celltype]:
+                    if self.graph.nodes[barcode].get('type') != 'cell':
                         continue
-                    # If no path exists between annotations, assume unrelated; add the new annotation
+                    if barcode not in barcodes:
+                        barcodes[barcode] = len(barcodes)
+                        groups.append(self.graph.nodes[barcode].get('group'))
+                    cells.append(barcodes[barcode])
+                    codes.append(tree.codes[celltype])
+            cells, codes = np.array(cells, dtype=np.int64), np.array(codes, dtype=np.int64)
+            counts.update(cells, codes, counts.group_rows(groups)[cells])
+            self._counts = counts
+        return self._counts
+
+    def cell_counts(self):
+        '''
+        number of cells per cell type, maintained incrementally by add_cells
+        returns: pandas.DataFrame, with the cells directly assigned to each cell type ('direct') and the distinct cells
+        assigned to the cell type or any of its subsets ('cumulative')
+        '''
+        import pandas as pd
+
+        counts = self._cell_counts()
+        return pd.DataFrame({'direct': counts.direct.sum(axis=0), 'cumulative': counts.cumulative().sum(axis=0)},
+                            index=pd.Index(counts.tree.celltypes, name='celltype'))
+
+    def composition(self, cumulative=True, normalize=False, node=None):
+        '''
+        cell type composition per group, e.g. per sample, with groups stored by add_cells(groupby=...)
+        cells added without group are reported under the group None
+        cumulative: bool, if True count the distinct cells of each cell type and all of its subsets, if False only cells
+        directly assigned to the cell type
+        normalize: bool, if True return fractions of the cells in each group (or of the cumulative count of node)
+        node: str, only report node and its subsets
+        returns: pandas.DataFrame, groups x cell types
+        '''
+        import pandas as pd
+
+        counts = self._cell_counts()
+        table = counts.cumulative() if cumulative else counts.direct.copy()
+        celltypes = np.arange(len(counts.tree.celltypes))
+        total = counts.n_cells
+        if node is not None:
+            if node not in counts.tree.codes:
+                raise ValueError(f"Cell type '{node}' does not exist in the hierarchy.")
+            code = counts.tree.codes[node]
+            celltypes = np.flatnonzero(counts.cover[:, code])
+            total = counts.cumulative()[:, code]
+        groups = counts.n_cells > 0
+        table, total = table[groups][:, celltypes], total[groups]
+        if normalize:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                table = table / total[:, None]
+        return pd.DataFrame(table, index=pd.Index(counts.groups[groups], name='group'),
+                            columns=pd.Index([counts.tree.celltypes[c] for c in celltypes], name='celltype'))
 
-                # Add the cell to the hierarchy
-                self.graph.add_node(barcode, type='cell')
-                self.graph.add_edge(cell_type, barcode)
-            
     def query_ancestors(self, query_node, adata=None, obs_key='hierarchical_query'):
         '''
         retrieves all cell barcodes belonging to the cell type and all of its subsets
@@ -191,6 +968,7 @@ class Hierarchy:
         '''
         import networkx as nx
         import anndata
+        self._load_cells()
         node_type='cell_type'
         if node_type == self.graph.nodes[query_node]['type']:
             nodes_of_specific_type = [node for node in nx.ancestors(self.graph, query_node) if self.graph.nodes[node]['type'] == node_type]
@@ -222,6 +1000,7 @@ class Hierarchy:
         import networkx as nx
         import anndata
 
+        self._load_cells()
         # Check if all coarse labels are in the graph
         for label in coarse_labels:
             if label not in self.graph.nodes:
@@ -264,6 +1043,7 @@ class Hierarchy:
         cell_type: str, name of the cell type node to query.
         returns: ls, of cell barcodes assigned to the given cell type.
         """
+        self._load_cells()
         # Check if the provided node is a valid cell type
         if cell_type not in self.graph.nodes:
             raise ValueError(f"Cell type '{cell_type}' does not exist in the hierarchy.")
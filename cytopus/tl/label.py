@@ -1,5 +1,9 @@
-#import pandas as pd
-#import csv
+import csv
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+from ..knowledge_base import KnowledgeBase
+from ..knowledge_base.kb_cache import get_cache, make_key
 
 def overlap_coefficient(set_a,set_b):
     '''
@@ -10,7 +14,73 @@ def overlap_coefficient(set_a,set_b):
     overlap = intersect_len/min_len
     return overlap
 
-def label_marker_genes(marker_genes, gs_label_dict, threshold = 0.4):
+#null distributions of overlap counts memoized per gene set size profile, see _null_tails
+_null_cache = {}
+
+
+def _null_chunk(seed, n_universe, n_permutations, marker_sizes, gene_set_sizes):
+    '''
+    histograms of overlap counts of n_permutations random marker sets with gene sets of each size
+    returns: numpy.ndarray of int64 with shape (len(marker_sizes), len(gene_set_sizes), max(marker_sizes) + 1)
+    '''
+    rng = np.random.default_rng(seed)
+    max_size = int(marker_sizes[-1])
+    #a uniformly random ordered draw of max_size genes (identified by their rank in the universe), every prefix of
+    #which is a random marker set of that size; a gene set of size s overlaps it in the draws with rank < s
+    keys = rng.random((n_permutations, n_universe))
+    ranks = np.argpartition(keys, max_size - 1, axis=1)[:, :max_size] if max_size < n_universe else \
+        np.tile(np.arange(n_universe), (n_permutations, 1))
+    ranks = np.take_along_axis(ranks, np.argsort(np.take_along_axis(keys, ranks, axis=1), axis=1), axis=1)
+    hist = np.zeros((len(marker_sizes), len(gene_set_sizes), max_size + 1), dtype=np.int64)
+    offsets = np.arange(n_permutations)[:, None] * n_universe
+    for i, m in enumerate(marker_sizes):
+        #count draws below each gene set size for all permutations at once on offset sorted prefixes
+        prefix = (np.sort(ranks[:, :m], axis=1) + offsets).ravel()
+        counts = np.searchsorted(prefix, gene_set_sizes[None, :] + offsets) - np.arange(n_permutations)[:, None] * m
+        bins = np.arange(len(gene_set_sizes))[None, :] * (max_size + 1) + counts
+        hist[i] = np.bincount(bins.ravel(), minlength=hist[i].size).reshape(hist[i].shape)
+    return hist
+
+
+def _null_tails(n_universe, marker_sizes, gene_set_sizes, n_permutations, seed=0, n_jobs=1, cache=None, chunk_size=100):
+    '''
+    permutation null of the overlap between marker sets and gene sets drawn from a universe of n_universe genes
+    as the number of permutations with an overlap of at least x genes, for every marker set and gene set size;
+    computed once per size profile and cached in memory and in the result cache if enabled
+    returns: numpy.ndarray of int64 with shape (len(marker_sizes), len(gene_set_sizes), max(marker_sizes) + 1)
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    from itertools import repeat
+
+    key = make_key('label_marker_genes_null', n_universe, n_permutations, seed, list(map(int, marker_sizes)),
+                   list(map(int, gene_set_sizes)))
+    if key in _null_cache:
+        return _null_cache[key]
+    result_cache = get_cache(cache)
+    tails = result_cache.get(key) if result_cache is not None else None
+    if tails is None:
+        #fixed chunks with independent seeds, so the null does not depend on n_jobs
+        sizes = [min(chunk_size, n_permutations - i) for i in range(0, n_permutations, chunk_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        args = (seeds, repeat(n_universe), sizes, repeat(marker_sizes), repeat(gene_set_sizes))
+        if n_jobs <= 1 or len(sizes) == 1:
+            hist = sum(map(_null_chunk, *args))
+        else:
+            #chunks run in worker processes, so they scale with n_jobs independently of the GIL
+            n_workers = min(n_jobs, len(sizes))
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                hist = sum(pool.map(_null_chunk, *args, chunksize=max(1, len(sizes) // (4 * n_workers))))
+        tails = np.cumsum(hist[:, :, ::-1], axis=2)[:, :, ::-1]
+        if result_cache is not None:
+            result_cache.put(key, tails)
+    if len(_null_cache) >= 16:
+        del _null_cache[next(iter(_null_cache))]
+    _null_cache[key] = tails
+    return tails
+
+
+def label_marker_genes(marker_genes, gs_label_dict, threshold = 0.4, cache=None, n_permutations=0, universe=None,
+                       alpha=None, seed=0, n_jobs=1):
     '''
     label an array of marker genes using a KnowledgeBase or a dictionary derived from the KnowledgeBase
     returns a dataframe of overlap coefficients for each gene set annotation and marker gene
@@ -19,11 +89,21 @@ def label_marker_genes(marker_genes, gs_label_dict, threshold = 0.4):
     gs_label_dict: cytopus.KnowledgeBase or dict, with gene set names (str) as keys and gene sets (list) as values
     threshold: float, if overlap coefficient > than threshold the factor will be labeled with the gene set name with 
     maximum overlap coefficient
+    cache: None to use the on-disk cache if enabled with cytopus.enable_cache, False to disable caching for this call
+    or a cytopus.knowledge_base.kb_cache.ResultCache
+    n_permutations: int, if > 0 compute empirical p-values of the overlaps from random marker sets of matched size
+    drawn from the gene universe
+    universe: list, genes random marker sets are drawn from (e.g. adata.var_names), None for all genes of the 
+    KnowledgeBase or all genes in gs_label_dict; marker genes and gene sets are restricted to the universe for testing
+    alpha: float, if not None only gene sets with p-value <= alpha are used as labels (requires n_permutations > 0)
+    seed: int, seed of the permutations
+    n_jobs: int, number of worker processes computing the permutations
     
     returns: pandas.DataFrame, with overlap coefficients of factors (rows) and gene sets (columns), indices are relabeled 
-    to the gene set with the maximum overlap coefficient
+    to the gene set with the maximum overlap coefficient; with n_permutations > 0 .attrs['p_values'] holds the p-values
+    of factors and gene sets and .attrs['labels'] the label, overlap coefficient and p-value of every factor
     '''
-    #import numpy as np
+    from ..knowledge_base.kb_index import incidence_matrix
 
     if isinstance(gs_label_dict,KnowledgeBase):
         #collapse annotation dict
@@ -34,41 +114,85 @@ def label_marker_genes(marker_genes, gs_label_dict, threshold = 0.4):
                 if k not in key_list:
                     gs_dict[k]=v
                     key_list.append(k)
-    elif isinstance(gs_label_dict, dict):
+    elif isinstance(gs_label_dict, Mapping):
             for v in gs_label_dict.values():
-                if isinstance(v,dict):
+                if isinstance(v,Mapping):
                     raise ValueError('gs_label_dict is a nested dictionary. gs_label_dict must be a flat/non-nested dictionary with gene set names as keys (str) amd gene sets (lists of strings) as values')
             gs_dict = gs_label_dict
     else:
         raise ValueError('gs_label_dict must be a dictionary or a cytopus.kb.queries.KnowledgeBase object')
+    if alpha is not None and n_permutations <= 0:
+        raise ValueError('alpha requires n_permutations > 0')
 
-    overlap_df = pd.DataFrame()
-    for i, v in pd.DataFrame(marker_genes).T.items():
-        overlap_temp = []
-        gs_names_temp = []
-        for gs_name, gs in gs_dict.items():
-            gene_set = set(gs)
-            marker_set = set(v)
-            #check and remove for nans
-            if 'nan' in gene_set:
-                gene_set.remove('nan')
-            if 'nan' in marker_set:
-                marker_set.remove('nan')
-            if len(gene_set) > 0 and len(marker_set)>0:
-                overlap_temp.append(overlap_coefficient(set(gene_set),set(marker_set)))
+    markers = pd.DataFrame(marker_genes)
+    result_cache = get_cache(cache)
+    if result_cache is not None:
+        cache_key = make_key('label_marker_genes', {k: sorted(map(str, v)) for k, v in gs_dict.items()}, list(gs_dict),
+                             markers.astype(str), threshold, n_permutations,
+                             None if universe is None else sorted(map(str, universe)), alpha, seed)
+        overlap_df = result_cache.get(cache_key)
+        if overlap_df is not None:
+            return overlap_df
+
+    #elements x factors and elements x gene sets incidence matrices, missing genes ('nan', NaN) are dropped
+    gs_names = list(gs_dict)
+    gs_genes = np.array([x for v in gs_dict.values() for x in v], dtype=object)
+    gs_columns = np.repeat(np.arange(len(gs_names)), [len(v) for v in gs_dict.values()])
+    marker_flat = markers.values.astype(object).ravel()
+    marker_columns = np.repeat(np.arange(len(markers)), markers.shape[1])
+    elements = pd.Index(pd.unique(np.concatenate([marker_flat, gs_genes])))
+    marker_matrix = incidence_matrix(elements, marker_columns, marker_flat, len(markers))[0].tocsc()
+    gs_matrix = incidence_matrix(elements, gs_columns, gs_genes, len(gs_names))[0].tocsc()
+
+    intersect = (marker_matrix.T @ gs_matrix).toarray()
+    marker_sizes, gs_sizes = marker_matrix.getnnz(axis=0), gs_matrix.getnnz(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        overlap = intersect / np.minimum(marker_sizes[:, None], gs_sizes[None, :])
+    overlap[(marker_sizes[:, None] == 0) | (gs_sizes[None, :] == 0)] = np.nan
+    overlap_df = pd.DataFrame(overlap, index=markers.index, columns=gs_names)
+
+    eligible = overlap_df > threshold
+    if n_permutations > 0:
+        if universe is None:
+            if isinstance(gs_label_dict, KnowledgeBase):
+                index = gs_label_dict.index
+                universe = [index.names[i] for i in np.flatnonzero(index.node_class_mask(['gene']))]
             else:
-                overlap_temp.append(np.nan)
-            gs_names_temp.append(gs_name)
-        overlap_df_temp = pd.DataFrame(overlap_temp, columns=[i],index=gs_names_temp).T
-        overlap_df = pd.concat([overlap_df,overlap_df_temp])
-    marker_gene_labels = [] #gene sets
-    for marker_set in overlap_df.index:
-        max_overlap = overlap_df.loc[marker_set].sort_values().index[-1]
-        if overlap_df.loc[marker_set].sort_values().values[-1] >threshold:
-            marker_gene_labels.append(max_overlap)
+                universe = gs_genes
+        universe = pd.unique(np.asarray(universe, dtype=object))
+        universe = universe[~(pd.isna(universe) | (universe.astype(str) == 'nan'))]
+        #restrict the sets to the universe, the null of the overlap only depends on the restricted sizes
+        in_universe = np.asarray(elements.isin(universe), dtype=np.float32)
+        marker_u = marker_matrix.T.multiply(in_universe).tocsr()
+        gs_u = gs_matrix.T.multiply(in_universe).tocsr()
+        intersect_u = np.asarray((marker_u @ gs_u.T).todense(), dtype=np.int64)
+        m_sizes, m_index = np.unique(marker_u.getnnz(axis=1), return_inverse=True)
+        s_sizes, s_index = np.unique(gs_u.getnnz(axis=1), return_inverse=True)
+        if len(universe) == 0 or m_sizes[-1] == 0:
+            p_values = np.ones(overlap.shape)
         else:
-            marker_gene_labels.append(marker_set)
-    overlap_df.index = marker_gene_labels     
+            tails = _null_tails(len(universe), m_sizes, s_sizes, n_permutations, seed=seed, n_jobs=n_jobs, cache=cache)
+            p_values = (1 + tails[m_index[:, None], s_index[None, :], intersect_u]) / (1 + n_permutations)
+        p_values[np.isnan(overlap)] = np.nan
+        p_values = pd.DataFrame(p_values, index=markers.index, columns=gs_names)
+        if alpha is not None:
+            eligible &= p_values <= alpha
+
+    #label factors with the eligible gene set of maximum overlap coefficient
+    best = np.where(eligible.values, overlap, -np.inf)
+    label_idx, labeled = best.argmax(axis=1), np.isfinite(best.max(axis=1))
+    marker_gene_labels = [gs_names[i] if ok else factor for factor, i, ok in zip(overlap_df.index, label_idx, labeled)]
+    if n_permutations > 0:
+        rows = np.arange(len(markers))
+        labels = pd.DataFrame({'factor': overlap_df.index, 'label': marker_gene_labels,
+                               'overlap': np.where(labeled, overlap[rows, label_idx], np.nan),
+                               'p_value': np.where(labeled, p_values.values[rows, label_idx], np.nan)})
+        p_values.index = marker_gene_labels
+        overlap_df.attrs['p_values'] = p_values
+        overlap_df.attrs['labels'] = labels
+    overlap_df.index = marker_gene_labels
+    if result_cache is not None:
+        result_cache.put(cache_key, overlap_df)
         
     return overlap_df
 
@@ -129,7 +253,7 @@ def get_gmt(gs_dict,save=False,path=None):
             gs_dict[k]+= [np.nan]*(max_length-len(v))
 
     #transform into df
-    gs_df = pd.DataFrame(gs_dict).T
+    gs_df = pd.DataFrame(dict(gs_dict)).T
     
     if save:
         gs_df.to_csv(path,sep='\t',header=False)
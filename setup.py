@@ -25,6 +25,9 @@ setup(
             'ipython'
         ],
     },
+    entry_points={
+        'console_scripts': ['cytopus=cytopus.cli:main'],
+    },
     include_package_data=True,
     package_data={'cytopus': ['data/*.txt','data/*.h5ad']},
 )
@@ -0,0 +1,136 @@
+'''
+reference implementations of the KnowledgeBase queries on plain networkx, following the cytopus 1.x code paths the
+indexed implementations replace, the tests compare both
+'''
+import networkx as nx
+
+
+def node_classes(graph):
+    '''
+    class of every node, gene sets without a 'class' attribute take it from their process_OF/identity_OF edge
+    '''
+    classes = dict(graph.nodes(data='class'))
+    for u, v, c in graph.edges(data='class'):
+        if classes[u] is None and c in ('process_OF', 'identity_OF'):
+            classes[u] = {'process_OF': 'cellular_process', 'identity_OF': 'identity'}[c]
+    return classes
+
+
+def celltypes(graph):
+    return [n for n, c in graph.nodes(data='class') if c == 'cell_type']
+
+
+def celltype_view(graph):
+    nodes = set(celltypes(graph))
+    return nx.subgraph_view(graph, filter_node=lambda n: n in nodes)
+
+
+def edges_of_class(graph, classes, origin=None, target=None):
+    return [(u, v) for u, v, c in graph.edges(data='class') if c in classes
+            and (origin is None or u in origin) and (target is None or v in target)]
+
+
+def hierarchy(graph, node='all-cells', invert=False, view=None):
+    '''
+    recursive nested hierarchy (cytopus 1.x dropped invert below the first level, here it is passed on)
+    '''
+    view = celltype_view(graph) if view is None else view
+    neighbors = view.successors(node) if invert else view.predecessors(node)
+    return {s: hierarchy(graph, s, invert=invert, view=view) for s in neighbors}
+
+
+def hierarchy_dict(graph):
+    '''
+    nested hierarchy of all root cell types built on the reversed cell type view, as cytopus.tl.hier.get_hierarchy_dict
+    '''
+    def nested(reversed_view, node):
+        return {node: {k: v for child in reversed_view.successors(node) for k, v in nested(reversed_view, child).items()}}
+
+    reversed_view = celltype_view(graph).reverse(copy=True)
+    hierarchy_dict = {}
+    for root in [n for n in reversed_view.nodes if reversed_view.in_degree(n) == 0]:
+        hierarchy_dict.update(nested(reversed_view, root))
+    return hierarchy_dict
+
+
+def processes(graph, gene_sets):
+    gene_sets = set(gene_sets)
+    gene_set_dict = {}
+    for u, v in edges_of_class(graph, ['gene_OF'], origin=gene_sets):
+        if graph.nodes[v].get('class') == 'gene':
+            gene_set_dict.setdefault(u, []).append(v)
+    return gene_set_dict
+
+
+def celltype_processes(graph, celltypes_, global_celltypes=[None], get_parents=True, get_children=True, parent_depth=1,
+                       child_depth=None):
+    view = celltype_view(graph)
+    parents, children = {}, {}
+    for i in celltypes_:
+        if i in view.nodes:
+            if get_parents:
+                parents[i] = list(nx.traversal.bfs_tree(view, i, depth_limit=parent_depth))
+            if get_children:
+                children[i] = list(nx.traversal.bfs_tree(view, i, reverse=True, depth_limit=child_depth))
+        else:
+            if get_parents:
+                parents[i] = {}
+            if get_children:
+                children[i] = [i]
+    all_celltypes = [c for v in list(children.values()) + list(parents.values()) for c in v]
+    all_celltypes = set(all_celltypes + global_celltypes + celltypes_)
+
+    gene_set_edges = edges_of_class(graph, ['process_OF'], target=all_celltypes)
+    celltype_gene_sets = {}
+    for gene_set, celltype in dict(gene_set_edges).items():
+        celltype_gene_sets.setdefault(celltype, []).append(gene_set)
+    gene_set_dict = processes(graph, [x[0] for x in gene_set_edges])
+    process_dict = {k: {gs: gene_set_dict[gs] for gs in v} for k, v in celltype_gene_sets.items()}
+    if global_celltypes != [None]:
+        global_gs = {}
+        for i in global_celltypes:
+            if i in process_dict:
+                global_gs.update(process_dict.pop(i))
+        process_dict['global'] = global_gs
+
+    merged = {}
+    for members in (children, parents):
+        for key, value in members.items():
+            merged_dict = {}
+            for celltype in value:
+                merged_dict.update(process_dict.get(celltype, {}))
+            merged.setdefault(key, {}).update(merged_dict)
+    if not get_children and not get_parents:
+        merged = process_dict
+    if global_celltypes != [None]:
+        merged['global'] = process_dict['global']
+    return merged
+
+
+def identities(graph, celltypes_):
+    gene_set_dict = {}
+    for u, v in edges_of_class(graph, ['gene_OF']):
+        gene_set_dict.setdefault(u, []).append(v)
+    return {v: gene_set_dict[u] for u, v in edges_of_class(graph, ['identity_OF'], target=set(celltypes_))}
+
+
+def add_cells(graph, obs):
+    '''
+    add cells of obs (barcodes as index, annotations as columns) to a Hierarchy graph, one has_path check per pair
+    '''
+    celltypes = [n for n in reversed(list(nx.dfs_postorder_nodes(graph))) if graph.nodes[n]['type'] == 'cell_type']
+    for celltype in celltypes:
+        for barcode in obs.index[obs.astype(str).apply(lambda x: x == celltype).any(axis=1)].tolist():
+            if barcode in graph:
+                current_annotations = [u for u, _ in graph.in_edges(barcode) if graph.nodes[u]['type'] == 'cell_type']
+                skip = False
+                for current_annotation in current_annotations:
+                    if nx.has_path(graph, current_annotation, celltype):
+                        skip = True
+                        break
+                    elif nx.has_path(graph, celltype, current_annotation):
+                        graph.remove_edge(current_annotation, barcode)
+                if skip:
+                    continue
+            graph.add_node(barcode, type='cell')
+            graph.add_edge(celltype, barcode)
@@ -0,0 +1,37 @@
+import pickle
+import warnings
+
+import pytest
+
+import cytopus as cp
+from cytopus.knowledge_base.kb_queries import get_data
+from cytopus.knowledge_base.kb_versions import DEFAULT_VERSION
+
+
+@pytest.fixture(scope='session')
+def default_graph():
+    '''
+    default KnowledgeBase graph as loaded from cytopus/data, shared between tests and never modified
+    '''
+    with open(get_data(DEFAULT_VERSION), 'rb') as f:
+        return pickle.load(f)
+
+
+@pytest.fixture(scope='session')
+def kb(default_graph):
+    '''
+    default KnowledgeBase shared between tests, tests must not modify it (use fresh_kb instead)
+    '''
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return cp.KnowledgeBase(default_graph, verbose=False)
+
+
+@pytest.fixture
+def fresh_kb(default_graph):
+    '''
+    default KnowledgeBase on a private copy of the graph which tests may edit
+    '''
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return cp.KnowledgeBase(default_graph.copy(), verbose=False)
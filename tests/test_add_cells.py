@@ -0,0 +1,129 @@
+import anndata
+import numpy as np
+import pandas as pd
+import pytest
+
+import cytopus as cp
+import baseline
+
+pytestmark = pytest.mark.filterwarnings('ignore:Cell types')
+
+
+def _obs(celltypes, n_cells, seed, offset=0):
+    rng = np.random.default_rng(seed)
+    obs = pd.DataFrame({
+        'coarse': rng.choice(celltypes, n_cells),
+        'fine': rng.choice(celltypes + ['not-a-cell-type'], n_cells),
+    }, index=[f'cell{i}' for i in range(offset, offset + n_cells)])
+    obs.loc[obs.index[::5], 'fine'] = np.nan
+    return obs
+
+
+@pytest.fixture
+def hierarchy_dict(kb):
+    return cp.tl.hier.get_hierarchy_dict(kb)
+
+
+@pytest.fixture
+def celltypes(kb):
+    #a few lineages with ancestors and descendants so that annotations get refined and replaced
+    hierarchy = kb.get_celltype_hierarchy('T')
+    return ['all-cells', 'leuko', 'TNK', 'T', 'B'] + list(hierarchy) + list(hierarchy['abT'])
+
+
+def _cell_edges(hierarchy):
+    return {(u, v) for u, v in hierarchy.graph.edges if hierarchy.graph.nodes[v]['type'] == 'cell'}
+
+
+def test_add_cells_matches_pairwise_has_path(hierarchy_dict, celltypes):
+    hierarchy = cp.tl.hier.Hierarchy(hierarchy_dict)
+    reference = cp.tl.hier.Hierarchy(hierarchy_dict).graph
+    #the second batch overlaps with the first one, its annotations are merged with the stored ones
+    for obs in [_obs(celltypes, 300, 0), _obs(celltypes, 300, 1, offset=150)]:
+        hierarchy.add_cells(anndata.AnnData(obs=obs), obs_columns=['coarse', 'fine'])
+        baseline.add_cells(reference, obs)
+    assert _cell_edges(hierarchy) == {(u, v) for u, v in reference.edges if reference.nodes[v]['type'] == 'cell'}
+
+
+@pytest.mark.parametrize('chunk_size', [1, 64, 100000])
+def test_add_cells_batched_matches_add_cells(hierarchy_dict, celltypes, tmp_path, chunk_size):
+    sources = [_obs(celltypes, 200, 2), _obs(celltypes, 200, 3, offset=100)]
+    path = str(tmp_path / 'cells.h5ad')
+    anndata.AnnData(obs=_obs(celltypes, 100, 4, offset=250)).write_h5ad(path)
+
+    batched = cp.tl.hier.Hierarchy(hierarchy_dict)
+    report = batched.add_cells_batched(iter(sources + [path]), obs_columns=['coarse', 'fine'], chunk_size=chunk_size,
+                                       verbose=False)
+    reference = cp.tl.hier.Hierarchy(hierarchy_dict)
+    for obs in sources + [anndata.read_h5ad(path).obs]:
+        reference.add_cells(anndata.AnnData(obs=obs), obs_columns=['coarse', 'fine'])
+
+    assert _cell_edges(batched) == _cell_edges(reference)
+    assert report['n_cells'].sum() == 500
+    assert report['n_new_cells'].sum() == len({v for _, v in _cell_edges(reference)})
+
+
+def test_obs_files_are_read_in_chunks(celltypes, tmp_path):
+    from cytopus.tl.hierarchy import _read_obs
+    obs = _obs(celltypes, 150, 5)
+    obs['score'] = pd.array([i if i % 7 else None for i in range(150)], dtype='Int64')
+    h5ad, tsv = str(tmp_path / 'cells.h5ad'), str(tmp_path / 'cells.tsv.gz')
+    anndata.AnnData(obs=obs).write_h5ad(h5ad)
+    obs.to_csv(tsv, sep='\t')
+
+    for path, columns in [(h5ad, ['fine', 'score']), (h5ad, None), (tsv, ['fine'])]:
+        chunks = list(_read_obs(path, columns, chunk_size=64))
+        assert [len(c) for c in chunks] == [64, 64, 22]
+        read = pd.concat(chunks)
+        expected = obs if columns is None else obs[columns]
+        assert list(read.columns) == list(expected.columns) and list(read.index) == list(obs.index)
+        assert read['fine'].astype(object).where(read['fine'].notna(), None).tolist() == \
+            expected['fine'].astype(object).where(expected['fine'].notna(), None).tolist()
+    chunks = list(_read_obs(h5ad, ['fine', 'score'], chunk_size=64))
+    #categorical columns keep the categories of the whole column in every chunk
+    assert all(list(c['fine'].cat.categories) == list(chunks[0]['fine'].cat.categories) for c in chunks)
+    assert pd.concat(chunks)['score'].isna().tolist() == obs['score'].isna().tolist()
+
+
+def test_add_cells_batched_reads_csv_tables(hierarchy_dict, celltypes, tmp_path):
+    obs = _obs(celltypes, 200, 6)
+    obs['sample'] = np.where(np.arange(200) < 120, 's1', 's2')
+    path = str(tmp_path / 'cells.csv')
+    obs.to_csv(path)
+
+    batched = cp.tl.hier.Hierarchy(hierarchy_dict)
+    report = batched.add_cells_batched(path, obs_columns=['coarse', 'fine'], chunk_size=64, verbose=False, groupby='sample')
+    reference = cp.tl.hier.Hierarchy(hierarchy_dict)
+    reference.add_cells(anndata.AnnData(obs=obs), obs_columns=['coarse', 'fine'], groupby='sample')
+    assert list(report['n_cells']) == [64, 64, 64, 8]
+    assert _cell_edges(batched) == _cell_edges(reference)
+    assert batched.composition().equals(reference.composition())
+
+
+def test_cell_table_follows_the_graph(hierarchy_dict, celltypes):
+    hierarchy = cp.tl.hier.Hierarchy(hierarchy_dict)
+    for seed, offset, group in [(7, 0, 's1'), (8, 100, 's2'), (9, 50, None)]:
+        obs = _obs(celltypes, 150, seed, offset=offset)
+        obs['sample'] = group
+        hierarchy.add_cells(anndata.AnnData(obs=obs), obs_columns=['coarse', 'fine'], groupby='sample')
+
+    def contents(table):
+        edges = {(hierarchy._celltype_index().celltypes[c], table.barcodes[r]) for r, c in zip(table.cells, table.codes)}
+        return edges, dict(zip(table.barcodes, table.groups))
+
+    incremental = hierarchy._cell_table()
+    hierarchy._cells = None
+    rebuilt = hierarchy._cell_table()
+    assert contents(incremental) == contents(rebuilt)
+    assert contents(incremental)[0] == _cell_edges(hierarchy)
+    assert contents(incremental)[1] == {v: hierarchy.graph.nodes[v].get('group') for _, v in _cell_edges(hierarchy)}
+
+
+def test_cell_table_resolves_hash_collisions():
+    from cytopus.tl.hierarchy import _CellTable
+    table = _CellTable()
+    #non-string barcodes are hashed through their string, 1 and '1' share a hash
+    table.add(np.array([1, 'a'], dtype=object), [None, None])
+    assert table.lookup(np.array(['1', 1, 'a', 'b'], dtype=object)).tolist() == [-1, 0, 1, -1]
+    table.add(np.array(['1'], dtype=object), ['s1'])
+    assert table.lookup(np.array(['1', 1, 'a'], dtype=object)).tolist() == [2, 0, 1]
@@ -0,0 +1,46 @@
+import itertools
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+import cytopus as cp
+
+
+def _status(graph, labels):
+    '''
+    classify the annotations of one cell with has_path checks on every pair
+    '''
+    labels = [x for x in labels if isinstance(x, str) and x in graph]
+    if not labels:
+        return 'unannotated'
+    status = 'consistent'
+    for a, b in itertools.combinations(labels, 2):
+        if a == b:
+            continue
+        if nx.has_path(graph, a, b) or nx.has_path(graph, b, a):
+            status = 'refinable' if status == 'consistent' else status
+        else:
+            return 'conflicting'
+    return status
+
+
+def test_annotation_conflicts_match_pairwise_paths(kb):
+    hierarchy = cp.tl.hier.Hierarchy(cp.tl.hier.get_hierarchy_dict(kb))
+    rng = np.random.default_rng(0)
+    celltypes = ['all-cells', 'leuko', 'TNK', 'T', 'abT', 'CD8-T', 'CD4-T', 'B', 'B-naive', 'M', 'mono', 'unknown', np.nan]
+    obs = pd.DataFrame({c: rng.choice(np.array(celltypes, dtype=object), 400) for c in ['a', 'b', 'c']},
+                       index=[f'cell{i}' for i in range(400)])
+
+    result = hierarchy.annotation_conflicts(obs, ['a', 'b', 'c'])
+    expected = [_status(hierarchy.graph, row) for row in obs.itertuples(index=False)]
+    assert result['status'].astype(str).tolist() == expected
+    assert set(result['conflicting_cells']) == {c for c, s in zip(obs.index, expected) if s == 'conflicting'}
+
+    pair = result['column_pairs'].iloc[0]
+    expected_pair = [_status(hierarchy.graph, row) for row in obs[['a', 'b']].itertuples(index=False)]
+    assert pair['n_conflicting'] == expected_pair.count('conflicting')
+    assert pair['n_refinable'] == expected_pair.count('refinable')
+    label_pairs = result['label_pairs']
+    assert label_pairs[(label_pairs['column_a'] == 'a') & (label_pairs['column_b'] == 'b')]['n_cells'].sum() == \
+        pair['n_refinable'] + pair['n_conflicting']
@@ -0,0 +1,79 @@
+import anndata
+import networkx as nx
+import numpy as np
+import pandas as pd
+import pytest
+
+import cytopus as cp
+
+pytestmark = pytest.mark.filterwarnings('ignore:Cell types')
+
+
+def _adata(celltypes, n_cells, seed, offset=0):
+    rng = np.random.default_rng(seed)
+    obs = pd.DataFrame({
+        'coarse': rng.choice(celltypes, n_cells),
+        'fine': rng.choice(celltypes, n_cells),
+        'sample': rng.choice(['s1', 's2', 's3'], n_cells),
+    }, index=[f'cell{i}' for i in range(offset, offset + n_cells)])
+    return anndata.AnnData(obs=obs)
+
+
+def _reference(hierarchy):
+    '''
+    direct and cumulative cell counts per group recounted from the graph with networkx
+    '''
+    graph = hierarchy.graph
+    celltypes = [n for n, t in graph.nodes(data='type') if t == 'cell_type']
+    cells = [n for n, t in graph.nodes(data='type') if t == 'cell']
+    rows = []
+    for cell in cells:
+        for label in graph.pred[cell]:
+            rows.append({'cell': cell, 'group': graph.nodes[cell].get('group'), 'celltype': label})
+    rows = pd.DataFrame(rows)
+    direct = rows.groupby(['group', 'celltype']).size().unstack(fill_value=0)
+    direct = direct.reindex(columns=celltypes, fill_value=0)
+    cumulative = {}
+    for celltype in celltypes:
+        subtree = {celltype} | {n for n in nx.ancestors(graph, celltype) if graph.nodes[n]['type'] == 'cell_type'}
+        cumulative[celltype] = rows[rows['celltype'].isin(subtree)].drop_duplicates('cell').groupby('group').size()
+    cumulative = pd.DataFrame(cumulative).reindex(index=direct.index, columns=celltypes).fillna(0).astype(int)
+    return direct, cumulative
+
+
+@pytest.fixture
+def hierarchy(kb):
+    hierarchy = cp.tl.hier.Hierarchy(cp.tl.hier.get_hierarchy_dict(kb))
+    hierarchy.cell_counts()
+    return hierarchy
+
+
+def test_incremental_counts_match_recount(kb, hierarchy):
+    celltypes = ['all-cells', 'leuko', 'TNK', 'T', 'abT', 'CD8-T', 'CD4-T', 'B', 'B-naive', 'M', 'mono']
+    #overlapping batches refine, add and regroup cells after the counts were built
+    for seed, offset in [(0, 0), (1, 100), (2, 50)]:
+        hierarchy.add_cells(_adata(celltypes, 200, seed, offset), obs_columns=['coarse', 'fine'], groupby='sample')
+    direct, cumulative = _reference(hierarchy)
+
+    counts = hierarchy.cell_counts()
+    np.testing.assert_array_equal(counts['direct'].values, direct.sum(axis=0).values)
+    composition = hierarchy.composition()
+    for group in cumulative.index:
+        np.testing.assert_array_equal(composition.loc[group].values, cumulative.loc[group].values)
+    np.testing.assert_array_equal(hierarchy.composition(cumulative=False).values.sum(axis=0), direct.sum(axis=0).values)
+
+    #the incremental counts equal counts built from scratch on the same graph
+    rebuilt = cp.tl.hier.Hierarchy.__new__(cp.tl.hier.Hierarchy)
+    rebuilt.graph = hierarchy.graph
+    pd.testing.assert_frame_equal(rebuilt.cell_counts(), counts)
+    pd.testing.assert_frame_equal(rebuilt.composition().sort_index(), hierarchy.composition().sort_index())
+
+
+def test_normalized_composition_of_node(hierarchy):
+    celltypes = ['T', 'abT', 'CD8-T', 'CD4-T', 'B']
+    hierarchy.add_cells(_adata(celltypes, 300, 3), obs_columns=['coarse'], groupby='sample')
+    composition = hierarchy.composition(node='T', normalize=True)
+    np.testing.assert_allclose(composition['T'].values, 1)
+    assert set(composition.columns) == {'T'} | set(nx.ancestors(hierarchy.graph, 'T')) & set(composition.columns)
+    with pytest.raises(ValueError):
+        hierarchy.composition(node='not-a-cell-type')
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cytopus.cli import main
+from cytopus.tl.label import label_marker_genes
+
+
+@pytest.fixture
+def marker_files(kb, tmp_path):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(3):
+        gene_sets = rng.choice(sorted(kb.processes), 4)
+        #factors made of the genes of one gene set each, so that they get labeled
+        markers = pd.DataFrame([rng.permutation(kb.processes[g] + ['X'] * 50)[:50] for g in gene_sets],
+                               index=[f'factor{j}' for j in range(4)])
+        paths.append(str(tmp_path / f'sample{i}.csv'))
+        markers.to_csv(paths[-1])
+    return paths
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_label_files_match_label_marker_genes(kb, marker_files, tmp_path, workers):
+    out_dir = tmp_path / f'labels{workers}'
+    main(['label', *marker_files, '--out-dir', str(out_dir), '--workers', str(workers), '--timings', str(tmp_path / 't.csv')])
+    timings = pd.read_csv(tmp_path / 't.csv')
+    assert sorted(timings['input']) == sorted(marker_files)
+    for path in marker_files:
+        markers = pd.read_csv(path, index_col=0)
+        expected = label_marker_genes(markers.values, kb.processes, threshold=0.4)
+        result = pd.read_csv(out_dir / (path.split('/')[-1][:-4] + '_labels.csv'), index_col=0)
+        np.testing.assert_allclose(result.values, expected.values)
+        labeled = [x for x in expected.index if x in kb.processes]
+        assert [x for x in result.index if x in kb.processes] == labeled
+        assert timings.loc[timings['input'] == path, 'n_labeled'].item() == len(labeled)
+
+
+def test_export_gmt_matches_processes(kb, tmp_path):
+    path = str(tmp_path / 'processes.gmt')
+    main(['export', 'processes', path])
+    exported = pd.read_csv(path, sep='\t', header=None, index_col=0)
+    assert {k: [g for g in v if isinstance(g, str)] for k, v in zip(exported.index, exported.values.tolist())} == kb.processes
+
+
+def test_exported_gene_sets_are_copies(fresh_kb, tmp_path):
+    from cytopus.cli import _select_gene_sets
+    from cytopus.tl.label import get_gmt
+    processes = {k: list(v) for k, v in fresh_kb.processes.items()}
+    get_gmt(_select_gene_sets(fresh_kb, 'all'), save=True, path=str(tmp_path / 'all.gmt'))
+    assert fresh_kb.processes == processes
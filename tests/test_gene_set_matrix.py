@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+import baseline
+
+
+def _var_names(kb, seed=0):
+    rng = np.random.default_rng(seed)
+    genes = sorted({g for v in kb.processes.values() for g in v})
+    var_names = list(rng.choice(genes, len(genes) // 2, replace=False)) + ['NOT-A-GENE']
+    return var_names + var_names[:10]
+
+
+def _reference(var_names, gene_sets):
+    '''
+    dense var_names x gene sets matrix with pandas, duplicated var names only match at their first occurrence
+    '''
+    var_names = pd.Index(var_names)
+    first = ~var_names.duplicated()
+    columns = [first & np.isin(var_names, list(genes)) for genes in gene_sets.values()]
+    return np.array(columns, dtype=np.float32).reshape(len(gene_sets), len(var_names)).T
+
+
+def test_matrix_of_all_gene_sets(kb):
+    var_names = _var_names(kb)
+    result = kb.gene_set_matrix(var_names)
+    names = result['gene_sets']['gene_set'].tolist()
+    classes = baseline.node_classes(kb.graph)
+    reference = baseline.processes(kb.graph, names)
+    assert set(names) == {u for u, v, c in kb.graph.edges(data='class') if c == 'gene_OF'}
+    np.testing.assert_array_equal(result['matrix'].toarray(), _reference(var_names, {k: reference.get(k, []) for k in names}))
+    assert result['gene_sets']['gene_set_class'].tolist() == [classes[x] for x in names]
+    found = set(var_names)
+    assert result['missing_genes'] == sorted({g for v in reference.values() for g in v} - found)
+
+
+def test_matrix_of_celltype_processes(kb):
+    var_names = _var_names(kb, 1)
+    processes = kb.get_celltype_processes(['T', 'B'], global_celltypes=['all-cells'], inplace=False, cache=False)
+    result = kb.gene_set_matrix(var_names, processes)
+    flat = [(c, k, v) for c, d in processes.items() for k, v in d.items()]
+    assert result['gene_sets'][['celltype', 'gene_set']].values.tolist() == [[c, k] for c, k, _ in flat]
+    columns = {f'{c}:{k}': v for c, k, v in flat}
+    np.testing.assert_array_equal(result['matrix'].toarray(), _reference(var_names, columns))
+    assert result['gene_sets']['n_genes_found'].tolist() == [len(set(v) & set(var_names)) for _, _, v in flat]
+
+
+def test_matrix_is_memoized_and_follows_edits(fresh_kb):
+    G = fresh_kb
+    var_names = _var_names(G)
+    gene_set = next(iter(G.processes))
+    first = G.gene_set_matrix(var_names, [gene_set])
+    assert G.gene_set_matrix(var_names, [gene_set])['matrix'] is first['matrix']
+    gene = next(g for g in var_names if g not in G.processes[gene_set] and G.graph.has_node(g))
+    G.graph.add_edge(gene_set, gene, **{'class': 'gene_OF'})
+    G.invalidate()
+    edited = G.gene_set_matrix(var_names, [gene_set])
+    assert edited['matrix'].sum() == first['matrix'].sum() + 1
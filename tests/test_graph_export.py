@@ -0,0 +1,104 @@
+import networkx as nx
+import numpy as np
+import pytest
+
+import baseline
+
+
+def _graph_edges(graph_json):
+    names = [n[0] for n in graph_json['nodes']]
+    return {(names[u], names[v]) for u, v in graph_json['edges']}
+
+
+@pytest.mark.parametrize('attributes', [['cell_type', 'cellular_process'], ['cell_type', 'cellular_process', 'gene']])
+def test_graph_json_matches_subgraph(kb, attributes):
+    colors = ['red', 'blue', 'green'][:len(attributes)]
+    graph_json = kb.get_graph_json(attributes=attributes, colors=colors, aggregate_genes=False)
+    classes = baseline.node_classes(kb.graph)
+    nodes = {n for n, c in classes.items() if c in attributes}
+    view = nx.subgraph_view(kb.graph, filter_node=lambda n: n in nodes)
+
+    assert [n[0] for n in graph_json['nodes']] == [n for n in kb.graph.nodes if n in nodes]
+    assert all(classes[n] == attributes[c] for n, c, _ in graph_json['nodes'])
+    assert _graph_edges(graph_json) == set(view.edges)
+
+
+def test_graph_json_aggregates_genes_into_gene_sets(kb):
+    graph_json = kb.get_graph_json(attributes=['cell_type', 'cellular_process', 'gene'], colors=['red', 'blue', 'green'])
+    classes = baseline.node_classes(kb.graph)
+    reference = baseline.processes(kb.graph, [n for n, c in classes.items() if c in ('cell_type', 'cellular_process')])
+
+    assert all(graph_json['classes'][n[1]] != 'gene' for n in graph_json['nodes'])
+    for position, chunk in graph_json['chunks'].items():
+        name, _, n_genes = graph_json['nodes'][position]
+        assert n_genes == len(chunk)
+        assert sorted(graph_json['genes'][g] for g in chunk) == sorted(reference.get(name, []))
+    assert sum(n[2] for n in graph_json['nodes']) == sum(len(v) for k, v in reference.items())
+
+
+def test_plot_graph_interactive_pins_vis_network(kb, tmp_path):
+    from cytopus.knowledge_base.kb_queries import _VIS_NETWORK_URL
+
+    save_path = str(tmp_path / 'graph.html')
+    kb.plot_graph_interactive(save_path=save_path)
+    html = open(save_path).read()
+    assert '<script src="' + _VIS_NETWORK_URL + '"></script>' in html
+    assert '@' in _VIS_NETWORK_URL
+
+    local_js = tmp_path / 'vis-network.min.js'
+    local_js.write_text('var vis = {};')
+    kb.plot_graph_interactive(save_path=save_path, vis_js=str(local_js))
+    html = open(save_path).read()
+    assert '<script>var vis = {};</script>' in html and 'unpkg' not in html
+
+    with pytest.raises(ValueError):
+        kb.plot_graph_interactive(save_path=save_path, backend='graphviz')
+
+
+def test_plot_graph_interactive_pyvis_backend(kb, tmp_path):
+    pytest.importorskip('pyvis')
+    save_path = str(tmp_path / 'graph.html')
+    kb.plot_graph_interactive(save_path=save_path, backend='pyvis')
+    assert 'vis.Network' in open(save_path).read()
+
+
+def test_index_follows_same_count_graph_edits(fresh_kb):
+    G = fresh_kb
+    graph = G.graph
+    gene_set, celltype = next((u, v) for u, v, c in graph.edges(data='class') if c == 'process_OF' and v != 'B')
+    target = 'B'
+    n_nodes, n_edges = graph.number_of_nodes(), graph.number_of_edges()
+    before = G.get_celltype_processes([target], get_parents=False, get_children=False, inplace=False, cache=False)
+    assert gene_set not in before.get(target, {})
+
+    #move the gene set from one cell type to another, keeping the number of nodes and edges
+    graph.remove_edge(gene_set, celltype)
+    graph.add_edge(gene_set, target, **{'class': 'process_OF'})
+    assert (graph.number_of_nodes(), graph.number_of_edges()) == (n_nodes, n_edges)
+    G.invalidate()
+
+    after = G.get_celltype_processes([target], get_parents=False, get_children=False, inplace=False, cache=False)
+    reference = baseline.celltype_processes(graph, [target], get_parents=False, get_children=False)
+    assert gene_set in after[target]
+    assert {k: dict(v) for k, v in after.items()} == reference
+
+
+def test_index_follows_node_attribute_edits(fresh_kb):
+    G = fresh_kb
+    index = G.index
+    gene_set = next(u for u, v, c in G.graph.edges(data='class') if c == 'process_OF')
+    G.graph.nodes[gene_set]['class'] = 'cell_type'
+    #reads keep the index until it is invalidated
+    assert G.index is index
+    G.invalidate()
+    assert G.index is not index
+    index = G.index
+    assert gene_set in [index.names[i] for i in np.flatnonzero(index.node_class_mask(['cell_type']))]
+
+
+def test_index_follows_graph_replacement(fresh_kb, default_graph):
+    G = fresh_kb
+    index = G.index
+    G.graph = default_graph.copy()
+    assert G.index is not index
+    assert G.index.names == index.names
@@ -0,0 +1,59 @@
+import pickle
+
+import anndata
+import numpy as np
+import pandas as pd
+import pytest
+
+import cytopus as cp
+
+#cell type labels missing from the hierarchy are warned about and skipped
+pytestmark = pytest.mark.filterwarnings('ignore:Cell types')
+
+
+def _obs(hierarchy, n_cells, seed, prefix='cell'):
+    rng = np.random.default_rng(seed)
+    celltypes = sorted(n for n, t in hierarchy.graph.nodes(data='type') if t == 'cell_type')
+    obs = pd.DataFrame({
+        'coarse': rng.choice(celltypes, n_cells),
+        'fine': rng.choice(celltypes + ['not-a-cell-type'], n_cells),
+        'sample': rng.choice(['s1', 's2', 's3'], n_cells),
+    }, index=[f'{prefix}{i}' for i in range(n_cells)])
+    obs.loc[obs.index[::7], 'fine'] = np.nan
+    return anndata.AnnData(obs=obs)
+
+
+@pytest.fixture
+def hierarchy(kb):
+    hierarchy = cp.tl.hier.Hierarchy(cp.tl.hier.get_hierarchy_dict(kb))
+    hierarchy.add_cells(_obs(hierarchy, 500, 0), obs_columns=['coarse', 'fine'], groupby='sample')
+    return hierarchy
+
+
+def _graph_state(hierarchy):
+    return (set(hierarchy.graph.nodes(data='type')), set(hierarchy.graph.edges),
+            {n: g for n, g in hierarchy.graph.nodes(data='group') if g is not None})
+
+
+@pytest.mark.parametrize('load_cells,mmap', [(True, False), (False, False), (False, True)])
+def test_save_load_round_trip(hierarchy, tmp_path, load_cells, mmap):
+    path = str(tmp_path / 'hierarchy.cyh')
+    hierarchy.save(path)
+    loaded = cp.tl.hier.Hierarchy.load(path, load_cells=load_cells, mmap=mmap)
+    pd.testing.assert_frame_equal(loaded.cell_counts(), hierarchy.cell_counts())
+    assert _graph_state(loaded) == _graph_state(hierarchy)
+
+
+def test_unpickles_hierarchy_pickled_before_cell_containers(hierarchy):
+    #a Hierarchy pickled by cytopus 1.x only has the graph in its __dict__
+    old = cp.tl.hier.Hierarchy.__new__(cp.tl.hier.Hierarchy)
+    old.graph = hierarchy.graph.copy()
+    old = pickle.loads(pickle.dumps(old))
+    assert set(old.__dict__) == {'graph'}
+
+    pd.testing.assert_frame_equal(old.cell_counts(), hierarchy.cell_counts())
+    old.add_cells(_obs(old, 50, 1, prefix='new'), obs_columns=['coarse', 'fine'])
+    recounted = cp.tl.hier.Hierarchy.__new__(cp.tl.hier.Hierarchy)
+    recounted.graph = old.graph
+    pd.testing.assert_frame_equal(old.cell_counts(), recounted.cell_counts())
+    assert old.cell_counts()['cumulative']['all-cells'] == hierarchy.cell_counts()['cumulative']['all-cells'] + 50
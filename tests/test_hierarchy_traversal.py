@@ -0,0 +1,82 @@
+import networkx as nx
+import pytest
+
+import cytopus as cp
+import baseline
+
+
+def _traversal(index, node, invert=False, depth=None):
+    codes, parents = index.traverse_hierarchy(node, invert=invert, depth=depth)
+    names = [index.names[c] for c in codes.tolist()]
+    return names, [node if p < 0 else names[p] for p in parents.tolist()]
+
+
+@pytest.mark.parametrize('depth', [None, 1, 2])
+def test_traversal_matches_bfs_tree(kb, depth):
+    view = nx.DiGraph(baseline.celltype_view(kb.graph))
+    index = kb.index
+    for node in kb.celltypes:
+        for invert in (False, True):
+            tree = nx.traversal.bfs_tree(view, node, reverse=not invert, depth_limit=depth)
+            names, parents = _traversal(index, node, invert=invert, depth=depth)
+            assert set(names) == set(tree.nodes) - {node}
+            assert len(names) == len(set(names))
+            assert {(p, n) for n, p in zip(names, parents)} == set(tree.edges)
+
+
+def test_nested_hierarchy_matches_recursive_extraction(kb):
+    for node in ['all-cells', 'T', 'B', 'M']:
+        assert kb.get_celltype_hierarchy(node) == baseline.hierarchy(kb.graph, node)
+        assert kb.get_celltype_hierarchy(node, invert=True) == baseline.hierarchy(kb.graph, node, invert=True)
+    assert cp.tl.hier.get_hierarchy_dict(kb) == {'all-cells': baseline.hierarchy(kb.graph, 'all-cells')}
+
+
+def test_traversal_visits_shared_descendants_once(fresh_kb):
+    G = fresh_kb
+    #give a cell type with descendants a second parent, turning the hierarchy into a DAG
+    child = next(c for c in G.celltypes if c != 'all-cells' and list(G.graph.predecessors(c))
+                 and G.graph.nodes[next(iter(G.graph.predecessors(c)))].get('class') == 'cell_type')
+    second_parent = next(c for c in G.celltypes if c not in G.get_celltype_hierarchy(child, invert=True) and c != child
+                         and child not in nx.ancestors(G.graph, c))
+    G.graph.add_edge(child, second_parent, **{'class': 'SUBSET_OF'})
+    G.invalidate()
+
+    names, parents = _traversal(G.index, 'all-cells')
+    tree = nx.traversal.bfs_tree(baseline.celltype_view(G.graph), 'all-cells', reverse=True)
+    assert len(names) == len(set(names)) == len(tree) - 1
+    assert {(p, n) for n, p in zip(names, parents)} == set(tree.edges)
+
+
+def test_traversal_terminates_on_cycles(fresh_kb):
+    G = fresh_kb
+    G.graph.add_edge('all-cells', 'T', **{'class': 'SUBSET_OF'})
+    G.invalidate()
+    names, _ = _traversal(G.index, 'T')
+    assert 'all-cells' in names and 'T' not in names
+
+
+def test_repeated_hierarchy_queries_are_memoized(fresh_kb, monkeypatch):
+    from cytopus.knowledge_base import kb_index, kb_queries
+
+    G = fresh_kb
+    first = G.get_celltype_hierarchy('T')
+    index = G.index
+    calls = {'index': 0, 'gather': 0}
+
+    def count(name, function):
+        def counted(*args, **kwargs):
+            calls[name] += 1
+            return function(*args, **kwargs)
+        return counted
+
+    #neither the graph is indexed again nor the hierarchy traversed again
+    monkeypatch.setattr(kb_queries, 'KBIndex', count('index', kb_queries.KBIndex))
+    monkeypatch.setattr(kb_index, 'csr_gather', count('gather', kb_index.csr_gather))
+    for _ in range(20):
+        assert G.get_celltype_hierarchy('T') == first
+    assert calls == {'index': 0, 'gather': 0}
+    assert G.index is index
+
+    G.invalidate()
+    assert G.get_celltype_hierarchy('T') == first
+    assert calls['index'] == 1 and calls['gather'] > 0
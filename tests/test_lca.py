@@ -0,0 +1,66 @@
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+import cytopus as cp
+import baseline
+from cytopus.knowledge_base.kb_index import TreeLCA
+
+
+def _reference(tree, a, b):
+    '''
+    lowest common ancestor and distance with networkx, on a tree with edges from parent to child
+    '''
+    if a not in tree or b not in tree:
+        return np.nan, -1
+    lca = nx.lowest_common_ancestor(tree, a, b)
+    if lca is None:
+        return np.nan, -1
+    return lca, nx.shortest_path_length(tree, lca, a) + nx.shortest_path_length(tree, lca, b)
+
+
+def _pairs(kb, n):
+    rng = np.random.default_rng(0)
+    celltypes = np.array(sorted(kb.celltypes) + ['unknown'], dtype=object)
+    a, b = rng.choice(celltypes, n), rng.choice(celltypes, n)
+    #same cell type, root and cell type pairs and missing values
+    a[:3], b[:3] = ['T', 'all-cells', 'CD8-T'], ['T', 'CD8-T', 'all-cells']
+    a[3] = np.nan
+    return a, b
+
+
+def test_lca_matches_networkx(kb):
+    tree = nx.DiGraph(baseline.celltype_view(kb.graph)).reverse()
+    a, b = _pairs(kb, 1000)
+    result = kb.lowest_common_ancestor(a, b)
+    expected = [_reference(tree, x, y) for x, y in zip(a, b)]
+    assert result['lca'].astype(object).fillna('missing').tolist() == [x[0] if x[1] >= 0 else 'missing' for x in expected]
+    assert result['distance'].tolist() == [x[1] for x in expected]
+
+
+def test_lca_of_categorical_labels(kb):
+    a, b = _pairs(kb, 200)
+    plain = kb.lowest_common_ancestor(a, b)
+    categorical = kb.lowest_common_ancestor(pd.Series(a, dtype='category'), pd.Categorical(b))
+    pd.testing.assert_frame_equal(plain, categorical)
+
+
+def test_hierarchy_lca_matches_knowledge_base(kb):
+    hierarchy = cp.tl.hier.Hierarchy(cp.tl.hier.get_hierarchy_dict(kb))
+    a, b = _pairs(kb, 300)
+    pd.testing.assert_frame_equal(hierarchy.lowest_common_ancestor(a, b).reset_index(drop=True)[['distance']],
+                                  kb.lowest_common_ancestor(a, b)[['distance']])
+    assert (hierarchy.lowest_common_ancestor(a, b)['lca'].astype(str).values ==
+            kb.lowest_common_ancestor(a, b)['lca'].astype(str).values).all()
+
+
+def test_forest_and_deep_paths():
+    #two trees: a path of 100 nodes and a small tree
+    names = [f'p{i}' for i in range(100)] + ['r', 'x', 'y']
+    parents = [-1] + list(range(99)) + [-1, 100, 100]
+    lca = TreeLCA(names, np.array(parents))
+    codes = np.array([99, 50, 101, 99, 0])
+    other = np.array([10, 50, 102, 101, -1])
+    result, distance = lca.lca_codes(codes, other)
+    assert result.tolist() == [10, 50, 100, -1, -1]
+    assert distance.tolist() == [89, 0, 2, -1, -1]
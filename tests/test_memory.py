@@ -0,0 +1,44 @@
+import json
+
+import baseline
+from cytopus.knowledge_base.kb_genesets import deep_sizeof
+
+
+def test_gene_set_attributes_are_plain_dicts(fresh_kb, tmp_path):
+    G = fresh_kb
+    G.get_celltype_processes(['T', 'B'], global_celltypes=['all-cells'], cache=False)
+    for gene_sets in [G.processes, G.identities, G.celltype_process_dict, G.celltype_process_dict['T']]:
+        assert type(gene_sets) is dict
+    assert all(type(v) is list for v in G.processes.values())
+    json.dump(G.celltype_process_dict, open(tmp_path / 'gene_sets.json', 'w'))
+
+    gene_set = next(iter(G.processes))
+    G.processes[gene_set].append('NEWGENE')
+    assert G.processes[gene_set][-1] == 'NEWGENE'
+
+
+def test_gene_sets_match_networkx(kb):
+    classes = baseline.node_classes(kb.graph)
+    gene_sets = {u for u, v, c in kb.graph.edges(data='class') if c == 'process_OF' and classes[v] == 'cell_type'}
+    assert kb.processes == baseline.processes(kb.graph, gene_sets)
+    assert kb.identities == baseline.identities(kb.graph, kb.celltypes)
+
+
+def test_gene_names_are_shared_with_the_graph(kb):
+    nodes = {id(n) for n in kb.graph.nodes}
+    assert all(id(g) in nodes for genes in kb.processes.values() for g in genes)
+    result = kb.get_celltype_processes(['T', 'CD8-T'], inplace=False, cache=False)
+    shared = set(result['T']) & set(result['CD8-T'])
+    assert shared and all(result['T'][k] is result['CD8-T'][k] for k in shared)
+
+
+def test_loading_does_not_build_the_index(default_graph):
+    import cytopus as cp
+    G = cp.KnowledgeBase(default_graph, verbose=False)
+    assert getattr(G, '_index', None) is None
+    seen = set()
+    deep_sizeof(G.graph, seen)
+    #gene set dictionaries only hold lists referencing the graph's gene names
+    assert deep_sizeof(G, seen) < 0.2 * 2**20
+    usage = G.memory_usage()
+    assert usage.loc['index', 'bytes'] == 0 and usage.loc['total', 'bytes'] == usage['bytes'].iloc[:-1].sum()
@@ -0,0 +1,88 @@
+import math
+
+import numpy as np
+import pytest
+
+import cytopus as cp
+from cytopus.knowledge_base.kb_names import METHOD_SCORES, normalize_names
+
+import baseline
+
+KINDS = {'cell_type': 'celltype', 'gene': 'gene'}
+
+
+def _trigram_set(name):
+    padded = f' {name} '
+    return {padded[j:j + 3] for j in range(len(padded) - 2)}
+
+
+def _best_fuzzy(label, names):
+    '''
+    brute force best cosine similarity of character trigrams between a label and names
+    '''
+    query = _trigram_set(normalize_names([label])[0])
+    best = 0
+    for name in normalize_names(names):
+        grams = _trigram_set(name)
+        best = max(best, len(query & grams) / math.sqrt(len(query) * len(grams)))
+    return best
+
+
+def test_exact_names_and_kinds(kb, default_graph):
+    classes = baseline.node_classes(default_graph)
+    names = list(default_graph.nodes)[::7]
+    result = kb.resolve_names(names)
+    assert list(result['label']) == names
+    assert list(result['match']) == names
+    assert (result['method'] == 'exact').all()
+    assert list(result['kind']) == [KINDS.get(classes[n], 'gene_set') for n in names]
+
+
+def test_normalized_and_kind_filter(kb, default_graph):
+    celltypes = baseline.celltypes(default_graph)
+    labels = [c.upper().replace('-', ' ') for c in celltypes if '-' in c][:20] + ['Endo_Lymphatics', 'cDC1s']
+    result = kb.resolve_names(labels, kinds=['celltype'], fuzzy=False)
+    expected = {normalize_names([c])[0]: c for c in celltypes}
+    for label, match, method in zip(result['label'], result['match'], result['method']):
+        assert method == 'normalized'
+        assert match == expected[normalize_names([label])[0]]
+    assert list(result['match'][-2:]) == ['endo-lymphatic', 'cDC1']
+    assert set(result['kind']) == {'celltype'}
+
+
+def test_fuzzy_matches_brute_force(kb, default_graph):
+    celltypes = baseline.celltypes(default_graph)
+    labels = ['monocyts classical', 'CD8 effector memmory', 'plasmablast IgG', 'dendritc']
+    result = kb.resolve_names(labels, kinds=['celltype'], min_score=0.3)
+    for label, method, score in zip(result['label'], result['method'], result['score']):
+        if method == 'fuzzy':
+            assert score == pytest.approx(_best_fuzzy(label, celltypes) * METHOD_SCORES['fuzzy'], rel=1e-5)
+    #several matches per label come best first
+    matches = kb.resolve_names(['memmory T'], kinds=['celltype'], n_matches=3, min_score=0.2)
+    assert len(matches) == 3
+    assert list(matches['score']) == sorted(matches['score'], reverse=True)
+
+
+def test_unresolved_and_missing_labels(kb):
+    result = kb.resolve_names(['zzzzqqq', np.nan, 'zzzzqqq'], kinds=['celltype'])
+    assert len(result) == 3
+    assert result['match'].isna().all()
+    assert (result['score'] == 0).all()
+
+
+def test_synonyms_invalidate_the_index(fresh_kb):
+    assert fresh_kb.resolve_names(['cytotoxic lymphocyte'], fuzzy=False)['match'].isna().all()
+    fresh_kb.add_synonyms({'cytotoxic lymphocyte': 'CD8-T'})
+    result = fresh_kb.resolve_names(['Cytotoxic-Lymphocytes'], fuzzy=False)
+    assert list(result['match']) == ['CD8-T']
+    assert list(result['method']) == ['synonym']
+    assert fresh_kb.graph.nodes['CD8-T']['synonyms'] == ['cytotoxic lymphocyte']
+    with pytest.raises(ValueError):
+        fresh_kb.add_synonyms({'x': 'not-a-name'})
+
+
+def test_hierarchy_resolve_labels(kb):
+    hierarchy = cp.tl.hier.Hierarchy(cp.tl.hier.get_hierarchy_dict(kb))
+    result = hierarchy.resolve_labels(['CD8-T', 'cd8 t cells', 'B-naiv'], fuzzy=False)
+    assert list(result['match']) == ['CD8-T', 'CD8-T', 'B-naive']
+    assert list(result['method']) == ['exact', 'normalized', 'prefix']
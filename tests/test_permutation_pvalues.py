@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.stats
+
+from cytopus.tl import label
+from cytopus.tl.label import label_marker_genes, overlap_coefficient
+
+
+@pytest.fixture(scope='module')
+def gene_sets():
+    rng = np.random.default_rng(0)
+    universe = [f'g{i}' for i in range(300)]
+    gs_dict = {f'gs{i}': list(rng.choice(universe, size, replace=False)) for i, size in enumerate([5, 12, 20, 40, 12])}
+    markers = [list(rng.choice(gs_dict['gs2'], 8, replace=False)) + list(rng.choice(universe, 2)),
+               list(rng.choice(universe, 10, replace=False)),
+               list(gs_dict['gs0'][:3]) + ['nan'] * 7]
+    return universe, gs_dict, markers
+
+
+def _reference_overlap(markers, gs_dict, threshold):
+    '''
+    overlap coefficients and labels with the cytopus 1.x per pair set loop
+    '''
+    rows, labels = [], []
+    for i, factor in enumerate(markers):
+        marker_set = set(factor) - {'nan'}
+        row = [overlap_coefficient(set(gs) - {'nan'}, marker_set) for gs in gs_dict.values()]
+        rows.append(row)
+        best = int(np.nanargmax(row))
+        labels.append(list(gs_dict)[best] if row[best] > threshold else i)
+    return pd.DataFrame(rows, index=labels, columns=list(gs_dict))
+
+
+def _brute_force_p_values(markers, gs_dict, universe, n_permutations, seed):
+    '''
+    empirical p-values from random marker sets of matched size drawn one by one from the universe
+    '''
+    rng = np.random.default_rng(seed)
+    universe_set = set(universe)
+    p_values = np.zeros((len(markers), len(gs_dict)))
+    for i, factor in enumerate(markers):
+        marker_set = (set(factor) - {'nan'}) & universe_set
+        for j, gs in enumerate(gs_dict.values()):
+            gene_set = set(gs) & universe_set
+            observed = len(marker_set & gene_set)
+            hits = sum(len(gene_set.intersection(rng.choice(universe, len(marker_set), replace=False))) >= observed
+                       for _ in range(n_permutations))
+            p_values[i, j] = (1 + hits) / (1 + n_permutations)
+    return p_values
+
+
+def test_overlap_matches_reference(gene_sets):
+    universe, gs_dict, markers = gene_sets
+    result = label_marker_genes(markers, gs_dict, threshold=0.4, cache=False)
+    pd.testing.assert_frame_equal(result, _reference_overlap(markers, gs_dict, 0.4), check_names=False)
+
+
+def test_null_tails_match_hypergeometric():
+    n_universe, n_permutations = 300, 20000
+    marker_sizes, gene_set_sizes = np.array([3, 10]), np.array([5, 12, 40])
+    tails = label._null_tails(n_universe, marker_sizes, gene_set_sizes, n_permutations, seed=1, cache=False)
+    for i, m in enumerate(marker_sizes):
+        for j, s in enumerate(gene_set_sizes):
+            expected = scipy.stats.hypergeom.sf(np.arange(m + 1) - 1, n_universe, s, m)
+            observed = tails[i, j, :m + 1] / n_permutations
+            np.testing.assert_allclose(observed, expected, atol=5 * np.sqrt(0.25 / n_permutations))
+
+
+def test_p_values_match_brute_force(gene_sets):
+    universe, gs_dict, markers = gene_sets
+    n_permutations = 2000
+    result = label_marker_genes(markers, gs_dict, cache=False, n_permutations=n_permutations, universe=universe, seed=0)
+    p_values = result.attrs['p_values'].values
+    reference = _brute_force_p_values(markers, gs_dict, universe, n_permutations, seed=0)
+    np.testing.assert_allclose(p_values, reference, atol=5 * np.sqrt(0.25 / n_permutations))
+    #the planted overlap is significant, the random factor is not
+    assert p_values[0, 2] < 0.01
+    assert result.attrs['labels']['label'].iloc[0] == 'gs2'
+    assert result.attrs['labels']['p_value'].iloc[0] == p_values[0, 2]
+
+
+def test_p_values_do_not_depend_on_n_jobs(gene_sets):
+    universe, gs_dict, markers = gene_sets
+    kwargs = dict(cache=False, n_permutations=1000, universe=universe, seed=3)
+    label._null_cache.clear()
+    single = label_marker_genes(markers, gs_dict, n_jobs=1, **kwargs).attrs['p_values']
+    label._null_cache.clear()
+    parallel = label_marker_genes(markers, gs_dict, n_jobs=4, **kwargs).attrs['p_values']
+    pd.testing.assert_frame_equal(single, parallel)
+    #a second call reuses the memoized null
+    assert len(label._null_cache) == 1
+    pd.testing.assert_frame_equal(label_marker_genes(markers, gs_dict, **kwargs).attrs['p_values'], single)
+    other_seed = label_marker_genes(markers, gs_dict, **dict(kwargs, seed=4)).attrs['p_values']
+    assert not other_seed.equals(single)
+
+
+def test_alpha_filters_labels(gene_sets):
+    universe, gs_dict, markers = gene_sets
+    result = label_marker_genes(markers, gs_dict, threshold=0.0, cache=False, n_permutations=500, universe=universe,
+                                alpha=0.05)
+    labels = result.attrs['labels']
+    assert (labels['p_value'].dropna() <= 0.05).all()
+    assert labels['label'].iloc[0] == 'gs2'
+    with pytest.raises(ValueError):
+        label_marker_genes(markers, gs_dict, alpha=0.05, cache=False)
+
+
+def test_null_chunks_run_in_worker_processes(monkeypatch):
+    import concurrent.futures
+    pools = []
+
+    class RecordingPool(concurrent.futures.ProcessPoolExecutor):
+        def __init__(self, max_workers=None, **kwargs):
+            pools.append(max_workers)
+            super().__init__(max_workers=max_workers, **kwargs)
+
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', RecordingPool)
+    marker_sizes, gene_set_sizes = np.array([3, 10]), np.array([5, 12, 40])
+    single = label._null_tails(300, marker_sizes, gene_set_sizes, 1000, seed=2, n_jobs=1, cache=False)
+    assert pools == []
+    label._null_cache.clear()
+    parallel = label._null_tails(300, marker_sizes, gene_set_sizes, 1000, seed=2, n_jobs=3, cache=False)
+    assert pools == [3]
+    np.testing.assert_array_equal(single, parallel)
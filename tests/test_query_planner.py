@@ -0,0 +1,103 @@
+import networkx as nx
+import pytest
+
+import baseline
+
+
+def _reference_query(graph, celltypes=None, relation='self', depth=None, gene_set_class=None,
+                     edge_class=('process_OF', 'identity_OF'), genes_any=None, genes_all=None, metadata=None):
+    '''
+    scan all gene set attachments and apply every filter to each of them
+    '''
+    classes = baseline.node_classes(graph)
+    view = nx.DiGraph(baseline.celltype_view(graph))
+    selected = None
+    if celltypes is not None:
+        selected = {c for c in celltypes if classes.get(c) == 'cell_type'}
+        for c in list(selected):
+            if relation in ('descendants', 'lineage'):
+                selected |= set(nx.traversal.bfs_tree(view, c, reverse=True, depth_limit=depth))
+            if relation in ('ancestors', 'lineage'):
+                selected |= set(nx.traversal.bfs_tree(view, c, depth_limit=depth))
+    rows = set()
+    for gene_set, celltype, c in graph.edges(data='class'):
+        if c not in edge_class or (selected is not None and celltype not in selected):
+            continue
+        if gene_set_class is not None and classes[gene_set] not in gene_set_class:
+            continue
+        genes = {g for g in graph.succ[gene_set] if classes[g] == 'gene'}
+        if genes_any is not None and not genes & set(genes_any):
+            continue
+        if genes_all is not None and not set(genes_all) <= genes:
+            continue
+        if any(graph.nodes[gene_set].get(k) not in (v if isinstance(v, list) else [v]) for k, v in (metadata or {}).items()):
+            continue
+        rows.add((gene_set, classes[gene_set], celltype, c, len(genes)))
+    return rows
+
+
+def _queries(kb):
+    gene_set = next(u for u, v, c in kb.graph.edges(data='class') if c == 'process_OF')
+    attribute = next(k for k in ['gene_set_topic', 'gene_set_type', 'author'] if kb.graph.nodes[gene_set].get(k) is not None)
+    value = kb.graph.nodes[gene_set][attribute]
+    return [
+        {},
+        {'celltypes': ['T', 'B', 'unknown-cell-type']},
+        {'celltypes': ['T'], 'relation': 'descendants'},
+        {'celltypes': ['CD8-T'], 'relation': 'ancestors', 'depth': 2},
+        {'celltypes': ['TNK'], 'relation': 'lineage', 'gene_set_class': ['identity']},
+        {'gene_set_class': ['cellular_process'], 'genes_any': ['CD3E', 'MKI67', 'NOT-A-GENE']},
+        {'genes_all': ['CD3E', 'CD3D']},
+        {'celltypes': ['all-cells'], 'relation': 'descendants', 'genes_all': ['MKI67']},
+        {'metadata': {attribute: [value]}, 'edge_class': ['process_OF']},
+        {'metadata': {attribute: value}, 'celltypes': ['all-cells'], 'relation': 'descendants', 'genes_any': ['CD3E']},
+    ]
+
+
+@pytest.mark.filterwarnings('ignore:cell types')
+def test_query_matches_scan_of_attachments(kb):
+    for filters in _queries(kb):
+        result = kb.query(**filters)
+        rows = {tuple(x) for x in result[['gene_set', 'gene_set_class', 'celltype', 'edge_class', 'n_genes']].values}
+        assert rows == _reference_query(kb.graph, **filters), filters
+        assert len(rows) == len(result)
+        estimates = [step['estimate'] for step in result.attrs['plan']]
+        assert estimates == sorted(estimates)
+
+
+def test_query_counts_matched_genes(kb):
+    result = kb.query(genes_any=['CD3E', 'CD3D', 'CD3G'])
+    for gene_set, n_matched in zip(result['gene_set'], result['n_matched_genes']):
+        assert n_matched == len({'CD3E', 'CD3D', 'CD3G'} & set(kb.graph.succ[gene_set]))
+
+
+@pytest.mark.filterwarnings('ignore:cell types')
+def test_plan_estimates_count_attachments(kb):
+    #single filter estimates are in the unit of the result: attachments (upper bounds for the gene filters)
+    for filters in _queries(kb):
+        if len(filters) - ('edge_class' in filters) != 1 or filters.get('relation', 'self') != 'self':
+            continue
+        result = kb.query(**filters)
+        (step,) = result.attrs['plan']
+        if step['filter'] in ('genes_any', 'genes_all'):
+            assert step['estimate'] >= len(result)
+        else:
+            assert step['estimate'] == len(result), filters
+    for gene_set_class in (['identity'], ['cellular_process']):
+        (step,) = kb.query(gene_set_class=gene_set_class).attrs['plan']
+        assert step['estimate'] == len(_reference_query(kb.graph, gene_set_class=gene_set_class))
+
+
+def test_class_estimate_counts_attachments_of_shared_gene_sets(fresh_kb):
+    G = fresh_kb
+    gene_sets = [u for u, v, c in G.graph.edges(data='class') if c == 'process_OF'][:5]
+    for gene_set in gene_sets:
+        for celltype in ['B', 'M', 'NK']:
+            G.graph.add_edge(gene_set, celltype, **{'class': 'process_OF'})
+    G.invalidate()
+    result = G.query(gene_set_class=['cellular_process'])
+    (step,) = result.attrs['plan']
+    assert step['estimate'] == len(result) == len(_reference_query(G.graph, gene_set_class=['cellular_process']))
+    #the class filter is no longer preferred over a cell type filter selecting fewer attachments
+    plan = G.query(celltypes=['B'], gene_set_class=['cellular_process']).attrs['plan']
+    assert [step['filter'] for step in plan] == ['celltypes', 'gene_set_class']
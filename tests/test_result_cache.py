@@ -0,0 +1,111 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cytopus.knowledge_base.kb_cache import ResultCache, make_key
+from cytopus.tl.label import label_marker_genes
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(path=str(tmp_path / 'cache'))
+
+
+def _call(G, cache, inplace=False):
+    return G.get_celltype_processes(['T', 'B', 'CD8-T'], global_celltypes=['all-cells'], inplace=inplace, cache=cache)
+
+
+def test_cached_celltype_processes_match_and_share_gene_names(fresh_kb, cache):
+    G = fresh_kb
+    computed = _call(G, cache)
+    assert len(os.listdir(cache.path)) == 1
+    loaded = _call(G, cache)
+    assert loaded == computed and [list(v) for v in loaded.values()] == [list(v) for v in computed.values()]
+    assert all(type(v) is dict and all(type(genes) is list for genes in v.values()) for v in loaded.values())
+
+    #gene names are the KnowledgeBase's own strings and gene sets listed under several cell types share one list
+    nodes = {id(n) for n in G.graph.nodes}
+    assert all(id(g) in nodes for value in loaded.values() for genes in value.values() for g in genes)
+    shared = set(loaded['T']) & set(loaded['CD8-T'])
+    assert shared and all(loaded['T'][k] is loaded['CD8-T'][k] for k in shared)
+
+    _call(G, cache, inplace=True)
+    assert G.celltype_process_dict == computed
+
+
+def test_cache_entries_store_plain_gene_lists(fresh_kb, cache):
+    import pickle
+    _call(fresh_kb, cache)
+    path = os.path.join(cache.path, os.listdir(cache.path)[0])
+    entry = pickle.load(open(path, 'rb'))
+    assert type(entry) is dict and set(entry) == {'gene_sets', 'celltypes', 'messages'}
+    assert all(type(v) is list for v in entry['gene_sets'].values())
+    assert os.path.getsize(path) < 64 * 2**10
+
+
+def test_cache_is_invalidated_by_same_count_edits(fresh_kb, cache):
+    G = fresh_kb
+    before = _call(G, cache)
+    gene_set = next(k for k in before['B'] if G.graph.has_edge(k, 'B'))
+    G.graph.remove_edge(gene_set, 'B')
+    G.graph.add_edge(gene_set, 'CD8-T', **{'class': 'process_OF'})
+    G.invalidate()
+    after = _call(G, cache)
+    assert gene_set in after['CD8-T'] and gene_set not in after['B']
+    assert after == G.get_celltype_processes(['T', 'B', 'CD8-T'], global_celltypes=['all-cells'], inplace=False, cache=False)
+    assert len(os.listdir(cache.path)) == 2
+
+
+def test_content_hash_order(kb, default_graph):
+    import networkx as nx
+    reordered = nx.DiGraph()
+    reordered.add_nodes_from(reversed(list(default_graph.nodes(data=True))))
+    reordered.add_edges_from(reversed(list(default_graph.edges(data=True))))
+    from cytopus.knowledge_base.kb_index import KBIndex
+    index = KBIndex(reordered)
+    assert index.content_hash() == kb.index.content_hash()
+    assert index.content_hash(ordered=True) != kb.index.content_hash(ordered=True)
+
+
+def test_cached_labels_match(kb, cache):
+    rng = np.random.default_rng(0)
+    genes = sorted({g for v in kb.processes.values() for g in v})
+    markers = pd.DataFrame(rng.choice(genes, (5, 30)), index=[f'factor{i}' for i in range(5)])
+    computed = label_marker_genes(markers, kb.processes, cache=cache)
+    pd.testing.assert_frame_equal(label_marker_genes(markers, kb.processes, cache=cache), computed)
+    assert make_key('label', markers) != make_key('label', markers.iloc[::-1])
+
+
+def test_cache_hits_repeat_warnings_and_messages(fresh_kb, cache, capsys):
+    G = fresh_kb
+    G.verbose = True
+    results, messages = [], []
+    for _ in range(2):
+        with pytest.warns(UserWarning, match='not-a-cell-type'):
+            results.append(G.get_celltype_processes(['T', 'not-a-cell-type'], global_celltypes=['all-cells'],
+                                                    inplace=False, cache=cache))
+        messages.append(capsys.readouterr().out)
+    assert len(os.listdir(cache.path)) == 1
+    assert results[0] == results[1]
+    assert 'not-a-cell-type' in messages[0] and messages[1] == messages[0]
+
+
+def test_cache_hit_survives_concurrent_eviction(cache, monkeypatch):
+    from cytopus.knowledge_base import kb_cache
+    cache.put('key', [1, 2])
+    utime = os.utime
+
+    def evicted(path):
+        #another process evicts the entry between reading and marking it as recently used
+        os.remove(path)
+        utime(path)
+    monkeypatch.setattr(kb_cache.os, 'utime', evicted)
+    assert cache.get('key') == [1, 2]
+    assert cache.get('key') is None
+
+
+def test_new_cache_directories_are_private(tmp_path):
+    cache = ResultCache(path=str(tmp_path / 'private' / 'cache'))
+    assert os.stat(cache.path).st_mode & 0o077 == 0
@@ -0,0 +1,77 @@
+import networkx as nx
+import pytest
+
+import cytopus as cp
+
+import baseline
+
+QUERIES = [
+    (['T'], {}),
+    (['T', 'B', 'M', 'not-a-cell-type'], {'global_celltypes': ['all-cells']}),
+    (['CD8-T', 'abT', 'TNK'], {'parent_depth': 3, 'child_depth': 1}),
+    (['blood', 'M'], {'get_parents': False}),
+]
+
+
+def _keys(nested):
+    '''
+    nested lists of the keys of a nested dictionary, which unlike dict equality compares their order
+    '''
+    return [(k, _keys(v)) for k, v in nested.items()]
+
+
+@pytest.mark.filterwarnings('ignore:Not all cell types')
+@pytest.mark.parametrize('celltypes,kwargs', QUERIES)
+def test_celltype_processes_keep_networkx_order(kb, celltypes, kwargs):
+    result = kb.get_celltype_processes(celltypes, inplace=False, cache=False, **kwargs)
+    reference = baseline.celltype_processes(kb.graph, celltypes, **kwargs)
+    assert list(result) == list(reference)
+    for key in reference:
+        assert list(result[key]) == list(reference[key])
+        assert list(result[key].values()) == list(reference[key].values())
+
+
+def test_traversal_keeps_bfs_order(kb):
+    #the view, not a copy, a copied graph lists predecessors in edge order
+    view = baseline.celltype_view(kb.graph)
+    index = kb.index
+    for node in ['all-cells', 'T', 'M', 'blood', 'CD8-T']:
+        for invert in (False, True):
+            tree = nx.traversal.bfs_tree(view, node, reverse=not invert)
+            assert [index.names[c] for c in index.traverse_hierarchy(node, invert=invert)[0].tolist()] == list(tree)[1:]
+
+
+def test_nested_hierarchies_keep_sibling_order(kb):
+    for node in ['all-cells', 'T', 'M']:
+        assert _keys(kb.get_celltype_hierarchy(node)) == _keys(baseline.hierarchy(kb.graph, node))
+    assert _keys(kb.get_celltype_hierarchy('CD8-T', invert=True)) == _keys(baseline.hierarchy(kb.graph, 'CD8-T', invert=True))
+    hierarchy_dict = cp.tl.hier.get_hierarchy_dict(kb)
+    assert _keys(hierarchy_dict) == _keys(baseline.hierarchy_dict(kb.graph))
+
+
+@pytest.mark.filterwarnings('ignore:Cell types')
+def test_hierarchy_keeps_sibling_order(kb, tmp_path):
+    hierarchy = cp.tl.hier.Hierarchy(cp.tl.hier.get_hierarchy_dict(kb))
+    reference = cp.tl.hier.Hierarchy(baseline.hierarchy_dict(kb.graph))
+    celltypes = [n for n, t in reference.graph.nodes(data='type') if t == 'cell_type']
+    assert [n for n, t in hierarchy.graph.nodes(data='type') if t == 'cell_type'] == celltypes
+    for celltype in celltypes:
+        assert list(hierarchy.graph.predecessors(celltype)) == list(reference.graph.predecessors(celltype))
+    hierarchy.save(str(tmp_path / 'hierarchy.cyh'))
+    loaded = cp.tl.hier.Hierarchy.load(str(tmp_path / 'hierarchy.cyh'))
+    for celltype in celltypes:
+        assert list(loaded.graph.predecessors(celltype)) == list(reference.graph.predecessors(celltype))
+
+
+def test_reordering_children_after_invalidate(fresh_kb):
+    G = fresh_kb
+    children = list(G.graph.predecessors('T'))
+    assert list(G.get_celltype_hierarchy('T')) == children
+    #re-adding the edge of the first child moves it last in networkx predecessor order, also if graph.edges is unchanged
+    data = dict(G.graph.edges[children[0], 'T'])
+    G.graph.remove_edge(children[0], 'T')
+    G.graph.add_edge(children[0], 'T', **data)
+    G.invalidate()
+    assert list(G.get_celltype_hierarchy('T')) == children[1:] + children[:1] == list(G.graph.predecessors('T'))
+    assert G.get_celltype_processes(['T'], inplace=False, cache=False) == baseline.celltype_processes(G.graph, ['T'])
+    assert list(G.get_celltype_processes(['T'], inplace=False, cache=False)['T']) == list(baseline.celltype_processes(G.graph, ['T'])['T'])
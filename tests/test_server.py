@@ -0,0 +1,97 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import baseline
+from cytopus.knowledge_base.kb_server import make_server, KnowledgeBaseClient, KBSnapshot
+
+
+@pytest.fixture
+def client(fresh_kb):
+    server = make_server(fresh_kb, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield KnowledgeBaseClient(f'http://127.0.0.1:{server.server_address[1]}')
+    server.shutdown()
+    server.server_close()
+
+
+def test_served_queries_match_networkx(client, kb):
+    assert client.health()['content_hash'] == kb.index.content_hash()
+    processes = client.get_celltype_processes(['T', 'B'], global_celltypes=['all-cells'])
+    assert processes == baseline.celltype_processes(kb.graph, ['T', 'B'], global_celltypes=['all-cells'])
+    assert client.get_celltype_hierarchy('T') == baseline.hierarchy(kb.graph, 'T')
+    assert client.get_identities(['T', 'B']) == baseline.identities(kb.graph, ['T', 'B'])
+    pd.testing.assert_frame_equal(client.query(celltypes=['T'], relation='descendants'),
+                                  kb.query(celltypes=['T'], relation='descendants'), check_dtype=False)
+    lca = client.lowest_common_ancestor(['CD8-T', 'B', 'unknown'], ['CD4-T', 'T', 'T'])
+    expected = kb.lowest_common_ancestor(['CD8-T', 'B', 'unknown'], ['CD4-T', 'T', 'T'])
+    assert lca['lca'].tolist()[:2] == expected['lca'].tolist()[:2] and pd.isna(lca['lca'].iloc[2])
+    assert lca['distance'].tolist() == expected['distance'].tolist()
+
+
+def test_batch_and_errors(client, kb):
+    results = client.batch([('get_identities', {'celltypes_identities': ['T']}), ('not_a_method', {}),
+                            ('get_celltype_hierarchy', {'node': 'B'})])
+    assert results[0] == baseline.identities(kb.graph, ['T'])
+    assert isinstance(results[1], RuntimeError)
+    assert results[2] == baseline.hierarchy(kb.graph, 'B')
+    with pytest.raises(RuntimeError):
+        client.get_celltype_hierarchy('not-a-cell-type')
+
+
+def test_concurrent_clients(client, kb):
+    celltypes = ['T', 'B', 'M', 'NK', 'CD8-T', 'DC']
+    expected = {c: baseline.celltype_processes(kb.graph, [c]) for c in celltypes}
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda c: (c, client.get_celltype_processes([c])), celltypes * 4))
+    assert all(result == expected[c] for c, result in results)
+
+
+def test_labels_over_http(client, kb):
+    from cytopus.tl.label import label_marker_genes
+    rng = np.random.default_rng(0)
+    genes = sorted({g for v in kb.processes.values() for g in v})
+    markers = pd.DataFrame(rng.choice(genes, (3, 50)), index=['f0', 'f1', 'f2'])
+    served = client.label_marker_genes(markers.values)
+    local = label_marker_genes(markers.values, kb.processes)
+    assert served.shape == local.shape
+    np.testing.assert_allclose(served.values.astype(float), local.values.astype(float))
+
+
+def test_snapshot_leaves_the_knowledge_base_editable(fresh_kb):
+    import networkx as nx
+    G = fresh_kb
+    G.verbose = True
+    expected = baseline.hierarchy(G.graph, 'T')
+    snapshot = KBSnapshot(G)
+    assert nx.is_frozen(snapshot.kb.graph) and not nx.is_frozen(G.graph) and G.verbose
+
+    child = next(iter(expected))
+    G.graph.remove_edge(child, 'T')
+    G.processes['new-gene-set'] = ['CD3E']
+    G.invalidate()
+    assert child not in G.get_celltype_hierarchy('T')
+    assert snapshot.get_celltype_hierarchy('T') == expected and 'new-gene-set' not in snapshot.kb.processes
+
+
+def test_concurrent_first_use_builds_every_memo_once(kb):
+    from cytopus.knowledge_base.kb_index import KBIndex
+    index = KBIndex(kb.graph)
+    barrier = threading.Barrier(8)
+    gene_sets = list(kb.processes)[:20]
+
+    def read(i):
+        barrier.wait()
+        #more dataset alignments than the index keeps, so memos are evicted while other threads read them
+        for j in range(4):
+            index.gene_set_incidence([f'gene{i}-{j}', 'CD3E', 'CD8A'], gene_sets)
+        return index.name_index(), index.traverse_hierarchy('all-cells'), index.edge_adjacency(['gene_OF'], by='dst')
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(read, range(8)))
+    assert all(all(a is b for a, b in zip(result, results[0])) for result in results)
+    assert len(index._incidence) <= 16
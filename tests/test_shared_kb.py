@@ -0,0 +1,90 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from cytopus.knowledge_base import attach_kb, publish_kb
+
+import baseline
+
+CELLTYPES = ['T', 'B', 'M', 'not-a-cell-type']
+
+#publishes the default KnowledgeBase and lets a pool of workers attach to it
+WORKER_SCRIPT = '''
+import multiprocessing
+import sys
+from cytopus.knowledge_base import publish_kb
+
+def work(shared):
+    return len(shared.processes), sorted(shared.get_celltype_processes(['T']))
+
+if __name__ == '__main__':
+    with publish_kb() as shared:
+        with multiprocessing.get_context(sys.argv[1]).Pool(2) as pool:
+            print(pool.map(work, [shared] * 4))
+'''
+
+
+@pytest.fixture(scope='module')
+def shared(kb):
+    with publish_kb(kb) as shared:
+        yield shared
+
+
+def _run(path, code, *args):
+    '''
+    run code as a script in a new interpreter (spawned workers import their functions from the script file)
+    '''
+    path.write_text(textwrap.dedent(code))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(os.path.dirname(__file__)), os.environ.get('PYTHONPATH', '')]))
+    return subprocess.run([sys.executable, str(path), *args], capture_output=True, text=True, env=env, timeout=300)
+
+
+def test_shared_queries_match_kb(kb, default_graph, shared):
+    assert set(shared.celltypes) == set(baseline.celltypes(default_graph))
+    assert dict(shared.processes) == kb.processes
+    assert dict(shared.identities) == kb.identities
+    assert shared.get_identities(CELLTYPES) == kb.get_identities(CELLTYPES)
+    assert shared.get_processes(['not-a-gene-set'] + list(kb.processes)[:20]) == kb.get_processes(list(kb.processes)[:20])
+    query = dict(global_celltypes=['all-cells'], parent_depth=2, child_depth=1)
+    assert shared.get_celltype_processes(CELLTYPES, **query) == \
+        baseline.celltype_processes(default_graph, CELLTYPES, **query)
+    assert shared.get_celltype_hierarchy('T') == kb.get_celltype_hierarchy('T')
+    genes = list(kb.processes[next(iter(kb.processes))])[:5]
+    assert shared.get_gene_sets(genes) == kb.get_gene_sets(genes)
+
+
+def test_attach_in_process(kb, shared):
+    attached = attach_kb(shared.name)
+    assert dict(attached.processes) == kb.processes
+    attached.close()
+    #closing an attachment leaves the block to the publisher
+    attached = attach_kb(shared.name)
+    assert len(attached.processes) == len(kb.processes)
+    attached.close()
+
+
+@pytest.mark.parametrize('method', ['spawn', 'fork', 'forkserver'])
+def test_workers_attach_without_tracker_noise(kb, tmp_path, method):
+    result = _run(tmp_path / 'workers.py', WORKER_SCRIPT, method)
+    assert result.returncode == 0, result.stderr
+    expected = (len(kb.processes), sorted(kb.get_celltype_processes(['T'], inplace=False, cache=False)))
+    assert result.stdout.strip() == str([expected] * 4)
+    #the resource tracker neither reports leaked blocks nor fails to unregister them
+    assert result.stderr == ''
+
+
+def test_separate_process_does_not_unlink(shared, tmp_path):
+    result = _run(tmp_path / 'attach.py', f'''
+        from cytopus.knowledge_base import attach_kb
+        shared = attach_kb({shared.name!r})
+        print(len(shared.processes))
+        shared.close()
+    ''')
+    assert result.returncode == 0, result.stderr
+    assert result.stderr == ''
+    attached = attach_kb(shared.name)
+    assert int(result.stdout) == len(attached.processes)
+    attached.close()
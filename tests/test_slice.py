@@ -0,0 +1,68 @@
+import pickle
+
+import networkx as nx
+import pytest
+
+import cytopus as cp
+from cytopus.cli import main
+
+import baseline
+
+CELLTYPES = ['T', 'B-naive']
+
+
+def _expected_celltypes(graph, celltypes, depth=None, ancestors=True):
+    '''
+    cell types of a slice with networkx: the cell types, their descendants up to depth and their ancestors
+    '''
+    view = baseline.celltype_view(graph)
+    expected = set()
+    for celltype in celltypes:
+        expected |= set(nx.traversal.bfs_tree(view, celltype, reverse=True, depth_limit=depth))
+        if ancestors:
+            expected |= nx.descendants(view, celltype)
+    return expected
+
+
+@pytest.mark.parametrize('depth,ancestors', [(None, True), (1, True), (None, False)])
+def test_slice_content_matches_networkx(kb, default_graph, depth, ancestors):
+    kb_slice = kb.slice(CELLTYPES, depth=depth, ancestors=ancestors)
+    celltypes = _expected_celltypes(default_graph, CELLTYPES, depth=depth, ancestors=ancestors)
+    assert set(kb_slice.celltypes) == celltypes
+    gene_set_edges = baseline.edges_of_class(default_graph, ['process_OF', 'identity_OF'], target=celltypes)
+    gene_sets = {u for u, v in gene_set_edges}
+    assert set(kb_slice.processes) == set(kb.processes) & gene_sets
+    assert set(kb_slice.identities) == set(baseline.identities(default_graph, celltypes))
+    for gene_set in kb_slice.processes:
+        assert kb_slice.processes[gene_set] == kb.processes[gene_set]
+    #every edge of the full graph between nodes of the slice is kept with its attributes
+    sub = default_graph.subgraph(kb_slice.graph.nodes)
+    assert set(kb_slice.graph.edges) == set(sub.edges)
+    for u, v, d in kb_slice.graph.edges(data=True):
+        assert d == default_graph.edges[u, v]
+    for n, d in kb_slice.graph.nodes(data=True):
+        assert d == default_graph.nodes[n]
+
+
+def test_slice_queries_match_full_kb(kb):
+    kb_slice = kb.slice(CELLTYPES)
+    query = dict(global_celltypes=['all-cells'], parent_depth=1, inplace=False, cache=False)
+    assert kb_slice.get_celltype_processes(CELLTYPES, **query) == kb.get_celltype_processes(CELLTYPES, **query)
+    assert kb_slice.get_celltype_hierarchy('T') == kb.get_celltype_hierarchy('T')
+    assert kb_slice.get_identities(CELLTYPES) == kb.get_identities(CELLTYPES)
+    with pytest.raises(ValueError):
+        kb.slice(['not-a-cell-type'])
+
+
+def test_save_and_cli_round_trip(kb, tmp_path):
+    path = str(tmp_path / 'slice.pkl')
+    main(['slice', path, '--celltypes', *CELLTYPES, '--depth', '1'])
+    with open(path, 'rb') as f:
+        graph = pickle.load(f)
+    expected = kb.slice(CELLTYPES, depth=1)
+    assert set(graph.nodes) == set(expected.graph.nodes)
+    assert set(graph.edges) == set(expected.graph.edges)
+    loaded = cp.KnowledgeBase(path, verbose=False)
+    assert loaded.processes == expected.processes
+    expected.save(str(tmp_path / 'saved.pkl'))
+    assert cp.KnowledgeBase(str(tmp_path / 'saved.pkl'), verbose=False).identities == expected.identities
@@ -0,0 +1,81 @@
+import pandas as pd
+import pytest
+
+import cytopus as cp
+from cytopus.knowledge_base.kb_versions import diff_kb, _load_graph
+
+
+def _reference_diff(graph_a, graph_b):
+    '''
+    diff of two graphs with python sets over their nodes and edges
+    '''
+    def nodes(graph, cls):
+        return {n for n, c in graph.nodes(data='class') if c == cls}
+
+    def edges(graph, cls):
+        return {(u, v) for u, v, c in graph.edges(data='class') if c == cls}
+
+    def gene_sets(graph):
+        return {u for u, v, c in graph.edges(data='class') if c in ('gene_OF', 'process_OF', 'identity_OF')}
+
+    def changes(cls, shared):
+        old, new = edges(graph_a, cls), edges(graph_b, cls)
+        return ({e for e in new - old if e[0] in shared}, {e for e in old - new if e[0] in shared})
+
+    report = {}
+    for key, a, b in [('celltypes', nodes(graph_a, 'cell_type'), nodes(graph_b, 'cell_type')),
+                      ('gene_sets', gene_sets(graph_a), gene_sets(graph_b)),
+                      ('genes', nodes(graph_a, 'gene'), nodes(graph_b, 'gene'))]:
+        report[key] = {'added': sorted(b - a), 'removed': sorted(a - b)}
+    shared_gene_sets = gene_sets(graph_a) & gene_sets(graph_b)
+    shared_celltypes = nodes(graph_a, 'cell_type') & nodes(graph_b, 'cell_type')
+    report['gene_set_membership'] = changes('gene_OF', shared_gene_sets)
+    report['hierarchy_moves'] = changes('SUBSET_OF', shared_celltypes)
+    report['gene_set_celltypes'] = tuple(set.union(*x) for x in zip(changes('process_OF', shared_gene_sets),
+                                                                     changes('identity_OF', shared_gene_sets)))
+    return report
+
+
+def _edge_sets(frame, origin, target):
+    return ({tuple(x) for x in frame.loc[frame.change == 'added', [origin, target]].values},
+            {tuple(x) for x in frame.loc[frame.change == 'removed', [origin, target]].values})
+
+
+def _check(report, reference):
+    for key in ['celltypes', 'gene_sets', 'genes']:
+        assert report[key] == reference[key]
+    assert _edge_sets(report['gene_set_membership'], 'gene_set', 'gene') == reference['gene_set_membership']
+    assert _edge_sets(report['gene_set_celltypes'], 'gene_set', 'celltype') == reference['gene_set_celltypes']
+    added, removed = reference['hierarchy_moves']
+    moves = report['hierarchy_moves'].set_index('celltype')
+    assert set(moves.index) == {u for u, _ in added | removed}
+    assert {(c, p) for c, parents in moves['new_parents'].items() for p in parents} == added
+    assert {(c, p) for c, parents in moves['old_parents'].items() for p in parents} == removed
+
+
+def test_diff_of_bundled_versions(kb):
+    old = _load_graph('Cytopus_1.23.txt')
+    _check(diff_kb(old, kb), _reference_diff(old, kb.graph))
+
+
+def test_diff_of_edited_graph(kb, fresh_kb):
+    graph = fresh_kb.graph
+    gene_set = next(u for u, v, c in graph.edges(data='class') if c == 'process_OF' and v != 'B')
+    celltype = next(iter(graph.succ[gene_set]))
+    graph.remove_edge(gene_set, celltype)
+    graph.add_edge(gene_set, 'B', **{'class': 'process_OF'})
+    graph.add_edge(gene_set, 'NEWGENE', **{'class': 'gene_OF'})
+    graph.nodes['NEWGENE']['class'] = 'gene'
+    graph.remove_edge('CD8-T', next(iter(graph.succ['CD8-T'])))
+    graph.add_edge('CD8-T', 'B', **{'class': 'SUBSET_OF'})
+
+    report = fresh_kb.diff(kb)
+    _check(report, _reference_diff(graph, kb.graph))
+    assert report['genes']['removed'] == ['NEWGENE']
+    assert report['summary']['hierarchy_moves'] == 1
+
+
+def test_list_versions_without_loading():
+    versions = cp.knowledge_base.kb_versions.list_versions()
+    assert versions['default'].sum() == 1
+    assert (versions['size_bytes'] > 0).all()